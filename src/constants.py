@@ -42,6 +42,14 @@ def get_scheduling_database_file():
     """ Get the filename of the scheduling database file. This file is in sqlite format. """
     return "/opt/openmotics/etc/sched.db"
 
+def get_eeprom_cache_database_file():
+    """ Get the filename of the master eeprom cache. This file is in sqlite format. """
+    return "/opt/openmotics/etc/eeprom_cache.db"
+
+def get_energy_store_dir():
+    """ Get the directory of the power history files, these files have a fixed size. """
+    return "/opt/openmotics/etc/energy/"
+
 
 def get_ssl_certificate_file():
     """ Get the filename of the ssl certificate. """
@@ -31,33 +31,46 @@ LOGGER = logging.getLogger("openmotics")
 import time as pytime
 import datetime
 import traceback
-import math
-from threading import Timer
+from threading import Timer, Thread
 
 from serial_utils import CommunicationTimedOutException
 
 import master.master_api as master_api
-from master.outputs import OutputStatus
+from master.outputs import OutputStatus, OutputReader, OutputCommandQueue
 from master.inputs import InputStatus
 from master.thermostats import ThermostatStatus
-from master.master_communicator import BackgroundConsumer
+from master.master_communicator import MasterCommunicator, BackgroundConsumer
 
-from master.eeprom_controller import EepromController, EepromFile
+from master.eeprom_controller import EepromController, EepromFile, EepromBankCache
 from master.eeprom_models import OutputConfiguration, InputConfiguration, ThermostatConfiguration,\
               SensorConfiguration, PumpGroupConfiguration, GroupActionConfiguration, \
               ScheduledActionConfiguration, PulseCounterConfiguration, StartupActionConfiguration,\
               DimmerConfiguration, GlobalThermostatConfiguration
 
 import power.power_api as power_api
+from power.power_sampler import PowerSampler
+from power.energy_store import EnergyStore
 
-def convert_nan(number):
-    """ Convert nan to 0. """
-    return 0.0 if math.isnan(number) else number
+from gateway.status_cache import StatusCache
 
 class GatewayApi(object):
     """ The GatewayApi combines master_api functions into high level functions. """
 
-    def __init__(self, master_communicator, power_communicator, power_controller):
+    # Time to live (in seconds) of the status that is read from the master.
+    STATUS_TTL = {'sensor_temperature' : 5, 'sensor_humidity' : 5, 'sensor_brightness' : 5,
+                  'pulse_counters' : 5, 'thermostats' : 2}
+
+    def __init__(self, master_communicator, power_communicator, power_controller,
+                 eeprom_cache_file=None, power_sample_period=1.0, energy_store_dir=None):
+        """ Create a GatewayApi.
+
+        :param eeprom_cache_file: filename of the sqlite database that keeps the master eeprom \
+        banks across restarts, None to only cache the banks in memory.
+        :param power_sample_period: number of seconds between sampling the realtime power of two \
+        power modules, 0 to disable the background sampling.
+        :param energy_store_dir: directory where the history of the sampled power is stored, \
+        None to disable the history.
+        """
         self.__master_communicator = master_communicator
 
         self.__last_maintenance_send_time = 0
@@ -66,9 +79,13 @@ class GatewayApi(object):
         self.__discover_mode_timer = None
 
         self.__output_status = None
+        self.__output_list = None
         self.__master_communicator.register_consumer(
                     BackgroundConsumer(master_api.output_list(), 0, self.__update_outputs))
 
+        self.__output_queue = OutputCommandQueue(self.__master_communicator)
+        self.__output_queue.start()
+
         self.__input_status = InputStatus()
         self.__master_communicator.register_consumer(
                     BackgroundConsumer(master_api.input_list(), 0, self.__update_inputs))
@@ -78,17 +95,34 @@ class GatewayApi(object):
                     BackgroundConsumer(master_api.module_initialize(), 0, self.__update_modules))
 
         self.__thermostat_status = None
+        self.__status_cache = StatusCache(GatewayApi.STATUS_TTL)
 
-        self.__eeprom_controller = EepromController(EepromFile(self.__master_communicator))
+        eeprom_cache = EepromBankCache(eeprom_cache_file) if eeprom_cache_file else None
+        self.__eeprom_controller = EepromController(
+                    EepromFile(self.__master_communicator, eeprom_cache))
+        self.__eeprom_controller.add_volatile_model(ThermostatConfiguration,
+                                                    ['setp%d' % i for i in range(6)])
+        self.__output_reader = OutputReader(self.__master_communicator, self.__eeprom_controller)
 
         self.__power_communicator = power_communicator
         self.__power_controller = power_controller
 
+        self.__energy_store = EnergyStore(energy_store_dir) if energy_store_dir else None
+        self.__power_sampler = PowerSampler(power_communicator, power_controller,
+                                            power_sample_period, self.__energy_store)
+        if power_sample_period > 0:
+            self.__power_sampler.start()
+
         self.__plugin_controller = None
 
         self.init_master()
         self.__run_master_timer()
 
+        verify_thread = Thread(target=self.__verify_eeprom_cache,
+                               name="Eeprom cache verification thread")
+        verify_thread.daemon = True
+        verify_thread.start()
+
     def set_plugin_controller(self, plugin_controller):
         """ Set the plugin controller. """
         self.__plugin_controller = plugin_controller
@@ -121,16 +155,25 @@ class GatewayApi(object):
 
             if write:
                 self.__master_communicator.do_command(master_api.activate_eeprom(), {'eep' : 0})
+                self.__eeprom_controller.invalidate_cache()
 
         except CommunicationTimedOutException:
             LOGGER.error("Got CommunicationTimedOutException during gateway_api initialization.")
 
+    def __verify_eeprom_cache(self):
+        """ Compare the eeprom banks that were kept across the restart with the master. """
+        try:
+            self.__eeprom_controller.verify_cache()
+        except:
+            LOGGER.exception("Exception while verifying the eeprom cache")
+
     def __run_master_timer(self):
         """ Run the master timer, this sets the masters clock if it differs more than 3 minutes
         from the gateway clock. """
 
         try:
-            status = self.__master_communicator.do_command(master_api.status())
+            status = self.__master_communicator.do_command(
+                            master_api.status(), priority=MasterCommunicator.PRIORITY_LOW)
             date = "%02d.%02d.%02d %02d:%02d:%02d" % (status['day'], status['month'],
                         status['year'], status['hours'], status['minutes'], status['seconds'])
 
@@ -208,8 +251,7 @@ class GatewayApi(object):
         if self.__output_status != None:
             self.__output_status.force_refresh()
 
-        if self.__thermostat_status != None:
-            self.__thermostat_status.force_refresh()
+        self.__invalidate_thermostats()
 
         if self.__maintenance_timeout_timer != None:
             self.__maintenance_timeout_timer.cancel()
@@ -288,6 +330,8 @@ class GatewayApi(object):
 
         self.__module_log = []
 
+        self.__eeprom_controller.invalidate_cache() # Discovery changes the modules in the eeprom.
+
         return {'status' : ret['resp']}
 
     def module_discover_stop(self):
@@ -303,6 +347,8 @@ class GatewayApi(object):
 
         self.__module_log = []
 
+        self.__eeprom_controller.invalidate_cache() # Discovery changes the modules in the eeprom.
+
         return {'status' : ret['resp']}
 
     def get_module_log(self):
@@ -358,22 +404,16 @@ class GatewayApi(object):
     ###### Output functions
 
     def __read_outputs(self):
-        """ Read all output information from the MasterApi.
-
-        :returns: a list of dicts with all fields from master_api.read_output.
-        """
-        ret = self.__master_communicator.do_command(master_api.number_of_io_modules())
-        num_outputs = ret['out'] * 8
-
-        outputs = []
-        for i in range(0, num_outputs):
-            outputs.append(self.__master_communicator.do_command(master_api.read_output(),
-                                                                 {'id' : i}))
-        return outputs
+        """ Read all output information using the OutputReader and the last OL message. """
+        last_outputs = None
+        if self.__output_status != None:
+            last_outputs = self.__output_status.get_outputs()
+        return self.__output_reader.read(self.__output_list, last_outputs)
 
     def __update_outputs(self, ol_output):
         """ Update the OutputStatus when an OL is received. """
         on_outputs = ol_output['outputs']
+        self.__output_list = on_outputs
 
         if self.__output_status != None:
             self.__output_status.partial_update(on_outputs)
@@ -398,7 +438,7 @@ class GatewayApi(object):
                  'ctimer':output['ctimer'], 'dimmer':output['dimmer']}
                  for output in outputs]
 
-    def set_output(self, id, is_on, dimmer=None, timer=None):
+    def set_output(self, id, is_on, dimmer=None, timer=None, wait=True):
         """ Set the status, dimmer and timer of an output.
 
         :param id: The id of the output to set
@@ -409,53 +449,76 @@ class GatewayApi(object):
         :type dimmer: Integer [0, 100] or None
         :param timer: The timer value to set, None if unchanged
         :type timer: Integer in [150, 450, 900, 1500, 2220, 3120]
-        :returns: emtpy dict.
+        :param wait: Wait until the commands are executed by the master.
+        :type wait: Boolean
+        :returns: emtpy dict if wait, list of :class`master.outputs.OutputCommandFuture` if not.
         """
+        futures = []
         if not is_on:
             if dimmer != None or timer != None:
                 raise ValueError("Cannot set timer and dimmer when setting output to off")
             else:
-                self.set_output_status(id, False)
+                futures.append(self.set_output_status(id, False, wait=False))
         else:
             if dimmer != None:
-                self.set_output_dimmer(id, dimmer)
+                futures.append(self.set_output_dimmer(id, dimmer, wait=False))
 
-            self.set_output_status(id, True)
+            futures.append(self.set_output_status(id, True, wait=False))
 
             if timer != None:
-                self.set_output_timer(id, timer)
+                futures.append(self.set_output_timer(id, timer, wait=False))
+
+        if not wait:
+            return futures
+
+        for future in futures:
+            future.result()
+
+        return dict()
 
+    def __queue_output_command(self, id, kind, action_type, wait):
+        """ Put a basic action for an output on the output command queue.
+
+        :returns: empty dict if wait, :class`master.outputs.OutputCommandFuture` if not.
+        """
+        future = self.__output_queue.put(id, kind, action_type)
+        if not wait:
+            return future
+
+        future.result()
         return dict()
 
-    def set_output_status(self, id, is_on):
+    def set_output_status(self, id, is_on, wait=True):
         """ Set the status of an output.
 
         :param id: The id of the output to set
         :type id: Integer [0, 240]
         :param is_on: Whether the output should be on
         :type is_on: Boolean
-        :returns: empty dict.
+        :param wait: Wait until the command is executed by the master.
+        :type wait: Boolean
+        :returns: empty dict if wait, :class`master.outputs.OutputCommandFuture` if not.
         """
         if id < 0 or id > 240:
             raise ValueError("id not in [0, 240]: %d" % id)
 
         if is_on:
-            self.__master_communicator.do_command(master_api.basic_action(),
-                    {"action_type" : master_api.BA_LIGHT_ON, "action_number" : id})
+            action_type = master_api.BA_LIGHT_ON
         else:
-            self.__master_communicator.do_command(master_api.basic_action(),
-                    {"action_type" : master_api.BA_LIGHT_OFF, "action_number" : id})
+            action_type = master_api.BA_LIGHT_OFF
 
-        return dict()
+        return self.__queue_output_command(id, OutputCommandQueue.STATUS, action_type, wait)
 
-    def set_output_dimmer(self, id, dimmer):
+    def set_output_dimmer(self, id, dimmer, wait=True):
         """ Set the dimmer of an output.
 
         :param id: The id of the output to set
         :type id: Integer [0, 240]
         :param dimmer: The dimmer value to set, None if unchanged
         :type dimmer: Integer [0, 100] or None
-        :returns: empty dict.
+        :param wait: Wait until the command is executed by the master.
+        :type wait: Boolean
+        :returns: empty dict if wait, :class`master.outputs.OutputCommandFuture` if not.
         """
         if id < 0 or id > 240:
             raise ValueError("id not in [0, 240]: %d" % id)
@@ -472,19 +535,18 @@ class GatewayApi(object):
         else:
             dimmer_action = master_api.__dict__['BA_LIGHT_ON_DIMMER_' + str(dimmer)]
 
-        self.__master_communicator.do_command(master_api.basic_action(),
-                    {"action_type" : dimmer_action, "action_number" : id})
-
-        return dict()
+        return self.__queue_output_command(id, OutputCommandQueue.DIMMER, dimmer_action, wait)
 
-    def set_output_timer(self, id, timer):
+    def set_output_timer(self, id, timer, wait=True):
         """ Set the timer of an output.
 
         :param id: The id of the output to set
         :type id: Integer [0, 240]
         :param timer: The timer value to set, None if unchanged
         :type timer: Integer in [150, 450, 900, 1500, 2220, 3120]
-        :returns: empty dict.
+        :param wait: Wait until the command is executed by the master.
+        :type wait: Boolean
+        :returns: empty dict if wait, :class`master.outputs.OutputCommandFuture` if not.
         """
         if id < 0 or id > 240:
             raise ValueError("id not in [0, 240]: %d" % id)
@@ -494,10 +556,7 @@ class GatewayApi(object):
 
         timer_action = master_api.__dict__['BA_LIGHT_ON_TIMER_'+str(timer)+'_OVERRULE']
 
-        self.__master_communicator.do_command(master_api.basic_action(),
-                    {"action_type" : timer_action, "action_number" : id})
-
-        return dict()
+        return self.__queue_output_command(id, OutputCommandQueue.TIMER, timer_action, wait)
 
     def set_all_lights_off(self):
         """ Turn all lights off.
@@ -505,7 +564,8 @@ class GatewayApi(object):
         :returns: empty dict.
         """
         self.__master_communicator.do_command(master_api.basic_action(),
-                    {"action_type" : master_api.BA_ALL_LIGHTS_OFF, "action_number" : 0})
+                    {"action_type" : master_api.BA_ALL_LIGHTS_OFF, "action_number" : 0},
+                    priority=MasterCommunicator.PRIORITY_HIGH)
 
         return dict()
 
@@ -515,7 +575,8 @@ class GatewayApi(object):
         :returns: empty dict.
         """
         self.__master_communicator.do_command(master_api.basic_action(),
-                    {"action_type" : master_api.BA_LIGHTS_OFF_FLOOR, "action_number" : floor})
+                    {"action_type" : master_api.BA_LIGHTS_OFF_FLOOR, "action_number" : floor},
+                    priority=MasterCommunicator.PRIORITY_HIGH)
 
         return dict()
 
@@ -525,7 +586,8 @@ class GatewayApi(object):
         :returns: empty dict.
         """
         self.__master_communicator.do_command(master_api.basic_action(),
-                    {"action_type" : master_api.BA_LIGHTS_ON_FLOOR, "action_number" : floor})
+                    {"action_type" : master_api.BA_LIGHTS_ON_FLOOR, "action_number" : floor},
+                    priority=MasterCommunicator.PRIORITY_HIGH)
 
         return dict()
 
@@ -548,42 +610,61 @@ class GatewayApi(object):
     ###### Thermostat functions
 
     def __get_all_thermostats(self):
-        """ Get basic information about all thermostats.
+        """ Get basic information about all thermostats. The information is read from the
+        ThermostatConfiguration in the eeprom (cache).
 
         :returns: array containing 24 dicts (one for each thermostats) with the following keys: \
         'active', 'sensor_nr', 'output0_nr', 'output1_nr', 'name'.
         """
         thermostats = []
-        for thermostat_id in range(0, 24):
-            thermostat = self.__master_communicator.do_command(master_api.read_setpoint(),
-                                                               {'thermostat' :  thermostat_id})
+        for thermostat in self.__eeprom_controller.read_all(ThermostatConfiguration,
+                                                            ['sensor', 'output0', 'output1',
+                                                             'name']):
             info = {}
-            info['active'] = (thermostat['sensor_nr'] < 30 or  thermostat['sensor_nr'] == 240) \
-                             and thermostat['output0_nr'] < 240
-            info['sensor_nr'] = thermostat['sensor_nr']
-            info['output0_nr'] = thermostat['output0_nr']
-            info['output1_nr'] = thermostat['output1_nr']
-            info['name'] = thermostat['name']
+            info['active'] = (thermostat.sensor < 30 or thermostat.sensor == 240) \
+                             and thermostat.output0 < 240
+            info['sensor_nr'] = thermostat.sensor
+            info['output0_nr'] = thermostat.output0
+            info['output1_nr'] = thermostat.output1
+            info['name'] = thermostat.name
 
             thermostats.append(info)
 
         return thermostats
 
-    def get_thermostat_status(self):
+    def __invalidate_thermostats(self):
+        """ Refresh the thermostat information on the next get_thermostat_status. """
+        if self.__thermostat_status != None:
+            self.__thermostat_status.force_refresh()
+
+    def __invalidate_setpoints(self):
+        """ The master writes the setpoints of the thermostats to the eeprom: the banks are read
+        again from the master when they are used. """
+        self.__eeprom_controller.invalidate_model(ThermostatConfiguration,
+                                                  ['setp%d' % i for i in range(6)])
+        self.__status_cache.invalidate('thermostats')
+        self.__invalidate_thermostats()
+
+    def get_thermostat_status(self, max_age=None):
         """ Get the status of the thermostats.
 
+        :param max_age: the maximum age of the status in seconds, None for the default.
         :returns: dict with global status information about the thermostats: 'thermostats_on',
         'automatic' and 'setpoint' and a list ('status') with status information for all
         thermostats, each element in the list is a dict with the following keys:
         'id', 'act', 'csetp', 'output0', 'output1', 'outside', 'mode', 'name', 'sensor_nr'.
+        'age' contains the age of the status in seconds.
         """
         if self.__thermostat_status == None:
-            self.__thermostat_status = ThermostatStatus(self.__get_all_thermostats(), 1800)
+            self.__thermostat_status = ThermostatStatus(self.__get_all_thermostats(), None)
         elif self.__thermostat_status.should_refresh():
             self.__thermostat_status.update(self.__get_all_thermostats())
         cached_thermostats = self.__thermostat_status.get_thermostats()
 
-        thermostat_info = self.__master_communicator.do_command(master_api.thermostat_list())
+        (thermostat_info, age) = self.__status_cache.get(
+                'thermostats',
+                lambda: self.__master_communicator.do_command(master_api.thermostat_list()),
+                max_age)
 
         mode = thermostat_info['mode']
 
@@ -620,7 +701,7 @@ class GatewayApi(object):
                 thermostats.append(thermostat)
 
         return {'thermostats_on' : thermostats_on, 'automatic' : automatic,
-                'setpoint' : setpoint, 'status' : thermostats}
+                'setpoint' : setpoint, 'status' : thermostats, 'age' : age}
 
     def __check_thermostat(self, thermostat):
         """ :raises ValueError if thermostat not in range [0, 24]. """
@@ -640,6 +721,7 @@ class GatewayApi(object):
 
         _ = self.__master_communicator.do_command(master_api.write_setpoint(),
             {'thermostat' : thermostat, 'config' : 0, 'temp' : master_api.Svt.temp(temperature)})
+        self.__invalidate_setpoints()
 
         return {'status': 'OK'}
 
@@ -675,51 +757,68 @@ class GatewayApi(object):
                 {'action_type' : master_api.__dict__['BA_ALL_SETPOINT_' + str(setpoint)],
                  'action_number' : 0}))
 
+        self.__invalidate_setpoints()
         return {'status': 'OK'}
 
     ###### Sensor status
 
-    def get_sensor_temperature_status(self):
+    def get_sensor_temperature_status(self, max_age=None):
         """ Get the current temperature of all sensors.
 
+        :param max_age: the maximum age of the status in seconds, None for the default.
         :returns: list with 32 temperatures, 1 for each sensor.
         """
-        output = []
-
-        list = self.__master_communicator.do_command(master_api.sensor_temperature_list())
-
-        for i in range(32):
-            output.append(list['tmp%d' % i].get_temperature())
-
-        return output
+        return self.get_status_with_age('sensor_temperature', max_age)[0]
 
-    def get_sensor_humidity_status(self):
+    def get_sensor_humidity_status(self, max_age=None):
         """ Get the current humidity of all sensors.
 
+        :param max_age: the maximum age of the status in seconds, None for the default.
         :returns: list with 32 bytes, 1 for each sensor.
         """
-        output = []
+        return self.get_status_with_age('sensor_humidity', max_age)[0]
 
-        list = self.__master_communicator.do_command(master_api.sensor_humidity_list())
-
-        for i in range(32):
-            output.append(list['hum%d' % i])
-
-        return output
-
-    def get_sensor_brightness_status(self):
+    def get_sensor_brightness_status(self, max_age=None):
         """ Get the current brightness of all sensors.
 
+        :param max_age: the maximum age of the status in seconds, None for the default.
         :returns: list with 32 bytes, 1 for each sensor.
         """
-        output = []
+        return self.get_status_with_age('sensor_brightness', max_age)[0]
 
-        list = self.__master_communicator.do_command(master_api.sensor_brightness_list())
+    def get_status_with_age(self, source, max_age=None):
+        """ Get a status from the status cache together with its age.
 
-        for i in range(32):
-            output.append(list['bri%d' % i])
+        :param source: 'sensor_temperature', 'sensor_humidity', 'sensor_brightness' or \
+        'pulse_counters'.
+        :param max_age: the maximum age of the status in seconds, None for the default.
+        :returns: tuple (the status, as returned by the get_*_status method of the source, the \
+        age of the status in seconds).
+        :raises: ValueError if the source is unknown.
+        """
+        readers = {'sensor_temperature' : self.__read_sensor_temperature,
+                   'sensor_humidity' : self.__read_sensor_humidity,
+                   'sensor_brightness' : self.__read_sensor_brightness,
+                   'pulse_counters' : self.__read_pulse_counters}
+        if source not in readers:
+            raise ValueError("Unknown status source %s" % source)
 
-        return output
+        return self.__status_cache.get(source, readers[source], max_age)
+
+    def __read_sensor_temperature(self):
+        """ Read the temperatures from the master. """
+        list = self.__master_communicator.do_command(master_api.sensor_temperature_list())
+        return [list['tmp%d' % i].get_temperature() for i in range(32)]
+
+    def __read_sensor_humidity(self):
+        """ Read the humidity from the master. """
+        list = self.__master_communicator.do_command(master_api.sensor_humidity_list())
+        return [list['hum%d' % i] for i in range(32)]
+
+    def __read_sensor_brightness(self):
+        """ Read the brightness from the master. """
+        list = self.__master_communicator.do_command(master_api.sensor_brightness_list())
+        return [list['bri%d' % i] for i in range(32)]
 
     ###### Group actions
 
@@ -735,47 +834,54 @@ class GatewayApi(object):
 
         self.__master_communicator.do_command(master_api.basic_action(),
                     {"action_type" : master_api.BA_GROUP_ACTION,
-                     "action_number" : group_action_id})
+                     "action_number" : group_action_id},
+                    priority=MasterCommunicator.PRIORITY_HIGH)
 
         return dict()
 
     ###### Backup and restore functions
 
     def get_master_backup(self):
-        """ Get a backup of the eeprom of the master.
+        """ Get a backup of the eeprom of the master. The banks are taken from the eeprom cache,
+        only the banks that are not cached and the thermostat setpoints are read from the master.
 
         :returns: String of bytes (size = 64kb).
         """
-        output = ""
-        for bank in range(0, 256):
-            output += self.__master_communicator.do_command(master_api.eeprom_list(),
-                {'bank' : bank})['data']
-        return output
+        (_, banks) = self.__eeprom_controller.get_backup()
+        return "".join([banks[bank] for bank in sorted(banks.keys())])
+
+    def get_master_backup_stream(self, start_bank=0):
+        """ Get a backup of the eeprom of the master, one bank at a time.
+
+        :param start_bank: the first bank of the backup, used to resume an interrupted backup.
+        :returns: generator that yields the bytes of the banks (256 bytes per bank).
+        """
+        for (_, data) in self.__eeprom_controller.iter_banks(start_bank):
+            yield data
+
+    def get_master_backup_incremental(self, since=None):
+        """ Get an incremental backup of the eeprom of the master.
+
+        :param since: the backup_id of a previous backup, None for a full backup.
+        :returns: dict with 'backup_id' key and 'banks' key: a dict that maps the bank number on \
+        the bytes in the bank. If since is a known backup id, only the banks that changed since \
+        that backup are included, else all banks are included.
+        """
+        (backup_id, banks) = self.__eeprom_controller.get_backup(since)
+        return {'backup_id' : backup_id, 'banks' : banks}
 
     def master_restore(self, data):
-        """ Restore a backup of the eeprom of the master.
+        """ Restore a backup of the eeprom of the master. Banks that did not change are skipped.
 
         :param data: The eeprom backup to restore.
         :type data: string of bytes (size = 64 kb).
         :returns: dict with 'output' key (contains an array with the addresses that were written).
         """
         ret = []
-        (num_banks, bank_size, write_size) = (256, 256, 10)
-
-        for bank in range(0, num_banks):
-            read = self.__master_communicator.do_command(master_api.eeprom_list(),
-                                                         {'bank' : bank})['data']
-            for addr in range(0, bank_size, write_size):
-                orig = read[addr:addr + write_size]
-                new = data[bank * bank_size + addr : bank * bank_size + addr + len(orig)]
-                if new != orig:
-                    ret.append("B" + str(bank) + "A" + str(addr))
-
-                    self.__master_communicator.do_command(master_api.write_eeprom(),
-                        {'bank': bank, 'address': addr, 'data': new})
-
-        self.__master_communicator.do_command(master_api.activate_eeprom(), {'eep' : 0})
+        for (bank, offset, _) in self.__eeprom_controller.restore(data):
+            ret.append("B" + str(bank) + "A" + str(offset))
         ret.append("Activated eeprom")
+        self.__invalidate_thermostats()
 
         return {'output' : ret}
 
@@ -809,6 +915,15 @@ class GatewayApi(object):
         """
         return self.__power_communicator.get_seconds_since_last_success()
 
+    def get_communication_statistics(self):
+        """ Get the statistics of the communication with the master and the power modules.
+
+        :returns: dict with 'master' and 'power' keys, both contain the statistics of the \
+        communicator: see :class`serial_utils.CommunicationStats`.
+        """
+        return {'master' : self.__master_communicator.get_communication_statistics(),
+                'power' : self.__power_communicator.get_communication_statistics()}
+
     def master_clear_error_list(self):
         """ Clear the number of errors.
 
@@ -833,11 +948,16 @@ class GatewayApi(object):
 
     ###### Pulse counter functions
 
-    def get_pulse_counter_status(self):
+    def get_pulse_counter_status(self, max_age=None):
         """ Get the pulse counter values.
 
+        :param max_age: the maximum age of the values in seconds, None for the default.
         :returns: array with the 8 pulse counter values.
         """
+        return self.get_status_with_age('pulse_counters', max_age)[0]
+
+    def __read_pulse_counters(self):
+        """ Read the pulse counters from the master. """
         out_dict = self.__master_communicator.do_command(master_api.pulse_list())
         return [out_dict['pv0'], out_dict['pv1'], out_dict['pv2'], out_dict['pv3'],
                 out_dict['pv4'], out_dict['pv5'], out_dict['pv6'], out_dict['pv7']]
@@ -1016,8 +1136,7 @@ class GatewayApi(object):
         'setp2' (Temp), 'setp3' (Temp), 'setp4' (Temp), 'setp5' (Temp)
         """
         self.__eeprom_controller.write(ThermostatConfiguration.from_dict(config))
-        if self.__thermostat_status != None:
-            self.__thermostat_status.force_refresh()
+        self.__invalidate_thermostats()
 
     def set_thermostat_configurations(self, config):
         """
@@ -1045,8 +1164,7 @@ class GatewayApi(object):
         """
         self.__eeprom_controller.write_batch(
                 [ThermostatConfiguration.from_dict(o) for o in config])
-        if self.__thermostat_status != None:
-            self.__thermostat_status.force_refresh()
+        self.__invalidate_thermostats()
 
     def get_sensor_configuration(self, id, fields=None):
         """
@@ -1377,57 +1495,84 @@ class GatewayApi(object):
 
         return dict()
 
-    def get_realtime_power(self):
-        """ Get the realtime power measurement values.
+    def get_realtime_power(self, max_age=None, timestamps=False):
+        """ Get the realtime power measurement values. The values are sampled in the background,
+        see :class`PowerSampler`.
 
+        :param max_age: the maximum age of the values in seconds, older values are sampled again \
+        by the background thread as soon as possible, the last values are returned right away. \
+        None to use the last sampled values.
+        :param timestamps: also return when the values of each module were sampled.
         :returns: dict with the module id as key and the following array as value: \
-        [voltage, frequency, current, power].
-        """
-        output = dict()
-
-        modules = self.__power_controller.get_power_modules()
-        for id in sorted(modules.keys()):
-            try:
-                addr = modules[id]['address']
-
-                volt = self.__power_communicator.do_command(addr, power_api.get_voltage())[0]
-                freq = self.__power_communicator.do_command(addr, power_api.get_frequency())[0]
-                current = self.__power_communicator.do_command(addr, power_api.get_current())
-                power = self.__power_communicator.do_command(addr, power_api.get_power())
+        [voltage, frequency, current, power]. For the modules that did not respond to the last \
+        sample, the last values that were read are returned (see get_stale_power_modules). If \
+        timestamps is True, a dict with 'power' (the dict above), 'timestamps' (module id as key, \
+        the time of the sample as value) and 'stale' (the ids of the modules that did not respond \
+        to the last sample) is returned.
+        """
+        (power, sample_times, stale) = self.__power_sampler.get_realtime_power(max_age)
+        if timestamps:
+            return {'power' : power, 'timestamps' : sample_times, 'stale' : stale}
+        else:
+            return power
 
-                out = []
-                for i in range(0, 8):
-                    out.append([convert_nan(volt), convert_nan(freq), convert_nan(current[i]),
-                                convert_nan(power[i])])
+    def get_stale_power_modules(self):
+        """ Get the power modules that did not respond to the last realtime power sample.
 
-                output[str(id)] = out
-            except Exception as exception:
-                LOGGER.exception("Got Exception for power module %s: %s", id, exception)
+        :returns: dict with 'stale': list of the ids of the modules.
+        """
+        return {'stale' : self.__power_sampler.get_stale()}
 
-        return output
+    def get_power_history(self, module_id, start, end=None, resolution=None):
+        """ Get the history of the power of the inputs of a power module.
 
-    def get_total_energy(self):
+        :param module_id: The id of the power module.
+        :param start: the start of the range (timestamp).
+        :param end: the end of the range (timestamp), None for now.
+        :param resolution: the resolution in seconds (1, 60, 900 or 86400), None to use the \
+        finest resolution that covers the range.
+        :returns: dict with 'resolution' and 'data': list of [timestamp, [power of the 8 inputs \
+        (W)], [energy of the 8 inputs (Wh)], [[day, night] increase of the energy counters of the \
+        8 inputs (Wh)]].
+        :raises: ValueError if the history is not enabled or the power module does not exist.
+        """
+        if self.__energy_store is None:
+            raise ValueError("The power history is not enabled")
+        if self.__power_controller.get_address(module_id) is None:
+            raise ValueError("Unknown power module %s" % module_id)
+        return self.__energy_store.get_history(module_id, start, end, resolution)
+
+    def get_total_energy(self, timestamps=False):
         """ Get the total energy (kWh) consumed by the power modules.
 
-        :returns: dict with the module id as key and the following array as value: [day, night].
+        :param timestamps: also return when the energy of each module was read.
+        :returns: dict with the module id as key and the following array as value: [day, night]. \
+        For the modules that did not respond, the last values that were read are returned (see \
+        get_power_module_health). If timestamps is True, a dict with 'energy' (the dict above), \
+        'timestamps' (module id as key, the time the values were read as value) and 'stale' (the \
+        ids of the modules that did not respond) is returned.
         """
-        output = dict()
-
-        modules = self.__power_controller.get_power_modules()
-        for id in sorted(modules.keys()):
-            try:
-                addr = modules[id]['address']
+        (energy, read_times, stale) = self.__power_sampler.read_total_energy()
+        if timestamps:
+            return {'energy' : energy, 'timestamps' : read_times, 'stale' : stale}
+        else:
+            return energy
 
-                day = self.__power_communicator.do_command(addr, power_api.get_day_energy())
-                night = self.__power_communicator.do_command(addr, power_api.get_night_energy())
+    def get_power_module_health(self):
+        """ Get the health of the power modules.
 
-                out = []
-                for i in range(0, 8):
-                    out.append([convert_nan(day[i]), convert_nan(night[i])])
+        :returns: dict with the module id as key and a dict with 'address', 'state' ('ok', \
+        'failing' or 'unavailable'), 'failures' (number of failed commands in a row), \
+        'last_success' (timestamp or None) and 'next_probe' (seconds until an unavailable module \
+        is contacted again) as value.
+        """
+        health = self.__power_communicator.get_module_health()
+        output = dict()
 
-                output[str(id)] = out
-            except Exception:
-                LOGGER.error("Got Exception for power module %s", id)
+        for (id, module) in self.__power_controller.get_power_modules().items():
+            state = health.get(module['address'], {'state' : 'ok', 'failures' : 0,
+                                                   'last_success' : None, 'next_probe' : 0})
+            output[str(id)] = dict(state, address="E" + str(module['address']))
 
         return output
 
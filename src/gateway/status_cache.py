@@ -0,0 +1,104 @@
+'''
+OpenMotics - Gateway
+Copyright (C) 2014 - OpenMotics <info@openmotics.com>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+'''
+The status_cache module contains the StatusCache, which keeps the last status that was read from
+the master for a number of sources.
+
+@author: fryckbos
+'''
+import time
+from threading import Lock, Event
+
+class StatusCache(object):
+    """ Cache for status that is read from the master (eg. the sensor values). Every source has a
+    time to live: a cached value is returned if it is younger than the ttl. If the value has to be
+    read, concurrent callers for the same source wait for one read instead of each reading the
+    value.
+    """
+
+    def __init__(self, ttls):
+        """ Create a StatusCache.
+
+        :param ttls: dict with the name of the source as key and the time to live in seconds as \
+        value.
+        """
+        self.__ttls = ttls
+        self.__values = {} # source -> (timestamp, value)
+        self.__reads = {} # source -> _Read
+        self.__lock = Lock()
+
+    def get(self, source, read, max_age=None):
+        """ Get the value of a source.
+
+        :param source: the name of the source.
+        :param read: function without arguments that reads the value from the master.
+        :param max_age: the maximum age of the value in seconds, None to use the ttl of the source.
+        :returns: tuple (value, age of the value in seconds).
+        :raises: the exception raised by read.
+        """
+        max_age = self.__ttls[source] if max_age is None else max_age
+
+        with self.__lock:
+            cached = self.__values.get(source)
+            if cached is not None and time.time() - cached[0] <= max_age:
+                return (cached[1], time.time() - cached[0])
+
+            current = self.__reads.get(source)
+            leader = current is None
+            if leader:
+                current = _Read()
+                self.__reads[source] = current
+
+        if leader:
+            try:
+                current.value = read()
+                current.timestamp = time.time()
+            except Exception as exception:
+                current.exception = exception
+            finally:
+                with self.__lock:
+                    if self.__reads.get(source) is current: # Not invalidated during the read
+                        if current.exception is None:
+                            self.__values[source] = (current.timestamp, current.value)
+                        del self.__reads[source]
+                current.done.set()
+        else:
+            current.done.wait()
+
+        if current.exception is not None:
+            raise current.exception
+        return (current.value, time.time() - current.timestamp)
+
+    def invalidate(self, source):
+        """ Remove the cached value of a source, the next get will read the value. A read that is
+        in progress is not cached. """
+        with self.__lock:
+            self.__values.pop(source, None)
+            self.__reads.pop(source, None)
+
+
+class _Read(object):
+    """ A read of a source that is in progress. """
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.timestamp = None
+        self.exception = None
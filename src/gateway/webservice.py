@@ -30,6 +30,7 @@ from types import MethodType
 import traceback
 import inspect
 import time
+import base64
 import requests
 
 from gateway.scheduling import SchedulingController
@@ -403,16 +404,20 @@ class WebInterface(object):
         return self.__success(inputs=self.__gateway_api.get_last_inputs())
 
     @cherrypy.expose
-    def get_thermostat_status(self, token):
+    def get_thermostat_status(self, token, max_age=None):
         """ Get the status of the thermostats.
 
+        :param max_age: the maximum age of the status in seconds (optional).
+        :type max_age: Float
         :returns: global status information about the thermostats: 'thermostats_on', \
         'automatic' and 'setpoint' and 'status': a list with status information for all \
         thermostats, each element in the list is a dict with the following keys: \
-        'id', 'act', 'csetp', 'output0', 'output1', 'outside', 'mode'.
+        'id', 'act', 'csetp', 'output0', 'output1', 'outside', 'mode'. 'age': the age of the \
+        status in seconds.
         """
         self.check_token(token)
-        return self.__wrap(self.__gateway_api.get_thermostat_status)
+        max_age = float(max_age) if max_age is not None else None
+        return self.__wrap(lambda: self.__gateway_api.get_thermostat_status(max_age))
 
     @cherrypy.expose
     def set_current_setpoint(self, token, thermostat, temperature):
@@ -447,31 +452,43 @@ class WebInterface(object):
                        boolean(thermostat_on), boolean(automatic), int(setpoint)))
 
     @cherrypy.expose
-    def get_sensor_temperature_status(self, token):
+    def get_sensor_temperature_status(self, token, max_age=None):
         """ Get the current temperature of all sensors.
 
-        :returns: 'status': list of 32 temperatures, 1 for each sensor.
+        :param max_age: the maximum age of the status in seconds (optional).
+        :type max_age: Float
+        :returns: 'status': list of 32 temperatures, 1 for each sensor, 'age': the age of the \
+        status in seconds.
         """
         self.check_token(token)
-        return self.__success(status=self.__gateway_api.get_sensor_temperature_status())
+        max_age = float(max_age) if max_age is not None else None
+        return self.__wrap_status('sensor_temperature', 'status', max_age)
 
     @cherrypy.expose
-    def get_sensor_humidity_status(self, token):
+    def get_sensor_humidity_status(self, token, max_age=None):
         """ Get the current humidity of all sensors.
 
-        :returns: 'status': List of 32 bytes, 1 for each sensor.
+        :param max_age: the maximum age of the status in seconds (optional).
+        :type max_age: Float
+        :returns: 'status': List of 32 bytes, 1 for each sensor, 'age': the age of the status in \
+        seconds.
         """
         self.check_token(token)
-        return self.__success(status=self.__gateway_api.get_sensor_humidity_status())
+        max_age = float(max_age) if max_age is not None else None
+        return self.__wrap_status('sensor_humidity', 'status', max_age)
 
     @cherrypy.expose
-    def get_sensor_brightness_status(self, token):
+    def get_sensor_brightness_status(self, token, max_age=None):
         """ Get the current brightness of all sensors.
 
-        :returns: 'status': List of 32 bytes, 1 for each sensor.
+        :param max_age: the maximum age of the status in seconds (optional).
+        :type max_age: Float
+        :returns: 'status': List of 32 bytes, 1 for each sensor, 'age': the age of the status in \
+        seconds.
         """
         self.check_token(token)
-        return self.__success(status=self.__gateway_api.get_sensor_brightness_status())
+        max_age = float(max_age) if max_age is not None else None
+        return self.__wrap_status('sensor_brightness', 'status', max_age)
 
     @cherrypy.expose
     def do_group_action(self, token, group_action_id):
@@ -505,6 +522,53 @@ class WebInterface(object):
         cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
         return self.__gateway_api.get_master_backup()
 
+    @cherrypy.expose
+    def get_master_backup_stream(self, token, start_bank=0):
+        """ Get a backup of the eeprom of the master, the banks are streamed to the client as they
+        are read (chunked transfer encoding). An interrupted download can be resumed by providing
+        the number of banks that were received as start_bank.
+
+        :param start_bank: the first bank to send (0 to 255).
+        :returns: This function does not return a dict, unlike all other API functions: it \
+        returns a string of bytes (256 bytes per bank). The X-Backup-Banks header contains the \
+        number of banks that will be sent.
+        """
+        self.check_token(token)
+        try:
+            start_bank = int(start_bank)
+        except ValueError:
+            start_bank = -1
+        if start_bank < 0 or start_bank > 255:
+            raise cherrypy.HTTPError(400, "start_bank should be between 0 and 255")
+
+        cherrypy.response.headers['Content-Type'] = 'application/octet-stream'
+        cherrypy.response.headers['X-Backup-Start-Bank'] = str(start_bank)
+        cherrypy.response.headers['X-Backup-Banks'] = str(256 - start_bank)
+        return self.__gateway_api.get_master_backup_stream(start_bank)
+
+    get_master_backup_stream._cp_config = {'response.stream' : True}
+
+    @cherrypy.expose
+    def get_master_backup_incremental(self, token, since=None):
+        """ Get an incremental backup of the eeprom of the master.
+
+        :param since: the backup_id of a previous backup, all banks are returned if this is not \
+        provided or unknown.
+        :returns: 'backup_id': the id of this backup (string) and 'banks': dict that maps the \
+        bank number on the base64 encoded bytes of the banks that changed since the previous \
+        backup.
+        """
+        self.check_token(token)
+
+        def get_backup():
+            """ Get the backup and encode the banks. """
+            ret = self.__gateway_api.get_master_backup_incremental(since)
+            ret['banks'] = dict([(str(bank), base64.b64encode(data))
+                                 for (bank, data) in ret['banks'].items()])
+            return ret
+
+        return self.__wrap(get_backup)
+
     @cherrypy.expose
     def master_restore(self, token, data):
         """ Restore a backup of the eeprom of the master.
@@ -517,6 +581,19 @@ class WebInterface(object):
         data = data.file.read()
         return self.__wrap(lambda: self.__gateway_api.master_restore(data))
 
+    @cherrypy.expose
+    def get_communication_statistics(self, token):
+        """ Get the statistics of the communication with the master and the power modules.
+
+        :returns: 'master' and 'power': dicts with 'actions' and 'modules' (latency histograms \
+        per action and per power module), 'failures' (timeouts and crc failures per action), \
+        'wait' (histogram of the time waited for the bus) and 'utilisation' (fraction of the bus \
+        capacity used in the last minute). A histogram contains count, mean, max, p50, p90, p99 \
+        (in seconds) and buckets: list of [upper bound, count].
+        """
+        self.check_token(token)
+        return self.__wrap(self.__gateway_api.get_communication_statistics)
+
     @cherrypy.expose
     def get_errors(self, token):
         """ Get the number of seconds since the last successul communication with the master and
@@ -1180,22 +1257,81 @@ class WebInterface(object):
         return self.__wrap(lambda: self.__gateway_api.set_power_modules(json.loads(modules)))
 
     @cherrypy.expose
-    def get_realtime_power(self, token):
-        """ Get the realtime power measurements.
+    def get_realtime_power(self, token, max_age=None, timestamps=None):
+        """ Get the realtime power measurements, these are the last measurements of the
+        background sampler.
 
-        :returns: module id as the keys: [voltage, frequency, current, power].
+        :param max_age: the maximum age of the measurements in seconds (optional), older \
+        measurements are sampled again as soon as possible.
+        :type max_age: Float
+        :param timestamps: 'true' to also get when the measurements were sampled (optional).
+        :type timestamps: Boolean
+        :returns: module id as the keys: [voltage, frequency, current, power]. If timestamps is \
+        true: 'power' (module id as the keys: [voltage, frequency, current, power]), 'timestamps' \
+        (module id as the keys: time of the sample) and 'stale' (ids of the modules that did not \
+        respond to the last sample).
         """
         self.check_token(token)
-        return self.__wrap(self.__gateway_api.get_realtime_power)
+        max_age = float(max_age) if max_age is not None else None
+        timestamps = boolean(timestamps) if timestamps is not None else False
+        return self.__wrap(lambda: self.__gateway_api.get_realtime_power(max_age, timestamps))
 
     @cherrypy.expose
-    def get_total_energy(self, token):
+    def get_stale_power_modules(self, token):
+        """ Get the power modules that did not respond to the last realtime power sample, their
+        realtime power measurements are the last measurements that were read.
+
+        :returns: 'stale': list of the ids of the modules.
+        """
+        self.check_token(token)
+        return self.__wrap(self.__gateway_api.get_stale_power_modules)
+
+    @cherrypy.expose
+    def get_power_history(self, token, module_id, start, end=None, resolution=None):
+        """ Get the history of the power measurements of a power module.
+
+        :param module_id: The id of the power module.
+        :type module_id: Integer
+        :param start: the start of the range (timestamp).
+        :type start: Integer
+        :param end: the end of the range (timestamp), by default now.
+        :type end: Integer
+        :param resolution: the resolution in seconds (1, 60, 900 or 86400), by default the \
+        finest resolution that covers the range.
+        :type resolution: Integer
+        :returns: 'resolution' and 'data': list of [timestamp, [power of the 8 inputs (W)], \
+        [energy of the 8 inputs (Wh)], [[day, night] increase of the energy counters of the 8 \
+        inputs (Wh)]].
+        """
+        self.check_token(token)
+        return self.__wrap(lambda: self.__gateway_api.get_power_history(
+                                        int(module_id), int(start),
+                                        int(end) if end is not None else None,
+                                        int(resolution) if resolution is not None else None))
+
+    @cherrypy.expose
+    def get_total_energy(self, token, timestamps=None):
         """ Get the total energy (Wh) consumed by the power modules.
 
-        :returns: modules id as key: [day, night].
+        :param timestamps: 'true' to also get when the energy of each module was read (optional).
+        :type timestamps: Boolean
+        :returns: modules id as key: [day, night]. If timestamps is true: 'energy' (modules id as \
+        key: [day, night]), 'timestamps' (modules id as key: time of the read) and 'stale' (ids \
+        of the modules that did not respond, their energy is the last energy that was read).
         """
         self.check_token(token)
-        return self.__wrap(self.__gateway_api.get_total_energy)
+        timestamps = boolean(timestamps) if timestamps is not None else False
+        return self.__wrap(lambda: self.__gateway_api.get_total_energy(timestamps))
+
+    @cherrypy.expose
+    def get_power_module_health(self, token):
+        """ Get the health of the power modules.
+
+        :returns: module id as key: dict with 'address', 'state' ('ok', 'failing' or \
+        'unavailable'), 'failures', 'last_success' and 'next_probe'.
+        """
+        self.check_token(token)
+        return self.__wrap(self.__gateway_api.get_power_module_health)
 
     @cherrypy.expose
     def start_power_address_mode(self, token):
@@ -1232,13 +1368,17 @@ class WebInterface(object):
                 lambda: self.__gateway_api.set_power_voltage(int(module_id), float(voltage)))
 
     @cherrypy.expose
-    def get_pulse_counter_status(self, token):
+    def get_pulse_counter_status(self, token, max_age=None):
         """ Get the pulse counter values.
 
-        :returns: 'counters': array with the 8 pulse counter values.
+        :param max_age: the maximum age of the values in seconds (optional).
+        :type max_age: Float
+        :returns: 'counters': array with the 8 pulse counter values, 'age': the age of the \
+        values in seconds.
         """
         self.check_token(token)
-        return self.__success(counters=self.__gateway_api.get_pulse_counter_status())
+        max_age = float(max_age) if max_age is not None else None
+        return self.__wrap_status('pulse_counters', 'counters', max_age)
 
     @cherrypy.expose
     def get_version(self, token):
@@ -1464,6 +1604,17 @@ class WebInterface(object):
         else:
             LOGGER.error("Could not find function WebInterface.%s", func_name)
 
+    def __wrap_status(self, source, key, max_age):
+        """ Get a status with its age from the gateway_api, see __wrap.
+
+        :returns: {'success': True, key: the status, 'age': the age of the status in seconds}
+        """
+        def get():
+            """ Put the status and the age in a dict. """
+            (status, age) = self.__gateway_api.get_status_with_age(source, max_age)
+            return {key : status, 'age' : age}
+        return self.__wrap(get)
+
     def __wrap(self, func):
         """ Wrap a gateway_api function and catches a possible Exception.
 
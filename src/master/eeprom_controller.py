@@ -24,10 +24,19 @@ Created on Sep 2, 2013
 
 @author: fryckbos
 '''
+import logging
+LOGGER = logging.getLogger("openmotics")
+
 import inspect
 import types
+import hashlib
+import sqlite3
+import time
+import zlib
+from threading import Lock, RLock
 
 from master_api import eeprom_list, read_eeprom, write_eeprom, activate_eeprom
+from master_communicator import MasterCommunicator
 
 
 class EepromController(object):
@@ -44,6 +53,55 @@ class EepromController(object):
         """ Invalidate the cache, this should happen when maintenance mode was used. """
         self.__eeprom_file.invalidate_cache()
 
+    def verify_cache(self):
+        """ Compare the banks of the persistent cache with the master, see
+        EepromFile.verify_cache. """
+        return self.__eeprom_file.verify_cache()
+
+    def invalidate_model(self, eeprom_model, fields=None):
+        """ Remove the banks that contain fields of an EepromModel (for all ids) from the cache,
+        this should happen when the master changes these fields.
+
+        :param eeprom_model: EepromModel class
+        :param fields: the fields of the model, None for all fields.
+        """
+        self.__eeprom_file.invalidate_banks(self.__get_banks(eeprom_model, fields))
+
+    def add_volatile_model(self, eeprom_model, fields=None):
+        """ Mark the banks that contain fields of an EepromModel (for all ids) as volatile: the
+        master can change these fields without the gateway knowing (eg. the thermostat setpoints),
+        backups read these banks from the master, see EepromFile.add_volatile_banks.
+
+        :param eeprom_model: EepromModel class
+        :param fields: the fields of the model, None for all fields.
+        """
+        self.__eeprom_file.add_volatile_banks(self.__get_banks(eeprom_model, fields))
+
+    def __get_banks(self, eeprom_model, fields):
+        """ Get the sorted list of banks that contain fields of an EepromModel (for all ids). """
+        ids = range(self.get_max_id(eeprom_model)) if eeprom_model.has_id() else [None]
+        banks = set()
+        for id in ids:
+            banks.update([address.bank for address in eeprom_model.get_addresses(id, fields)])
+        return sorted(banks)
+
+    def get_backup(self, since=None):
+        """ Get a (incremental) backup of the EepromFile, see EepromFile.get_backup. """
+        return self.__eeprom_file.get_backup(since)
+
+    def iter_banks(self, start=0):
+        """ Iterate over the banks of the EepromFile, see EepromFile.iter_banks. """
+        return self.__eeprom_file.iter_banks(start)
+
+    def restore(self, data):
+        """ Restore a backup of the EepromFile and activate it.
+
+        :returns: list of (bank, offset, length) tuples that were written.
+        """
+        written = self.__eeprom_file.restore(data)
+        self.__eeprom_file.activate()
+        return written
+
     def read(self, eeprom_model, id=None, fields=None):
         """ Create an instance of an EepromModel by reading it from the EepromFile. The id has to
         be specified if the model has an EepromId field.
@@ -54,9 +112,9 @@ class EepromController(object):
         eeprom_model.check_id(id)
 
         addresses = eeprom_model.get_addresses(id, fields)
-        eeprom_data = self.__eeprom_file.read(addresses)
+        bank_data = self.__eeprom_file.read_bank_data(addresses)
 
-        return eeprom_model.from_eeprom_data(eeprom_data, id, fields)
+        return eeprom_model.from_bank_data(bank_data, id, fields)
 
     def read_batch(self, eeprom_model, ids, fields=None):
         """ Create a list of instances of an EepromModel by reading it from the EepromFile.
@@ -71,17 +129,23 @@ class EepromController(object):
         for id in ids:
             addresses.extend(eeprom_model.get_addresses(id, fields))
 
-        eeprom_data = self.__eeprom_file.read(addresses)
+        bank_data = self.__eeprom_file.read_bank_data(addresses)
 
-        i = 0
-        out = []
+        return [eeprom_model.from_bank_data(bank_data, id, fields) for id in ids]
+
+    def plan_read_batch(self, eeprom_model, ids, fields=None):
+        """ Get the commands that read_batch would send to the master, for diagnostics.
 
+        :param eeprom_model: EepromModel class
+        :param id: list of integers
+        :returns: list of dicts with 'command' ('EL' or 'RE') and 'bank', 'RE' commands also \
+        contain 'addr' and 'num'.
+        """
+        addresses = []
         for id in ids:
-            length = len(eeprom_model.get_addresses(id, fields))
-            out.append(eeprom_model.from_eeprom_data(eeprom_data[i:i + length], id, fields))
-            i += length
+            addresses.extend(eeprom_model.get_addresses(id, fields))
 
-        return out
+        return self.__eeprom_file.plan_read(addresses)
 
     def read_all(self, eeprom_model, fields=None):
         """ Create a list of instance of an EepromModel by reading all ids of that model from the
@@ -140,19 +204,101 @@ class EepromFile(object):
     """ Reads from and writes to the Master EEPROM. """
 
     BATCH_SIZE = 10
+    NUM_BANKS = 256
+    MAX_BACKUPS = 16
 
-    def __init__(self, master_communicator):
+    def __init__(self, master_communicator, persistent_cache=None):
         """ Create an EepromFile.
 
         :param master_communicator: communicates with the master.
         :type master_communicator: instance of MasterCommunicator.
+        :param persistent_cache: keeps the banks across restarts, None to only cache in memory.
+        :type persistent_cache: instance of EepromBankCache.
         """
         self.__master_communicator = master_communicator
         self.__bank_cache = dict()
+        self.__unverified = set() # banks loaded from the persistent cache, not yet compared
+        self.__persistent_cache = persistent_cache
+        self.__persistent_cache_loaded = (persistent_cache is None)
+        self.__lock = RLock()
+        self.__planner = EepromReadPlanner()
+        self.__backup_hashes = dict()
+        self.__backup_ids = []
+        self.__volatile_banks = set()
 
     def invalidate_cache(self):
         """ Invalidate the cache, this should happen when maintenance mode was used. """
-        self.__bank_cache = dict()
+        with self.__lock:
+            self.__bank_cache = dict()
+            self.__unverified = set()
+            if self.__persistent_cache is not None:
+                self.__persistent_cache.clear()
+                self.__persistent_cache_loaded = True
+
+    def __load_persistent_cache(self):
+        """ Load the banks from the persistent cache, they are used right away. The master might
+        have changed while we were not running: verify_cache compares the loaded banks with the
+        master, until then backups read them from the master. """
+        with self.__lock:
+            if not self.__persistent_cache_loaded:
+                banks = self.__persistent_cache.load()
+                self.__bank_cache.update(banks)
+                self.__unverified = set(banks.keys())
+                self.__persistent_cache_loaded = True
+
+    def verify_cache(self):
+        """ Compare every bank that was loaded from the persistent cache with the master, using low
+        priority commands. The banks are read one at a time without holding the lock, so reads and
+        writes of the cache can go ahead. A bank that differs was changed while the gateway was not
+        running, it is replaced by the bank on the master.
+
+        :returns: list of the banks that differed.
+        """
+        if not self.__persistent_cache_loaded:
+            self.__load_persistent_cache()
+
+        with self.__lock:
+            banks = sorted(self.__unverified)
+
+        changed = []
+        for bank in banks:
+            data = self.__do_command('EL', eeprom_list(), {"bank" : bank},
+                                     MasterCommunicator.PRIORITY_LOW)['data']
+            with self.__lock:
+                # Reads, writes and invalidates in the meantime already verified the bank.
+                if bank not in self.__unverified:
+                    continue
+                self.__unverified.discard(bank)
+                if self.__bank_cache.get(bank) != data:
+                    self.__bank_cache[bank] = data
+                    if self.__persistent_cache is not None:
+                        self.__persistent_cache.store(bank, data)
+                    changed.append(bank)
+
+        if len(changed) > 0:
+            LOGGER.warning("Eeprom banks %s changed while the gateway was not running", changed)
+        return changed
+
+    def __get_refresh(self):
+        """ Get the banks that backups have to read from the master: the volatile banks and the
+        banks that are not verified yet. """
+        with self.__lock:
+            return self.__volatile_banks | self.__unverified
+
+    def get_cache_info(self):
+        """ Get information about the banks in the persistent cache.
+
+        :returns: list of dicts with 'bank', 'read_time', 'write_time', 'dirty' and 'verified', \
+        empty list if there is no persistent cache.
+        """
+        if self.__persistent_cache is None:
+            return []
+
+        info = self.__persistent_cache.get_bank_info()
+        for bank_info in info:
+            bank_info['verified'] = self.__persistent_cache_loaded and \
+                                    bank_info['bank'] not in self.__unverified
+        return info
 
     def activate(self):
         """ Activate a change in the Eeprom. The master will read the eeprom
@@ -167,88 +313,110 @@ class EepromFile(object):
         :type addresses: list of EepromAddress instances.
         :returns: a list of EepromData instances (in the same order as the provided addresses).
         """
-        ## Group the addresses per bank
-        per_bank = dict()
-        for addr in addresses:
-            if addr.bank not in per_bank:
-                per_bank[addr.bank] = []
-            per_bank[addr.bank].append(addr)
-
-        ## Read the bank data
-        bank_data = dict()
-        for bank in per_bank:
-            bank_data[bank] = self.__read_bank(bank, per_bank[bank])
+        bank_data = self.read_bank_data(addresses)
 
         ## Extract the required bytes from the bank data
         return [EepromData(a, bank_data[a.bank][a.offset : a.offset + a.length])
                 for a in addresses]
 
-    def __read_bank(self, bank, addresses):
-        """ Read a list of addresses from a bank, this returns a list of 256 bytes. Only the bytes
-        described in the addresses are valid, the other bytes might be dummies. The master_api
-        provides two function for reading from the eeprom: master_api.eeprom_list() and
-        master_api.read_eeprom(). The list reads a full bank (256 bytes), while the read can only
-        read 10 bytes at once. Due to communciation overhead the read function is about half the
-        speed (per byte) of the list function. Howver the list function is cached while the read
-        function is not. If more than 6 reads are required for 1 bank, the list function is used
-        to read the bank at once.
-
-        :param bank: the number of the bank
-        :type bank: Integer
-        :param addresses: the addresses in the bank to read
-        :type addresses: a list of EepromAddress instances
-        :returns: list of 256 bytes.
-        """
-        ## Mark the bytes that should be read
-        read_map = [False] * 256
-        for addr in addresses:
-            for i in range(addr.offset, addr.offset + addr.length):
-                read_map[i] = True
-
-        ## Find the start addresses of the reads
-        start_addresses = []
-        i = 0
-        while i < 256:
-            if read_map[i] is True:
-                if i > 256 - EepromFile.BATCH_SIZE:
-                    ## This is the last possible start address
-                    i = 256 - EepromFile.BATCH_SIZE
-                start_addresses.append(i)
-                i += EepromFile.BATCH_SIZE
+    def read_bank_data(self, addresses):
+        """ Read the banks that contain the addresses. The banks that are not in the cache are
+        read using the commands planned by the EepromReadPlanner.
+
+        :param addresses: the addresses to read.
+        :type addresses: list of EepromAddress instances.
+        :returns: dict that maps the bank number on the 256 bytes in the bank. Only the bytes \
+        described in the addresses are valid, the other bytes might be dummies.
+        """
+        with self.__lock:
+            commands = self.plan_read(addresses)
+            planned = set([command['bank'] for command in commands])
+            # Keep the cached banks: they can be invalidated while the other banks are read.
+            cached = dict([(addr.bank, self.__bank_cache[addr.bank]) for addr in addresses
+                           if addr.bank not in planned])
+
+        bank_data = dict()
+        for command in commands:
+            bank = command['bank']
+            if command['command'] == 'EL':
+                bank_data[bank] = self.__read_banks([bank])[bank]
             else:
-                i += 1
+                ## Fill the bytes with dummies and only read the required bytes from eeprom.
+                if bank not in bank_data:
+                    bank_data[bank] = ["\xff"] * 256
 
-        ## Read from the start addresses
-        if len(start_addresses) > 6:
-            ## Too many reads, better read the whole bank at once using eeprom_list.
-            return self.__read_banks([bank])[bank]
-        else:
-            ## Fill the bytes with dummies and only read the required bytes from eeprom.
-            bytes = ["\xff"] * 256
+                read = self.__do_command('RE', read_eeprom(),
+                        {"bank" : bank, "addr" : command['addr'], "num" : command['num']})
+                bank_data[bank][command['addr'] : command['addr'] + command['num']] = read["data"]
+
+        for bank in bank_data:
+            if isinstance(bank_data[bank], list):
+                bank_data[bank] = ''.join(bank_data[bank])
+
+        bank_data.update(cached)
+        return bank_data
+
+    def plan_read(self, addresses):
+        """ Get the commands that are required to read addresses from the Eeprom, the banks in
+        the cache don't require any commands.
+
+        :param addresses: the addresses to read.
+        :type addresses: list of EepromAddress instances.
+        :returns: list of dicts with 'command' ('EL' or 'RE') and 'bank', 'RE' commands also \
+        contain 'addr' and 'num'.
+        """
+        if not self.__persistent_cache_loaded:
+            self.__load_persistent_cache()
+
+        ## Group the addresses per bank
+        per_bank = dict()
+        for addr in addresses:
+            if addr.bank not in self.__bank_cache:
+                if addr.bank not in per_bank:
+                    per_bank[addr.bank] = []
+                per_bank[addr.bank].append(addr)
 
-            for addr in start_addresses:
-                read = self.__master_communicator.do_command(
-                    read_eeprom(), {"bank" : bank, "addr" : addr, "num" : EepromFile.BATCH_SIZE})
+        return self.__planner.plan(per_bank)
 
-                bytes[addr : addr + EepromFile.BATCH_SIZE] = read["data"]
+    def get_read_latencies(self):
+        """ Get the estimated latencies of the eeprom read commands.
 
-            return ''.join(bytes)
+        :returns: dict with the latency in seconds for 'RE' and 'EL'.
+        """
+        return self.__planner.get_latencies()
+
+    def __do_command(self, name, cmd, fields, priority=MasterCommunicator.PRIORITY_NORMAL):
+        """ Execute a read command on the master, the duration is reported to the planner. """
+        start = time.time()
+        output = self.__master_communicator.do_command(cmd, fields, priority=priority)
+        self.__planner.add_measurement(name, time.time() - start)
+        return output
 
-    def __read_banks(self, banks):
+    def __read_banks(self, banks, priority=MasterCommunicator.PRIORITY_NORMAL, refresh=()):
         """ Read a number of banks from the Eeprom.
 
         :param banks: a list of banks (integers).
+        :param priority: the priority of the master commands.
+        :param refresh: the banks that are read from the master, even if they are in the cache.
         :returns: a dict mapping the bank to the data.
         """
+        if not self.__persistent_cache_loaded:
+            self.__load_persistent_cache()
+
         ret = dict()
 
         for bank in banks:
-            if bank in self.__bank_cache:
-                data = self.__bank_cache[bank]
-            else:
-                output = self.__master_communicator.do_command(eeprom_list(), {"bank" : bank})
-                data = output['data']
-                self.__bank_cache[bank] = data
+            with self.__lock:
+                if bank in self.__bank_cache and bank not in refresh:
+                    data = self.__bank_cache[bank]
+                else:
+                    output = self.__do_command('EL', eeprom_list(), {"bank" : bank}, priority)
+                    data = output['data']
+                    previous = self.__bank_cache.get(bank)
+                    self.__unverified.discard(bank)
+                    self.__bank_cache[bank] = data
+                    if self.__persistent_cache is not None and previous != data:
+                        self.__persistent_cache.store(bank, data)
 
             ret[bank] = data
 
@@ -259,53 +427,200 @@ class EepromFile(object):
 
         :param data: the data to write.
         :type data: list of EepromData instances.
+        :returns: list of (bank, offset, length) tuples that were written.
+        """
+        with self.__lock:
+            # Read the data in the banks that we are trying to write
+            bank_data = self.__read_banks(set([d.address.bank for d in data]))
+            new_bank_data = dict([(bank, bytearray(bank_data[bank])) for bank in bank_data])
+
+            for data_piece in data:
+                self.__patch(new_bank_data, data_piece)
+
+            # Check what changed and write changes in batch
+            written = []
+            try:
+                for bank in sorted(bank_data.keys()):
+                    extents = EepromFile.get_write_extents(bytearray(bank_data[bank]),
+                                                           new_bank_data[bank])
+                    if len(extents) == 0:
+                        continue
+
+                    if self.__persistent_cache is not None:
+                        self.__persistent_cache.mark_dirty(bank)
+
+                    new = new_bank_data[bank]
+                    for (offset, length) in extents:
+                        self.__write(bank, offset, str(new[offset:offset + length]))
+                        written.append((bank, offset, length))
+
+                    new = str(new)
+                    self.__bank_cache[bank] = new
+                    self.__unverified.discard(bank)
+                    if self.__persistent_cache is not None:
+                        self.__persistent_cache.store(bank, new, written=True)
+            except Exception as exception:
+                ## The write failed at some point, we are not sure about the data in the cache,
+                ## so we invalidate it.
+                self.invalidate_cache()
+                raise exception
+
+            return written
+
+    def invalidate_banks(self, banks):
+        """ Remove banks from the cache, this should happen when the master changed the banks
+        (eg. the thermostat setpoints).
+
+        :param banks: list of banks (integers).
+        """
+        with self.__lock:
+            for bank in banks:
+                self.__bank_cache.pop(bank, None)
+                self.__unverified.discard(bank)
+            if self.__persistent_cache is not None:
+                self.__persistent_cache.remove(banks)
+
+    def add_volatile_banks(self, banks):
+        """ Mark banks as volatile: the master can change these banks without the gateway knowing
+        (eg. the thermostat setpoints). Backups always read the volatile banks from the master, the
+        other banks are taken from the cache.
+
+        :param banks: list of banks (integers).
+        """
+        with self.__lock:
+            self.__volatile_banks.update(banks)
+
+    def iter_banks(self, start=0):
+        """ Iterate over the banks of the Eeprom, starting at bank start. The banks are read one at
+        a time (from the cache if possible, volatile and unverified banks from the master), so only
+        one bank is kept in memory by the generator.
+
+        :param start: the first bank to return.
+        :returns: generator of tuples (bank number, bytes in the bank).
+        """
+        if start < 0 or start >= EepromFile.NUM_BANKS:
+            raise ValueError("Start bank should be between 0 and %d, got %d" %
+                             (EepromFile.NUM_BANKS - 1, start))
+
+        for bank in range(start, EepromFile.NUM_BANKS):
+            yield (bank, self.__read_banks([bank], MasterCommunicator.PRIORITY_LOW,
+                                           refresh=self.__get_refresh())[bank])
+
+    def get_backup(self, since=None):
+        """ Get a backup of the Eeprom, the banks are taken from the cache if possible, the volatile
+        banks and the banks that are not verified yet are read from the master. Every backup gets an
+        id that is derived from the hashes of the banks. The hashes are kept for the last
+        MAX_BACKUPS backups: if since is one of those ids, only the banks that changed since that
+        backup are returned.
+
+        :param since: the id of a previous backup, None to get all banks.
+        :returns: tuple (backup id, dict that maps the bank number on the bytes in the bank).
+        """
+        banks = self.__read_banks(range(EepromFile.NUM_BANKS), MasterCommunicator.PRIORITY_LOW,
+                                  refresh=self.__get_refresh())
+        hashes = [hashlib.md5(banks[bank]).hexdigest() for bank in range(EepromFile.NUM_BANKS)]
+        backup_id = hashlib.sha1("".join(hashes)).hexdigest()
+
+        previous = self.__get_backup_hashes(since) if since is not None else None
+        self.__store_backup_hashes(backup_id, hashes)
+
+        if previous is None:
+            return (backup_id, banks)
+        else:
+            return (backup_id, dict([(bank, banks[bank]) for bank in range(EepromFile.NUM_BANKS)
+                                     if hashes[bank] != previous[bank]]))
+
+    def __get_backup_hashes(self, backup_id):
+        """ Get the bank hashes for a backup id, None if the backup id is unknown. """
+        if self.__persistent_cache is not None:
+            return self.__persistent_cache.get_backup_hashes(backup_id)
+        else:
+            with self.__lock:
+                return self.__backup_hashes.get(backup_id)
+
+    def __store_backup_hashes(self, backup_id, hashes):
+        """ Store the bank hashes of a backup, only the last MAX_BACKUPS backups are kept. """
+        if self.__persistent_cache is not None:
+            self.__persistent_cache.store_backup_hashes(backup_id, hashes, EepromFile.MAX_BACKUPS)
+        else:
+            with self.__lock:
+                if backup_id in self.__backup_ids:
+                    self.__backup_ids.remove(backup_id)
+                self.__backup_ids.append(backup_id)
+                self.__backup_hashes[backup_id] = hashes
+
+                while len(self.__backup_ids) > EepromFile.MAX_BACKUPS:
+                    del self.__backup_hashes[self.__backup_ids.pop(0)]
+
+    def restore(self, data):
+        """ Restore a backup of the Eeprom. Every bank is read from the master and compared with the
+        backup: a bank is only skipped if it is equal on the master, not just in the cache. Only the
+        changed bytes in the other banks are written.
+
+        :param data: The eeprom backup to restore.
+        :type data: string of bytes (size = 64 kb).
+        :returns: list of (bank, offset, length) tuples that were written.
         """
-        # Read the data in the banks that we are trying to write
-        bank_data = self.__read_banks(set([d.address.bank for d in data]))
-        new_bank_data = bank_data.copy()
-
-        for data_piece in data:
-            self.__patch(new_bank_data, data_piece)
-
-        # Check what changed and write changes in batch
-        try:
-            for bank in bank_data.keys():
-                old = bank_data[bank]
-                new = new_bank_data[bank]
-    
-                i = 0
-                while i < len(bank_data[bank]):
-                    if old[i] != new[i]:
-                        length = 1
-                        j = 1
-                        while j < EepromFile.BATCH_SIZE:
-                            if old[i + j] != new[i + j]:
-                                length = j + 1
-                            j += 1
-    
-                        self.__write(bank, i, new[i:i + length])
-                        i += EepromFile.BATCH_SIZE
-                    else:
-                        i += 1
-    
-                self.__bank_cache[bank] = new
-        except Exception as exception:
-            ## The write failed at some point, we are not sure about the data in the cache,
-            ## so we invalidate it.
-            self.invalidate_cache()
-            raise exception
+        size = EepromFile.NUM_BANKS * 256
+        if len(data) != size:
+            raise ValueError("The backup should be %d bytes, got %d bytes" % (size, len(data)))
+
+        with self.__lock:
+            all_banks = range(EepromFile.NUM_BANKS)
+            banks = self.__read_banks(all_banks, MasterCommunicator.PRIORITY_LOW,
+                                      refresh=set(all_banks))
+
+            pieces = []
+            for bank in range(EepromFile.NUM_BANKS):
+                new = data[bank * 256:(bank + 1) * 256]
+                if new != banks[bank]:
+                    pieces.append(EepromData(EepromAddress(bank, 0, 256), new))
+
+            return self.write(pieces)
+
+    @staticmethod
+    def get_write_extents(old, new):
+        """ Compare the old and the new bytes of a bank and get the extents that have to be
+        written. An extent starts at a changed byte and ends at the last changed byte within
+        BATCH_SIZE bytes. Blocks of unchanged bytes are skipped using slice comparisons.
+
+        :param old: the bytes in the bank.
+        :type old: bytearray
+        :param new: the new bytes for the bank, same length as old.
+        :type new: bytearray
+        :returns: list of (offset, length) tuples.
+        """
+        (size, block) = (EepromFile.BATCH_SIZE, 32)
+        extents = []
+
+        (i, end) = (0, len(old))
+        while i < end:
+            if old[i:i + block] == new[i:i + block]:
+                i += block
+                continue
+
+            while old[i] == new[i]:
+                i += 1
+
+            last = i
+            for j in range(i + 1, min(i + size, end)):
+                if old[j] != new[j]:
+                    last = j
+
+            extents.append((i, last - i + 1))
+            i += size
+
+        return extents
 
     def __patch(self, bank_data, eeprom_data):
-        """ Patch a byte array with a eeprom_data.
+        """ Patch the bytes of a bank in place with a eeprom_data.
 
-        :param bank_data: dict with bank data, key = bank, data = bytes in the bank.
+        :param bank_data: dict with bank data, key = bank, data = bytearray of the bank.
         :param eeprom_data: instance of EepromData.
         """
         address = eeprom_data.address
-        data = bank_data[address.bank]
-        bank_data[address.bank] = data[0:address.offset] \
-                                  + eeprom_data.bytes \
-                                  + data[address.offset + address.length:]
+        memoryview(bank_data[address.bank])[address.offset:address.offset + address.length] = \
+            eeprom_data.bytes
 
     def __write(self, bank, offset, to_write):
         """ Write a byte array to a specific location defined by the bank and the offset. """
@@ -313,6 +628,216 @@ class EepromFile(object):
                 write_eeprom(), {"bank" : bank, "address": offset, "data": to_write})
 
 
+class EepromReadPlanner(object):
+    """ Plans the commands to read addresses from the Eeprom. The master_api provides two functions
+    for reading from the eeprom: master_api.eeprom_list() (EL) and master_api.read_eeprom() (RE).
+    The list reads a full bank (256 bytes), while the read can only read 10 bytes at once. The
+    planner keeps an estimate of the latency of both commands, these are updated with the measured
+    durations. For every bank the addresses are merged into ranges, the ranges are covered with as
+    few reads as possible: if the reads take longer than a list, the bank is listed. A listed bank
+    is cached, so the list is preferred if both take the same time. The commands for the different
+    banks don't influence each other, so planning per bank gives the cheapest plan for all banks.
+    """
+
+    READ_SIZE = 10
+
+    def __init__(self, read_latency=0.02, list_latency=0.13, weight=0.1):
+        """ Create an EepromReadPlanner.
+
+        :param read_latency: the initial estimate for the latency of a read (in sec).
+        :param list_latency: the initial estimate for the latency of a list (in sec).
+        :param weight: the weight of a new measurement in the estimate.
+        """
+        self.__latencies = {'RE' : read_latency, 'EL' : list_latency}
+        self.__weight = weight
+
+    def get_latencies(self):
+        """ Get the estimated latencies, dict with 'RE' and 'EL'. """
+        return dict(self.__latencies)
+
+    def add_measurement(self, command, duration):
+        """ Update the latency estimate of a command ('RE' or 'EL') with a measured duration. """
+        self.__latencies[command] = \
+            (1 - self.__weight) * self.__latencies[command] + self.__weight * duration
+
+    @staticmethod
+    def merge_ranges(addresses):
+        """ Merge the overlapping and adjacent addresses in a bank.
+
+        :param addresses: list of EepromAddress instances in the same bank.
+        :returns: sorted list of [start, end) ranges.
+        """
+        ranges = []
+        for (start, end) in sorted([(a.offset, a.offset + a.length) for a in addresses]):
+            if len(ranges) > 0 and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+        return ranges
+
+    @staticmethod
+    def get_reads(ranges):
+        """ Get the reads that cover a list of ranges.
+
+        :param ranges: sorted list of [start, end) ranges.
+        :returns: list of (addr, num) tuples.
+        """
+        size = EepromReadPlanner.READ_SIZE
+        reads = []
+        for (start, end) in ranges:
+            if len(reads) > 0 and start < reads[-1][0] + size:
+                ## The start of the range is covered by the previous read
+                (addr, num) = reads[-1]
+                reads[-1] = (addr, max(num, min(size, end - addr)))
+                start = addr + size
+
+            while start < end:
+                addr = min(start, 256 - size) # The last possible start address is 256 - size
+                reads.append((addr, min(size, end - addr)))
+                start = addr + size
+
+        return reads
+
+    def plan(self, per_bank):
+        """ Plan the commands to read the addresses.
+
+        :param per_bank: dict that maps the bank on a list of EepromAddress instances.
+        :returns: list of dicts with 'command' ('EL' or 'RE') and 'bank', 'RE' commands also \
+        contain 'addr' and 'num'.
+        """
+        commands = []
+        for bank in sorted(per_bank.keys()):
+            reads = EepromReadPlanner.get_reads(EepromReadPlanner.merge_ranges(per_bank[bank]))
+
+            if len(reads) * self.__latencies['RE'] >= self.__latencies['EL']:
+                commands.append({'command' : 'EL', 'bank' : bank})
+            else:
+                commands.extend([{'command' : 'RE', 'bank' : bank, 'addr' : addr, 'num' : num}
+                                 for (addr, num) in reads])
+        return commands
+
+
+class EepromBankCache(object):
+    """ Keeps the banks of the master eeprom in a sqlite database, so the banks don't have to be
+    read from the master again after a restart. Every bank has a checksum, the time it was read
+    from the master and the time it was last written by the gateway. A bank is marked dirty while
+    it is being written: if the gateway stops during a write, the bank is not loaded anymore.
+    """
+
+    def __init__(self, db_filename):
+        """ Create an EepromBankCache.
+
+        :param db_filename: filename of the sqlite database.
+        """
+        self.__connection = sqlite3.connect(db_filename, check_same_thread=False,
+                                            isolation_level=None)
+        self.__cursor = self.__connection.cursor()
+        self.__lock = Lock()
+        self.__create_tables()
+
+    def __create_tables(self):
+        """ Create the bank and backup tables if they don't exist. """
+        self.__cursor.execute("CREATE TABLE IF NOT EXISTS banks (bank INTEGER PRIMARY KEY, "
+                              "data BLOB, checksum INTEGER, read_time REAL, write_time REAL, "
+                              "dirty INTEGER default 0);")
+        self.__cursor.execute("CREATE TABLE IF NOT EXISTS backups (id TEXT PRIMARY KEY, "
+                              "time REAL, hashes TEXT);")
+
+    @staticmethod
+    def __checksum(data):
+        """ Calculate the checksum for the data of a bank. """
+        return zlib.crc32(data) & 0xffffffff
+
+    def load(self):
+        """ Load the banks from the database. Banks that are dirty or have an invalid checksum
+        are removed.
+
+        :returns: dict that maps the bank number on the data (string of 256 bytes).
+        """
+        banks = {}
+        invalid = []
+        with self.__lock:
+            for row in self.__cursor.execute("SELECT bank, data, checksum, dirty FROM banks;"):
+                data = str(row[1])
+                if row[3] == 0 and len(data) == 256 and self.__checksum(data) == row[2]:
+                    banks[row[0]] = data
+                else:
+                    invalid.append(row[0])
+
+            for bank in invalid:
+                self.__cursor.execute("DELETE FROM banks WHERE bank=?;", (bank,))
+
+        return banks
+
+    def store(self, bank, data, written=False):
+        """ Store the data of a bank, this clears the dirty flag.
+
+        :param bank: the number of the bank.
+        :param data: string of 256 bytes.
+        :param written: whether the gateway wrote the data, sets the write_time for the bank.
+        """
+        now = time.time()
+        with self.__lock:
+            self.__cursor.execute("INSERT OR REPLACE INTO banks (bank, data, checksum, read_time, "
+                                  "write_time, dirty) VALUES (?, ?, ?, "
+                                  "COALESCE((SELECT read_time FROM banks WHERE bank=? AND ?), ?), "
+                                  "COALESCE(?, (SELECT write_time FROM banks WHERE bank=?)), 0);",
+                                  (bank, sqlite3.Binary(data), self.__checksum(data),
+                                   bank, written, now, now if written else None, bank))
+
+    def remove(self, banks):
+        """ Remove a number of banks. """
+        with self.__lock:
+            for bank in banks:
+                self.__cursor.execute("DELETE FROM banks WHERE bank=?;", (bank,))
+
+    def mark_dirty(self, bank):
+        """ Mark a bank as dirty, this should be called before writing to the bank. """
+        with self.__lock:
+            self.__cursor.execute("UPDATE banks SET dirty=1 WHERE bank=?;", (bank,))
+
+    def clear(self):
+        """ Remove all banks. """
+        with self.__lock:
+            self.__cursor.execute("DELETE FROM banks;")
+
+    def store_backup_hashes(self, backup_id, hashes, max_backups):
+        """ Store the bank hashes of a backup.
+
+        :param backup_id: the id of the backup.
+        :param hashes: list with the hash (string) for every bank.
+        :param max_backups: the number of backups to keep, the oldest backups are removed.
+        """
+        with self.__lock:
+            self.__cursor.execute("INSERT OR REPLACE INTO backups (id, time, hashes) "
+                                  "VALUES (?, ?, ?);", (backup_id, time.time(), ",".join(hashes)))
+            self.__cursor.execute("DELETE FROM backups WHERE id NOT IN "
+                                  "(SELECT id FROM backups ORDER BY rowid DESC LIMIT ?);",
+                                  (max_backups,))
+
+    def get_backup_hashes(self, backup_id):
+        """ Get the bank hashes of a backup.
+
+        :returns: list with the hash for every bank, None if the backup is unknown.
+        """
+        with self.__lock:
+            for row in self.__cursor.execute("SELECT hashes FROM backups WHERE id=?;",
+                                             (backup_id,)):
+                return str(row[0]).split(",")
+        return None
+
+    def get_bank_info(self):
+        """ Get the read and write times and the dirty flag for the stored banks.
+
+        :returns: list of dicts with 'bank', 'read_time', 'write_time' and 'dirty'.
+        """
+        with self.__lock:
+            return [{'bank' : row[0], 'read_time' : row[1], 'write_time' : row[2],
+                     'dirty' : row[3] == 1}
+                    for row in self.__cursor.execute("SELECT bank, read_time, write_time, dirty "
+                                                     "FROM banks ORDER BY bank;")]
+
+
 class EepromAddress(object):
     """ Represents an address in the Eeprom, has a bank, an offset and a length. """
 
@@ -361,6 +886,8 @@ class EepromModel(object):
     class of EepromModel with an optional EepromId and EepromDataTypes as class fields.
     """
 
+    __layouts = {} # EepromModel class -> EepromModelLayout
+
     def __init__(self, **kwargs):
         """ The arguments to the constructor are defined by the EepromDataType class fields. """
         fields = [x[0] for x in self.__class__.get_fields(include_id=True)]
@@ -375,38 +902,39 @@ class EepromModel(object):
         if id_field_name != None and id_field_name not in kwargs:
             raise TypeError("The id was missing for %s" % self.__class__.__name__)
 
+    @classmethod
+    def get_layout(cls):
+        """ Get the EepromModelLayout of the EepromModel, the layout is created on first use. """
+        layout = EepromModel.__layouts.get(cls)
+        if layout is None:
+            layout = EepromModelLayout(cls)
+            EepromModel.__layouts[cls] = layout
+        return layout
+
     @classmethod
     def get_fields(cls, include_id=False):
         """ Get the fields defined by an EepromModel child. """
-        return inspect.getmembers(cls,
-                                  lambda x: isinstance(x, EepromDataType) or
-                                            isinstance(x, CompositeDataType) or
-                                            (include_id and isinstance(x, EepromId)))
+        return list(cls.get_layout().get_fields(include_id))
 
     @classmethod
     def get_field_dict(cls, include_id=False):
         """ Get a dict from the field name to the field type for each field defined by the
         EepromModel child.
         """
-        class_field_dict = {}
-        for (name, type) in cls.get_fields(include_id):
-            class_field_dict[name] = type
-
-        return class_field_dict
+        return dict(cls.get_layout().get_fields(include_id))
 
     @classmethod
     def get_id_field(cls):
         """ Get the name of the EepromId field. None if not included. """
         if cls.has_id():
-            ids = inspect.getmembers(cls, lambda x: isinstance(x, EepromId))
-            return ids[0][0]
+            return cls.get_layout().id_fields[0][0]
         else:
             return None
 
     @classmethod
     def has_id(cls):
         """ Check if the EepromModel has an id. """
-        ids = inspect.getmembers(cls, lambda x: isinstance(x, EepromId))
+        ids = cls.get_layout().id_fields
         if len(ids) == 0:
             return False
         elif len(ids) == 1:
@@ -429,8 +957,7 @@ class EepromModel(object):
         elif id is not None and not has_id:
             raise TypeError("%s doesn't have an id, but id was given." % cls.__name__)
         elif id is not None:
-            id_type = inspect.getmembers(cls, lambda x: isinstance(x, EepromId))
-            max_id = id_type[0][1].get_max_id()
+            max_id = cls.get_layout().id_fields[0][1].get_max_id()
 
             if id > max_id:
                 raise TypeError("The maximum id for %s is %d, %d was provided." %
@@ -480,30 +1007,31 @@ class EepromModel(object):
             data_dict[d.address] = d
 
         field_dict = dict()
+        for (field_name, is_composite, parts) in cls.get_layout().get_entry(id, fields)[1]:
+            values = [field_type.from_bytes(data_dict[address].bytes)
+                      for (field_type, address) in parts]
+            field_dict[field_name] = values if is_composite else values[0]
 
-        if fields == None:
-            # Add data for all fields.
-            for (field_name, field_type) in cls.get_fields():
-                if isinstance(field_type, CompositeDataType):
-                    field_dict[field_name] = field_type.from_data_dict(data_dict, id)
-                else:
-                    address = field_type.get_address(id)
-                    bytes = data_dict[address].bytes
-                    field_dict[field_name] = field_type.from_bytes(bytes)
-        else:
-            # Add data for given fields only.
-            class_field_dict = cls.get_field_dict()
-            for field_name in fields:
-                if field_name not in class_field_dict:
-                    raise TypeError("Field %s is unknown for %s" % (field_name, cls.__name__))
-                else:
-                    field_type = class_field_dict[field_name]
-                    if isinstance(field_type, CompositeDataType):
-                        field_dict[field_name] = field_type.from_data_dict(data_dict, id)
-                    else:
-                        address = field_type.get_address(id)
-                        bytes = data_dict[address].bytes
-                        field_dict[field_name] = field_type.from_bytes(bytes)
+        if id is not None:
+            field_dict[cls.get_id_field()] = id
+
+        return cls(**field_dict)
+
+    @classmethod
+    def from_bank_data(cls, bank_data, id=None, fields=None):
+        """ Create an EepromModel by slicing the bytes of the fields from the bank data.
+
+        :param bank_data: dict that maps the bank number on the bytes in the bank (as returned \
+        by EepromFile.read_bank_data).
+        """
+        cls.check_id(id)
+
+        field_dict = dict()
+        for (field_name, is_composite, parts) in cls.get_layout().get_entry(id, fields)[1]:
+            values = [field_type.from_bytes(
+                            bank_data[address.bank][address.offset:address.offset + address.length])
+                      for (field_type, address) in parts]
+            field_dict[field_name] = values if is_composite else values[0]
 
         if id is not None:
             field_dict[cls.get_id_field()] = id
@@ -514,31 +1042,69 @@ class EepromModel(object):
     def get_addresses(cls, id=None, fields=None):
         """ Get the addresses used by this EepromModel. """
         cls.check_id(id)
-        addresses = []
+        return list(cls.get_layout().get_entry(id, fields)[0])
 
-        if fields == None:
-            # Add addresses for all fields.
-            for (_, field_type) in cls.get_fields():
-                if isinstance(field_type, CompositeDataType):
-                    addresses.extend(field_type.get_addresses(id))
-                else:
-                    addresses.append(field_type.get_address(id))
 
-        else:
-            # Add addresses for given fields only.
-            class_field_dict = cls.get_field_dict()
+class EepromModelLayout(object):
+    """ The layout of an EepromModel: the fields of the model and the addresses of the fields for
+    each id. The addresses are calculated using the address generators of the fields, the layout
+    caches the addresses per id and per list of fields so the generators are only called once.
+    """
 
-            for field in fields:
-                if field not in class_field_dict:
-                    raise TypeError("Field %s is unknown for %s" % (field, cls.__name__))
+    def __init__(self, model):
+        """ Create the layout for an EepromModel class. """
+        self.__model = model
+        self.id_fields = inspect.getmembers(model, lambda x: isinstance(x, EepromId))
+        self.__fields = inspect.getmembers(model,
+                                           lambda x: isinstance(x, EepromDataType) or
+                                                     isinstance(x, CompositeDataType))
+        self.__fields_with_id = inspect.getmembers(model,
+                                                   lambda x: isinstance(x, EepromDataType) or
+                                                             isinstance(x, CompositeDataType) or
+                                                             isinstance(x, EepromId))
+        self.__entries = {}
+
+    def get_fields(self, include_id=False):
+        """ Get the list of (name, type) tuples for the fields, sorted by name. """
+        return self.__fields_with_id if include_id else self.__fields
+
+    def get_entry(self, id, fields=None):
+        """ Get the addresses and the decode information for an id and a list of fields.
+
+        :param id: the id of the model, None if the model has no id.
+        :param fields: the names of the fields, None for all fields.
+        :returns: tuple (list of EepromAddresses, list of (field name, is composite, list of \
+        (EepromDataType, EepromAddress))).
+        """
+        key = (id, None if fields is None else tuple(fields))
+        entry = self.__entries.get(key)
+        if entry is None:
+            entry = self.__compile(id, fields)
+            self.__entries[key] = entry
+        return entry
+
+    def __compile(self, id, fields):
+        """ Calculate the addresses for an id and a list of fields. The address generators are
+        only called for all fields, the entry for a list of fields is taken from that entry. """
+        if fields is None:
+            decode = []
+            for (field_name, field_type) in self.__fields:
+                if isinstance(field_type, CompositeDataType):
+                    parts = [(t, t.get_address(id)) for t in field_type.get_data_types()]
+                    decode.append((field_name, True, parts))
                 else:
-                    field_type = class_field_dict[field]
-                    if isinstance(field_type, CompositeDataType):
-                        addresses.extend(field_type.get_addresses(id))
-                    else:
-                        addresses.append(field_type.get_address(id))
+                    decode.append((field_name, False, [(field_type, field_type.get_address(id))]))
+        else:
+            all_fields = dict([(d[0], d) for d in self.get_entry(id)[1]])
+            decode = []
+            for field_name in fields:
+                if field_name not in all_fields:
+                    raise TypeError("Field %s is unknown for %s" %
+                                    (field_name, self.__model.__name__))
+                decode.append(all_fields[field_name])
 
-        return addresses
+        addresses = [address for (_, _, parts) in decode for (_, address) in parts]
+        return (addresses, decode)
 
 
 class EepromId(object):
@@ -593,6 +1159,10 @@ class CompositeDataType(object):
         """ Get all EepromDataType addresses in the composite data type. """
         return [t[1].get_address(id) for t in self.__eeprom_data_types]
 
+    def get_data_types(self):
+        """ Get the EepromDataTypes in the composite data type. """
+        return [t[1] for t in self.__eeprom_data_types]
+
     def get_name(self):
         """ Get the name of the EepromDataType. To be implemented in the subclass. """
         return "[%s]" % (",".join(["%s(%s)" % (t[0], t[1].get_name())
@@ -25,6 +25,8 @@ Created on Sep 9, 2012
 
 @author: fryckbos
 '''
+import functools
+
 from master_command import MasterCommandSpec, Field, OutputFieldType, DimmerFieldType, \
                            ErrorListFieldType
 
@@ -87,18 +89,33 @@ BA_LIGHT_ON_TIMER_3120_NO_OVERRULE = 206
 
 BA_STATUS_LEDS = 64
 
+def spec(function):
+    """ Decorator for the functions below: the MasterCommandSpec is created once, when this module
+    is loaded, every call returns the same instance. """
+    instance = function()
+
+    @functools.wraps(function)
+    def get_spec():
+        """ Get the shared instance. """
+        return instance
+
+    return get_spec
+
+@spec
 def basic_action():
     """ Basic actions. """
     return MasterCommandSpec("BA",
         [Field.byte("action_type"), Field.byte("action_number"), Field.padding(11)],
         [Field.str("resp", 2), Field.padding(11), Field.lit("\r\n")])
 
+@spec
 def reset():
     """ Reset the gateway, used for firmware updates. """
     return MasterCommandSpec("re",
         [Field.padding(13)],
         [Field.str("resp", 2), Field.padding(11), Field.lit("\r\n")])
 
+@spec
 def status():
     """ Get the status of the master. """
     return MasterCommandSpec("ST",
@@ -108,6 +125,7 @@ def status():
          Field.byte('mode'), Field.byte('f1'), Field.byte('f2'), Field.byte('f3'),
          Field.byte('h'), Field.lit('\r\n')])
 
+@spec
 def set_time():
     """ Set the time on the master. """
     return MasterCommandSpec("st",
@@ -117,36 +135,42 @@ def set_time():
          Field.byte('day'), Field.byte('month'), Field.byte('year'), Field.padding(6),
          Field.lit("\r\n")])
 
+@spec
 def eeprom_list():
     """ List all bytes from a certain eeprom bank """
     return MasterCommandSpec("EL",
         [Field.byte("bank"), Field.padding(12)],
         [Field.byte("bank"), Field.str("data", 256), Field.lit("\r\n")])
 
+@spec
 def read_eeprom():
     """ Read a number (1-10) of bytes from a certain eeprom bank and address. """
     return MasterCommandSpec("RE",
         [Field.byte('bank'), Field.byte('addr'), Field.byte('num'), Field.padding(10)],
         [Field.byte('bank'), Field.byte('addr'), Field.varstr('data', 10), Field.lit('\r\n')])
 
+@spec
 def write_eeprom():
     """ Write data bytes to the addr in the specified eeprom bank """
     return MasterCommandSpec("WE",
         [Field.byte("bank"), Field.byte("address"), Field.varstr("data", 10)],
         [Field.byte("bank"), Field.byte("address"), Field.varstr("data", 10), Field.lit('\r\n')])
 
+@spec
 def activate_eeprom():
     """ Activate eeprom after write """
     return MasterCommandSpec("AE",
         [Field.byte("eep"), Field.padding(12)],
         [Field.byte("eep"), Field.str("resp", 2), Field.padding(10), Field.lit('\r\n')])
 
+@spec
 def number_of_io_modules():
     """ Read the number of input and output modules """
     return MasterCommandSpec("rn",
         [Field.padding(13)],
         [Field.byte("in"), Field.byte("out"), Field.padding(11), Field.lit('\r\n')])
 
+@spec
 def read_output():
     """ Read the information about an output """
     return MasterCommandSpec("ro",
@@ -157,6 +181,7 @@ def read_output():
          Field.bytes('menu_position', 3), Field.str('name', 16), Field.crc(),
          Field.lit('\r\n')])
 
+@spec
 def read_input():
     """ Read the information about an input """
     return MasterCommandSpec("ri",
@@ -164,6 +189,7 @@ def read_input():
         [Field.byte('input_nr'), Field.byte('output_action'), Field.bytes('output_list', 30),
          Field.str('input_name', 8), Field.crc(), Field.lit('\r\n')])
 
+@spec
 def temperature_list():
     """ Read the temperature thermostat sensor list for a series of 12 sensors """
     return MasterCommandSpec("TL",
@@ -173,6 +199,7 @@ def temperature_list():
          Field.svt('tmp7'), Field.svt('tmp8'), Field.svt('tmp9'), Field.svt('tmp10'),
          Field.svt('tmp11'), Field.lit('\r\n')])
 
+@spec
 def setpoint_list():
     """ Read the current setpoint of the thermostats in series of 12 """
     return MasterCommandSpec("SL",
@@ -182,12 +209,14 @@ def setpoint_list():
          Field.svt('tmp7'), Field.svt('tmp8'), Field.svt('tmp9'), Field.svt('tmp10'),
          Field.svt('tmp11'), Field.lit('\r\n')])
 
+@spec
 def thermostat_mode():
     """ Read the current thermostat mode """
     return MasterCommandSpec("TM",
         [Field.padding(13)],
         [Field.byte('mode'), Field.padding(12), Field.lit('\r\n')])
 
+@spec
 def read_setpoint():
     """ Read the programmed setpoint of a thermostat """
     return MasterCommandSpec("rs",
@@ -218,6 +247,7 @@ def read_setpoint():
          Field.svt('fri_temp_n'), Field.svt('sat_temp_n'), Field.svt('sun_temp_n'),
          Field.crc(), Field.lit('\r\n')])
 
+@spec
 def write_setpoint():
     """ Write a setpoints of a thermostats """
     return MasterCommandSpec("ws",
@@ -225,6 +255,7 @@ def write_setpoint():
         [Field.byte("thermostat"), Field.byte("config"), Field.svt("temp"), Field.padding(10),
          Field.lit('\r\n')])
 
+@spec
 def thermostat_list():
     """ Read the thermostat mode, the outside temperature, the temperature of each thermostat,
     as well as the setpoint.
@@ -246,6 +277,7 @@ def thermostat_list():
          Field.svt('setp20'), Field.svt('setp21'), Field.svt('setp22'), Field.svt('setp23'),
          Field.crc(), Field.lit('\r\n')])
 
+@spec
 def sensor_humidity_list():
     """ Reads the list humidity values of the 32 (0-31) sensors. """
     return MasterCommandSpec("hl",
@@ -260,6 +292,7 @@ def sensor_humidity_list():
          Field.hum('hum28'), Field.hum('hum29'), Field.hum('hum30'), Field.hum('hum31'),
          Field.crc(), Field.lit('\r\n')])
 
+@spec
 def sensor_temperature_list():
     """ Reads the list temperature values of the 32 (0-31) sensors. """
     return MasterCommandSpec("cl",
@@ -274,6 +307,7 @@ def sensor_temperature_list():
          Field.svt('tmp28'), Field.svt('tmp29'), Field.svt('tmp30'), Field.svt('tmp31'),
          Field.crc(), Field.lit('\r\n')])
 
+@spec
 def sensor_brightness_list():
     """ Reads the list brightness values of the 32 (0-31) sensors. """
     return MasterCommandSpec("bl",
@@ -288,6 +322,7 @@ def sensor_brightness_list():
          Field.byte('bri28'), Field.byte('bri29'), Field.byte('bri30'), Field.byte('bri31'),
          Field.crc(), Field.lit('\r\n')])
 
+@spec
 def pulse_list():
     """ List the pulse counter values. """
     return MasterCommandSpec("PL",
@@ -295,36 +330,42 @@ def pulse_list():
         [Field.int('pv0'), Field.int('pv1'), Field.int('pv2'), Field.int('pv3'), Field.int('pv4'),
          Field.int('pv5'), Field.int('pv6'), Field.int('pv7'), Field.lit('\r\n')])
 
+@spec
 def error_list():
     """ Get the number of errors for each input and output module. """
     return MasterCommandSpec("el",
         [Field.padding(13)],
         [Field("errors", ErrorListFieldType()), Field.crc(), Field.lit("\r\n")])
 
+@spec
 def clear_error_list():
     """ Clear the number of errors. """
     return MasterCommandSpec("ec",
         [Field.padding(13)],
         [Field.str("resp", 2), Field.padding(11), Field.lit("\r\n")])
 
+@spec
 def to_cli_mode():
     """ Go to CLI mode """
     return MasterCommandSpec("CM",
         [Field.padding(13)],
         None)
 
+@spec
 def module_discover_start():
     """ Put the master in module discovery mode. """
     return MasterCommandSpec("DA",
         [Field.padding(13)],
         [Field.str("resp", 2), Field.padding(11), Field.lit("\r\n")])
 
+@spec
 def module_discover_stop():
     """ Put the master into the normal working state. """
     return MasterCommandSpec("DO",
         [Field.padding(13)],
         [Field.str("resp", 2), Field.padding(11), Field.lit("\r\n")])
 
+@spec
 def indicate():
     """ Flash the led for a given output/input/sensor. """
     return MasterCommandSpec("IN",
@@ -333,18 +374,21 @@ def indicate():
 
 ### Below are the asynchronous messages, sent by the master to the gateway
 
+@spec
 def output_list():
     """ The message sent by the master whenever the outputs change. """
     return MasterCommandSpec("OL",
         [],
         [Field("outputs", OutputFieldType()), Field.lit("\r\n")])
 
+@spec
 def input_list():
     """ The message sent by the master whenever an input is enabled. """
     return MasterCommandSpec("IL",
         [],
         [Field.byte('input'), Field.byte('output'), Field.lit("\r\n")])
 
+@spec
 def module_initialize():
     """ The message sent by the master whenever a module is initialized in module discovery mode.
     """
@@ -355,6 +399,7 @@ def module_initialize():
 
 ### Below are the function to update the firmware of the modules (input/output/dimmer/thermostat)
 
+@spec
 def modules_goto_bootloader():
     """ Reset the module to go to the bootloader. """
     return MasterCommandSpec("FR",
@@ -363,6 +408,7 @@ def modules_goto_bootloader():
         [Field.str('addr', 4), Field.byte("error_code"), Field.lit('C'), Field.byte('crc0'),
          Field.byte('crc1'), Field.padding(5), Field.lit("\r\n")])
 
+@spec
 def modules_new_firmware_version():
     """ Preprare the slave module for a new version. """
     return MasterCommandSpec("FN",
@@ -371,6 +417,7 @@ def modules_new_firmware_version():
         [Field.str('addr', 4), Field.byte("error_code"), Field.lit('C'), Field.byte('crc0'),
          Field.byte('crc1'), Field.padding(5), Field.lit("\r\n")])
 
+@spec
 def modules_new_crc():
     """ Write the new crc code to the bootloaded module. """
     return MasterCommandSpec("FC",
@@ -380,18 +427,21 @@ def modules_new_crc():
         [Field.str('addr', 4), Field.byte("error_code"), Field.lit('C'), Field.byte('crc0'),
          Field.byte('crc1'), Field.padding(5), Field.lit("\r\n")])
 
+@spec
 def change_communication_mode_to_long():
     """ Change the number of bytes used to communicate with the master to 75. """
     return MasterCommandSpec("cm",
         [Field.lit('\x4d'), Field.lit('\x01'), Field.padding(11)],
         [Field.lit('\x4d'), Field.lit('\x01'), Field.padding(11), Field.lit("\r\n")])
 
+@spec
 def change_communication_mode_to_short():
     """ Change the number of bytes used to communicate with the master to 18. """
     return MasterCommandSpec("cm",
         [Field.lit('\x12'), Field.lit('\x00'), Field.padding(71)],
         [Field.lit('\x12'), Field.lit('\x00'), Field.padding(11), Field.lit("\r\n")])
 
+@spec
 def modules_update_firmware_block():
     """ Upload 1 block of 64 bytes to the module. """
     return MasterCommandSpec("FD",
@@ -400,6 +450,7 @@ def modules_update_firmware_block():
         [Field.str('addr', 4), Field.byte("error_code"), Field.lit('C'), Field.byte('crc0'),
          Field.byte('crc1'), Field.lit("\r\n")])
 
+@spec
 def modules_verify_firmware():
     """ Tell the master to verify the update firmware. """
     return MasterCommandSpec("FV",
@@ -409,6 +460,7 @@ def modules_verify_firmware():
          Field.byte("f1"), Field.byte("f2"), Field.byte("f3"), Field.byte("status"),
          Field.lit('C'), Field.byte('crc0'), Field.byte('crc1'), Field.lit("\r\n")])
 
+@spec
 def modules_goto_application():
     """ Let the module go to application. """
     return MasterCommandSpec("FG",
@@ -25,6 +25,7 @@ Created on Sep 9, 2012
 @author: fryckbos
 """
 import math
+import struct
 
 import master_api
 from serial_utils import printable
@@ -37,6 +38,8 @@ class MasterCommandSpec(object):
     The output looks like this:
     [Action (2 bytes)] [cid] [fields]
     The total length depends on the action.
+
+    A MasterCommandSpec is immutable: the specs in master_api are shared by all callers.
     """
     def __init__(self, action, input_fields, output_fields):
         """ Create a MasterCommandSpec.
@@ -45,12 +48,16 @@ class MasterCommandSpec(object):
         :type action: 2-byte string
         :param input_fields: Fields in the input to the master
         :type input_fields: array of :class`Field`
-        :param output_fields: Fields in the output from the master
+        :param output_fields: Fields in the output from the master, None if there is no output
         :type output_fields: array of :class`Field`
         """
         self.action = action
-        self.input_fields = input_fields
-        self.output_fields = output_fields
+        self.input_fields = tuple(input_fields)
+        self.output_fields = tuple(output_fields) if output_fields is not None else None
+
+        self.__prefix = "STR" + action
+        self.__has_crc = any([Field.is_crc(field) for field in self.output_fields or []])
+        self.__output_codec = MasterCommandCodec(self.output_fields or [])
 
     def create_input(self, cid, fields=None):
         """ Create an input command for the master using this spec and the provided fields.
@@ -64,7 +71,6 @@ class MasterCommandSpec(object):
         if fields is None:
             fields = dict()
 
-        start = "STR" + self.action + chr(cid)
         encoded_fields = ""
         for field in self.input_fields:
             if Field.is_crc(field):
@@ -72,7 +78,7 @@ class MasterCommandSpec(object):
             else:
                 encoded_fields += field.encode(fields.get(field.name))
 
-        return start + encoded_fields + "\r\n"
+        return self.__prefix + chr(cid) + encoded_fields + "\r\n"
 
     def __calc_crc(self, encoded_string):
         """ Calculate the crc of an string. """
@@ -109,6 +115,8 @@ class MasterCommandSpec(object):
         :type partial_result: None if no partial result yet
         :rtype: tuple of (bytes consumed(int), result(Result), done(bool))
         """
+        codec = self.__output_codec
+
         if partial_result == None:
             from_pending = 0
             partial_result = Result()
@@ -117,47 +125,211 @@ class MasterCommandSpec(object):
             byte_str = partial_result.pending_bytes + byte_str
             partial_result.pending_bytes = ""
 
-        def decode_field(index, byte_str, field, num_bytes):
-            """ Decode one field, returns index for the next field if successful,
-            returns a tuple with decode information if not successful."""
-            if index + num_bytes <= len(byte_str):
-                try:
-                    decoded = field.decode(byte_str[index:index + num_bytes])
-                except NeedMoreBytesException, nmbe:
-                    return decode_field(index, byte_str, field, nmbe.bytes_required)
-                else:
-                    partial_result[field.name] = decoded
-                    partial_result.field_index += 1
-                    partial_result.pending_bytes = ""
-                    index += num_bytes
-                    return index
-            else:
-                partial_result.pending_bytes += byte_str[index:]
+        if partial_result.field_index == 0:
+            if self.__has_crc:
+                # Outputs with a crc are only decoded if the complete output was received and the
+                # crc over the received bytes is valid.
+                length = codec.get_offset(byte_str, len(self.output_fields))
+                if length is None or length > len(byte_str):
+                    partial_result.pending_bytes = byte_str
+                    return (len(byte_str) - from_pending, partial_result, False)
+                elif not codec.check_crc(byte_str):
+                    partial_result.crc_valid = False
+                    partial_result.complete = True
+                    return (length - from_pending, partial_result, True)
+
+            # Fast path: the complete output is available, decode it at once.
+            fields = {}
+            index = codec.decode(byte_str, fields)
+            if index is not None:
+                partial_result.fields = fields
+                partial_result.field_index = len(self.output_fields)
+                partial_result.complete = True
+                return (index - from_pending, partial_result, True)
+
+        # Decode field by field, the remaining bytes are kept until more bytes arrive.
+        index = 0
+        for field_index in range(partial_result.field_index, len(self.output_fields)):
+            field = self.output_fields[field_index]
+            num_bytes = codec.get_decode_length(field_index, byte_str, index)
+            if num_bytes is None or index + num_bytes > len(byte_str):
+                partial_result.pending_bytes = byte_str[index:]
                 return (len(byte_str) - from_pending, partial_result, False)
 
-        # Found beginning, start decoding
-        index = 0
-        for field in self.output_fields[partial_result.field_index:]:
-            index = decode_field(index, byte_str, field, field.get_min_decode_bytes())
-            if type(index) != int:
-                # We ran out of bytes
-                return index
+            partial_result[field.name] = field.decode(byte_str[index:index + num_bytes])
+            partial_result.field_index += 1
+            index += num_bytes
 
         partial_result.complete = True
         return (index - from_pending, partial_result, True)
 
     def output_has_crc(self):
         """ Check if the MasterCommandSpec output contains a crc field. """
-        for field in self.output_fields:
-            if Field.is_crc(field):
-                return True
-
-        return False
+        return self.__has_crc
 
     def __eq__(self, other):
         """ Only used for testing, equals by name. """
         return self.action == other.action
 
+class MasterCommandCodec(object):
+    """ Compiled decoder for a list of fields. Consecutive fixed length fields are unpacked with a
+    single struct format. The length of a variable length field
+    (OutputFieldType, ErrorListFieldType) is 1 + the first byte times the item_size of the type.
+    A crc field is the sum of the preceding bytes: 'C' + 2 bytes.
+    """
+
+    # Actions on a struct value, per field.
+    VALUE = 0     # use the struct value
+    CONST = 1     # no struct value, the field has a constant value
+    CALL = 2      # pass the struct value through a function
+    LITERAL = 3   # check the struct value against a literal
+
+    def __init__(self, fields):
+        """ Compile the fields.
+
+        :param fields: sequence of :class`Field`
+        """
+        self.__segments = [] # ('fixed', Struct, decoders), ('var', field) or ('crc', field)
+        self.__lengths = []  # decode length per field, (None, item_size) for variable length fields
+        self.__crc_index = None # the index of the crc field
+
+        (formats, decoders) = ([], [])
+
+        def close_fixed():
+            """ Add the current run of fixed length fields as one segment. """
+            if len(formats) > 0:
+                self.__segments.append(('fixed', struct.Struct('>' + ''.join(formats)),
+                                        list(decoders)))
+            del formats[:], decoders[:]
+
+        for field in fields:
+            field_type = field.field_type
+            if isinstance(field_type, (OutputFieldType, ErrorListFieldType)):
+                close_fixed()
+                self.__segments.append(('var', field))
+                self.__lengths.append((None, field_type.item_size))
+                continue
+
+            if Field.is_crc(field):
+                self.__crc_index = len(self.__lengths)
+                self.__lengths.append((field.get_min_decode_bytes(), None))
+                close_fixed()
+                self.__segments.append(('crc', field))
+                continue
+
+            self.__lengths.append((field.get_min_decode_bytes(), None))
+            (fmt, decoder) = MasterCommandCodec.__compile_field(field)
+            formats.append(fmt)
+            decoders.append((field.name, ) + decoder)
+
+        close_fixed()
+
+    @staticmethod
+    def __compile_field(field):
+        """ Get the struct format and decoder for a fixed length field.
+
+        :returns: tuple (format, (action, argument) for decoding)
+        """
+        field_type = field.field_type
+        if isinstance(field_type, FieldType):
+            fmt = '%ds' % field_type.length
+            if field_type.python_type == int:
+                fmt = 'B' if field_type.length == 1 else 'H'
+            return (fmt, (MasterCommandCodec.VALUE, None))
+        elif isinstance(field_type, PaddingFieldType):
+            return ('%dx' % field_type.length, (MasterCommandCodec.CONST, ""))
+        elif isinstance(field_type, LiteralFieldType):
+            return ('%ds' % len(field_type.literal),
+                    (MasterCommandCodec.LITERAL, field_type.literal))
+        else:
+            return ('%ds' % field.get_min_decode_bytes(), (MasterCommandCodec.CALL, field.decode))
+
+    def get_offset(self, byte_str, field_index):
+        """ Get the offset of a field in byte_str.
+
+        :returns: the offset, None if the offset is not known yet.
+        """
+        offset = 0
+        for index in range(field_index):
+            length = self.get_decode_length(index, byte_str, offset)
+            if length is None:
+                return None
+            offset += length
+        return offset
+
+    def check_crc(self, byte_str):
+        """ Check the crc field in byte_str: the sum of the bytes before the crc field. The
+        byte_str should contain at least all bytes up to and including the crc field. """
+        offset = self.get_offset(byte_str, self.__crc_index)
+        crc = sum(bytearray(byte_str[:offset]))
+        received = byte_str[offset:offset + 3]
+        return received[0] == 'C' and ord(received[1]) * 256 + ord(received[2]) == crc
+
+    def get_decode_length(self, field_index, byte_str, index):
+        """ Get the number of bytes of a field, the field starts at index in byte_str.
+
+        :returns: the number of bytes, None if the length is not known yet.
+        """
+        (length, item_size) = self.__lengths[field_index]
+        if length is None:
+            if index >= len(byte_str):
+                return None
+            length = 1 + ord(byte_str[index]) * item_size
+        return length
+
+    def decode(self, byte_str, fields):
+        """ Decode all fields at once.
+
+        :param byte_str: the bytes to decode, trailing bytes are ignored.
+        :param fields: dict where the decoded fields are stored.
+        :returns: the number of bytes used, None if byte_str does not contain all fields.
+        """
+        index = 0
+        length = len(byte_str)
+
+        for segment in self.__segments:
+            if segment[0] == 'fixed':
+                (_, fixed, decoders) = segment
+                end = index + fixed.size
+                if end > length:
+                    return None
+
+                values = fixed.unpack_from(byte_str, index)
+                position = 0
+                for (name, action, argument) in decoders:
+                    if action == MasterCommandCodec.CONST:
+                        fields[name] = argument
+                        continue
+
+                    value = values[position]
+                    position += 1
+                    if action == MasterCommandCodec.VALUE:
+                        fields[name] = value
+                    elif action == MasterCommandCodec.CALL:
+                        fields[name] = argument(value)
+                    elif value != argument:
+                        raise ValueError('Byte array does not match literal: expected %s, got %s' %
+                                         (printable(argument), printable(value)))
+                    else:
+                        fields[name] = ""
+            else:
+                field = segment[1]
+                if segment[0] == 'crc':
+                    end = index + 3
+                elif index < length:
+                    end = index + 1 + ord(byte_str[index]) * field.field_type.item_size
+                else:
+                    return None
+
+                if end > length:
+                    return None
+                fields[field.name] = field.decode(byte_str[index:end])
+
+            index = end
+
+        return index
+
+
 class Result(object):
     """ Result of a communication with the master. Can be accessed as a dict,
     contains the output fields specified in the spec."""
@@ -168,6 +340,7 @@ class Result(object):
         self.field_index = 0
         self.fields = {}
         self.pending_bytes = ""
+        self.crc_valid = True
 
     def __getitem__(self, key):
         """ Implemented so class can be accessed as a dict. """
@@ -498,6 +671,9 @@ class DimmerFieldType(object):
 
 class OutputFieldType(object):
     """ Field type for OL. """
+
+    item_size = 2
+
     def __init__(self):
         pass
 
@@ -507,7 +683,7 @@ class OutputFieldType(object):
 
     def decode(self, byte_str):
         """ Decode a byte string. """
-        bytes_required = 1 + (ord(byte_str[0]) * 2)
+        bytes_required = 1 + (ord(byte_str[0]) * OutputFieldType.item_size)
 
         if len(byte_str) < bytes_required:
             raise NeedMoreBytesException(bytes_required)
@@ -525,6 +701,9 @@ class OutputFieldType(object):
 
 class ErrorListFieldType(object):
     """ Field type for el. """
+
+    item_size = 4
+
     def __init__(self):
         pass
 
@@ -546,7 +725,7 @@ class ErrorListFieldType(object):
     def decode(self, byte_str):
         """ Decode a byte string. """
         nr_modules = ord(byte_str[0])
-        bytes_required = 1 + (nr_modules * 4)
+        bytes_required = 1 + (nr_modules * ErrorListFieldType.item_size)
 
         if len(byte_str) < bytes_required:
             raise NeedMoreBytesException(bytes_required)
@@ -28,29 +28,65 @@ import logging
 LOGGER = logging.getLogger("openmotics")
 
 import os
+import re
 import sys
 import time
-from threading import Thread, Lock, Event
+import heapq
+from threading import Thread, Lock, Event, Condition
 from Queue import Queue, Empty
+from collections import deque
 
 import master_api
-from master_command import Field, printable
-from serial_utils import CommunicationTimedOutException
+from master_command import printable
+from serial_utils import CommunicationTimedOutException, CommunicationStats, get_transport
 
 class MasterCommunicator(object):
     """ Uses a serial port to communicate with the master and updates the output state.
     Provides methods to send MasterCommands, Passthrough and Maintenance. A watchdog checks the
     state of the communication: if more than 1 timeout between 2 watchdog checks is received, the
     communication is not working properly and watchdog callback is called.
+
+    Every reply from the master carries the cid of the command, this allows multiple commands to
+    be outstanding at the same time (pipelining). The pipeline_depth limits the number of commands
+    in flight, a depth of 1 sends the commands one by one.
+
+    The serial port is accessed through a transport (see serial_utils.get_transport): ports with a
+    file descriptor are polled and drained in one read, so a pty or socket can stand in for the
+    serial port.
+
+    Every command has a priority: when the command window is full, waiting commands get the next
+    place in order of priority. Interactive commands use PRIORITY_HIGH, background jobs (bulk
+    reads, periodic refreshes) use PRIORITY_LOW: they take a place per command, so interactive
+    commands get in between the commands of a running background job.
+
+    The timeout of a command is learned per action (see :class`AdaptiveTimeout`) unless a timeout
+    is provided. Idempotent read commands are retried after a timeout. The watchdog only fires if
+    a significant fraction of the commands failed, a single slow reply on a busy bus does not
+    restart the service.
     """
 
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
+    PRIORITY_NAMES = ['high', 'normal', 'low']
+
+    RECV_BUFFER_SIZE = 4096
+    # Seconds to wait for the rest of a prefix before the held bytes go to the passthrough.
+    HOLD_TIMEOUT = 0.05
+    BAUDRATE = 115200
+
+    # Read commands that can safely be sent again if the answer did not arrive.
+    IDEMPOTENT_ACTIONS = frozenset(['ST', 'EL', 'RE', 'rn', 'ro', 'ri', 'TL', 'SL', 'rs', 'tl',
+                                    'hl', 'cl', 'bl', 'PL', 'el'])
+
     def __init__(self, serial, init_master=True, verbose=False,
                  watchdog_period=150, watchdog_callback=lambda: os._exit(1),
-                 passthrough_timeout=0.2):
+                 passthrough_timeout=0.2, pipeline_depth=1, read_retries=1, watchdog_rate=0.5):
         """ Default constructor.
 
         :param serial: Serial port to communicate with
-        :type serial: Instance of :class`serial.Serial`
+        :type serial: Instance of :class`serial.Serial`, a transport or an object that replicates \
+        the pyserial read, inWaiting and write methods.
         :param init_master: Send an initialization sequence to the master to make sure we are in \
         CLI mode. This can be turned of for testing.
         :type init_master: boolean.
@@ -64,23 +100,49 @@ class MasterCommunicator(object):
         :param passthrough_timeout: The time to wait for an answer on a passthrough message \
         (in sec)
         :type passthrough_timeout: float.
+        :param pipeline_depth: The maximum number of commands that can wait for an answer from \
+        the master at the same time (in [1, 254]).
+        :type pipeline_depth: integer.
+        :param read_retries: The number of times an idempotent read command is sent again after \
+        a timeout.
+        :type read_retries: integer.
+        :param watchdog_rate: The watchdog callback is called if more than 1 command failed \
+        between two watchdog checks and the failed commands are at least this fraction of the \
+        commands.
+        :type watchdog_rate: float.
         """
+        if pipeline_depth < 1 or pipeline_depth > 254:
+            raise ValueError("pipeline_depth not in [1, 254]: %d" % pipeline_depth)
+
         self.__init_master = init_master
         self.__verbose = verbose
 
         self.__serial = serial
+        self.__transport = get_transport(serial)
         self.__serial_write_lock = Lock()
-        self.__command_lock = Lock()
+        self.__command_window = CommandWindow(pipeline_depth,
+                                              len(MasterCommunicator.PRIORITY_NAMES))
+        self.__pipeline_depth = pipeline_depth
         self.__serial_bytes_written = 0
         self.__serial_bytes_read = 0
         self.__timeouts = 0
+        self.__commands = 0
+        self.__counters_lock = Lock()
+        self.__adaptive_timeout = AdaptiveTimeout()
+        self.__read_retries = read_retries
+        self.__stats = CommunicationStats(MasterCommunicator.BAUDRATE)
 
         self.__cid = 1
+        self.__cid_lock = Lock()
 
         self.__maintenance_mode = False
         self.__maintenance_queue = Queue()
 
-        self.__consumers = []
+        # The consumers are indexed on their 3-byte prefix, the read thread looks up consumers in
+        # the index without taking the lock: the index is replaced (not modified) on every change.
+        self.__consumer_index = {}
+        self.__start_bytes = None
+        self.__consumers_lock = Lock()
 
         self.__passthrough_mode = False
         self.__passthrough_timeout = passthrough_timeout
@@ -95,6 +157,7 @@ class MasterCommunicator(object):
         self.__read_thread.daemon = True
 
         self.__watchdog_period = watchdog_period
+        self.__watchdog_rate = watchdog_rate
         self.__watchdog_callback = watchdog_callback
         self.__watchdog_thread = Thread(target=self.__watchdog,
                                         name="MasterCommunicator watchdog thread")
@@ -123,6 +186,11 @@ class MasterCommunicator(object):
         self.__read_thread.start()
         self.__watchdog_thread.start()
 
+    def stop(self):
+        """ Stop the background threads. The read thread stops when the transport returns from a
+        read, for a PollTransport this happens at the latest after the poll timeout. """
+        self.__stop = True
+
     def get_bytes_written(self):
         """ Get the number of bytes written to the Master. """
         return self.__serial_bytes_written
@@ -138,10 +206,30 @@ class MasterCommunicator(object):
         else:
             return time.time() - self.__last_success
 
+    def get_communication_statistics(self):
+        """ Get the communication statistics: latency histograms per action, the number of
+        timeouts and crc failures per action, the time waited for a place in the command window
+        (in total and per priority in 'lanes') and the bus utilisation, see
+        :class`serial_utils.CommunicationStats`. 'queue' contains the number of commands that are
+        waiting for a place in the command window per priority, 'in_flight' the number of commands
+        that are waiting for an answer and 'timeouts' the current timeout per action. """
+        ret = self.__stats.to_dict()
+        waiting = self.__command_window.get_waiting()
+        ret['queue'] = dict([(MasterCommunicator.PRIORITY_NAMES[priority], waiting[priority])
+                             for priority in range(len(waiting))])
+        ret['in_flight'] = self.__command_window.get_in_flight()
+        ret['timeouts'] = self.__adaptive_timeout.get_timeouts()
+        return ret
+
+    def get_pipeline_depth(self):
+        """ Get the maximum number of commands that can be in flight at the same time. """
+        return self.__pipeline_depth
+
     def __get_cid(self):
         """ Get a communication id """
-        (ret, self.__cid) = (self.__cid, (self.__cid % 255) + 1)
-        return ret
+        with self.__cid_lock:
+            (ret, self.__cid) = (self.__cid, (self.__cid % 255) + 1)
+            return ret
 
     def __write_to_serial(self, data):
         """ Write data to the serial port.
@@ -152,8 +240,9 @@ class MasterCommunicator(object):
         with self.__serial_write_lock:
             if self.__verbose:
                 print "%.3f writing to serial: %s" % (time.time(), printable(data))
-            self.__serial.write(data)
+            self.__transport.write(data)
             self.__serial_bytes_written += len(data)
+            self.__stats.record_bytes(len(data))
 
     def register_consumer(self, consumer):
         """ Register a customer consumer with the communicator. An instance of :class`Consumer`
@@ -163,15 +252,44 @@ class MasterCommunicator(object):
         :param consumer: The consumer to register.
         :type consumer: Consumer or BackgroundConsumer.
         """
-        self.__consumers.append(consumer)
+        prefix = consumer.get_prefix()
+        with self.__consumers_lock:
+            index = dict(self.__consumer_index)
+            index[prefix] = index.get(prefix, []) + [consumer]
+            self.__set_consumer_index(index)
+
+    def __unregister_consumer(self, consumer):
+        """ Remove a consumer, if it is still registered. """
+        prefix = consumer.get_prefix()
+        with self.__consumers_lock:
+            consumers = self.__consumer_index.get(prefix, [])
+            if consumer in consumers:
+                index = dict(self.__consumer_index)
+                index[prefix] = [c for c in consumers if c is not consumer]
+                if len(index[prefix]) == 0:
+                    del index[prefix]
+                self.__set_consumer_index(index)
+
+    def __set_consumer_index(self, index):
+        """ Replace the consumer index, should be called while holding the consumers lock. """
+        start_bytes = set([re.escape(prefix[0]) for prefix in index])
+        if len(start_bytes) > 0:
+            self.__start_bytes = re.compile("[" + "".join(start_bytes) + "]")
+        else:
+            self.__start_bytes = None
+        self.__consumer_index = index
 
-    def do_command(self, cmd, fields=None, timeout=1):
+    def do_command(self, cmd, fields=None, timeout=None, priority=PRIORITY_NORMAL, retries=None):
         """ Send a command over the serial port and block until an answer is received.
         If the master does not respond within the timeout period, a CommunicationTimedOutException
         is raised
 
         :param cmd: specification of the command to execute
         :type cmd: :class`MasterCommand.MasterCommandSpec`
+        :param timeout: the timeout (in sec), None to use the learned timeout for the action.
+        :param priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+        :param retries: the number of times the command is sent again after a timeout, None to \
+        use read_retries for idempotent read commands and 0 for other commands.
         :raises: :class`CommunicationTimedOutException` if master did not respond in time
         :raises: :class`InMaintenanceModeException` if master is in maintenance mode
         :returns: dict containing the output fields of the command
@@ -179,43 +297,145 @@ class MasterCommunicator(object):
         if self.__maintenance_mode:
             raise InMaintenanceModeException()
 
+        if retries is None:
+            retries = self.__read_retries if cmd.action in MasterCommunicator.IDEMPOTENT_ACTIONS \
+                      else 0
+
+        self.__count(commands=1)
+        while True:
+            consumer = self.__send_command(cmd, fields, priority)
+            try:
+                return self.__complete_command(consumer, timeout)
+            except CommunicationTimedOutException:
+                if retries == 0:
+                    self.__count(timeouts=1)
+                    raise
+                retries -= 1
+
+    def do_commands(self, commands, timeout=None, priority=PRIORITY_NORMAL,
+                    return_exceptions=False):
+        """ Send a list of commands over the serial port and block until all answers are received.
+        The next commands are sent while waiting for the answers of the previous commands, the
+        number of outstanding commands is limited by the pipeline depth.
+
+        :param commands: the commands to execute
+        :type commands: list of tuples (:class`MasterCommand.MasterCommandSpec`, fields dict)
+        :param timeout: the timeout for each command (in sec), None to use the learned timeouts.
+        :param priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW, every command takes a \
+        place in the command window separately: commands with a higher priority can get in between.
+        :param return_exceptions: if True, a command that times out or fails the crc check does \
+        not stop the batch: the exception is returned in place of the output fields.
+        :raises: :class`CommunicationTimedOutException` if master did not respond in time
+        :raises: :class`InMaintenanceModeException` if master is in maintenance mode
+        :returns: list of dicts containing the output fields, in the order of the commands
+        """
+        if self.__maintenance_mode:
+            raise InMaintenanceModeException()
+
+        results = []
+        pending = deque()
+        self.__count(commands=len(commands))
+
+        def complete_oldest():
+            """ Wait for the answer on the oldest pending command and add it to the results. """
+            try:
+                results.append(self.__complete_command(pending.popleft(), timeout))
+            except (CommunicationTimedOutException, CrcCheckFailedException), exception:
+                if isinstance(exception, CommunicationTimedOutException):
+                    self.__count(timeouts=1)
+                if not return_exceptions:
+                    raise
+                results.append(exception)
+
+        try:
+            for (cmd, fields) in commands:
+                consumer = None
+                while consumer is None:
+                    # Only block for a place when none of our commands are in flight: waiting for
+                    # a place while holding places deadlocks with other callers that do the same.
+                    consumer = self.__send_command(cmd, fields, priority, block=len(pending) == 0)
+                    if consumer is None:
+                        complete_oldest()
+                pending.append(consumer)
+
+            while len(pending) > 0:
+                complete_oldest()
+        finally:
+            # Clean up the outstanding commands if one of the commands failed.
+            for consumer in pending:
+                self.__unregister_consumer(consumer)
+                self.__command_window.release()
+
+        return results
+
+    def __count(self, commands=0, timeouts=0):
+        """ Add to the number of commands and timeouts that are checked by the watchdog. """
+        with self.__counters_lock:
+            self.__commands += commands
+            self.__timeouts += timeouts
+
+    def __send_command(self, cmd, fields, priority, block=True):
+        """ Register a consumer for the command and write the command to the serial port. This
+        takes a place in the command window, it is released by __complete_command.
+
+        :param block: wait for a place in the command window, if False the command is only sent \
+        if a place is available immediately.
+        :returns: the registered :class`Consumer`, None if block is False and no place was \
+        available.
+        """
         if fields is None:
             fields = dict()
 
-        cid = self.__get_cid()
-        consumer = Consumer(cmd, cid)
-        inp = cmd.create_input(cid, fields)
+        start = time.time()
+        if block:
+            self.__command_window.acquire(priority)
+        elif not self.__command_window.try_acquire():
+            return None
 
-        with self.__command_lock:
-            self.__consumers.append(consumer)
+        try:
+            cid = self.__get_cid()
+            consumer = Consumer(cmd, cid)
+            inp = cmd.create_input(cid, fields)
+
+            self.register_consumer(consumer)
+            consumer.send_time = time.time()
+            self.__stats.record_wait(consumer.send_time - start,
+                                     MasterCommunicator.PRIORITY_NAMES[priority])
             self.__write_to_serial(inp)
-            try:
-                result = consumer.get(timeout).fields
-                if cmd.output_has_crc() and not self.__check_crc(cmd, result):
-                    raise CrcCheckFailedException()
-                else:
-                    self.__last_success = time.time()
-                    return result
-            except CommunicationTimedOutException:
-                self.__timeouts += 1
-                raise
+            return consumer
+        except:
+            self.__command_window.release()
+            raise
 
-    def __check_crc(self, cmd, result):
-        """ Calculate the CRC of the data for a certain master command.
+    def __complete_command(self, consumer, timeout):
+        """ Wait for the answer on a command sent by __send_command and release its place in the
+        command window.
 
-        :param cmd: instance of MasterCommandSpec.
-        :param result: A dict containing the result of the master command.
-        :returns: boolean
+        :raises: :class`CommunicationTimedOutException` if master did not respond in time
+        :returns: dict containing the output fields of the command
         """
-        crc = 0
-        for field in cmd.output_fields:
-            if Field.is_crc(field):
-                break
-            else:
-                for byte in field.encode(result[field.name]):
-                    crc += ord(byte)
+        cmd = consumer.cmd
+        if timeout is None:
+            timeout = self.__adaptive_timeout.get_timeout(cmd.action)
 
-        return result['crc'] == [67, (crc / 256), (crc % 256)]
+        try:
+            result = consumer.get(timeout)
+            latency = consumer.receive_time - consumer.send_time
+            self.__adaptive_timeout.add_measurement(cmd.action, latency)
+            self.__stats.record_command(cmd.action, latency)
+            if not result.crc_valid:
+                self.__stats.record_failure('crc', cmd.action)
+                raise CrcCheckFailedException()
+            else:
+                self.__last_success = time.time()
+                return result.fields
+        except CommunicationTimedOutException:
+            self.__unregister_consumer(consumer)
+            self.__adaptive_timeout.add_timeout(cmd.action)
+            self.__stats.record_failure('timeout', cmd.action)
+            raise
+        finally:
+            self.__command_window.release()
 
     def __passthrough_wait(self):
         """ Waits until the passthrough is done or a timeout is reached. """
@@ -223,7 +443,7 @@ class MasterCommunicator(object):
             LOGGER.info("Timed out on passthrough message")
 
         self.__passthrough_mode = False
-        self.__command_lock.release()
+        self.__command_window.release_exclusive()
 
     def send_passthrough_data(self, data):
         """ Send raw data on the serial port.
@@ -235,7 +455,7 @@ class MasterCommunicator(object):
             raise InMaintenanceModeException()
 
         if not self.__passthrough_mode:
-            self.__command_lock.acquire()
+            self.__command_window.acquire_exclusive()
             self.__passthrough_done.clear()
             self.__passthrough_mode = True
             passthrough_thread = Thread(target=self.__passthrough_wait)
@@ -304,23 +524,15 @@ class MasterCommunicator(object):
         """ Returns whether the MasterCommunicator is in maintenance mode. """
         return self.__maintenance_mode
 
-    def __get_start_bytes(self):
-        """ Create a dict that maps the start byte to a list of consumers. """
-        start_bytes = {}
-        for consumer in self.__consumers:
-            start_byte = consumer.get_prefix()[0]
-            if start_byte in start_bytes:
-                start_bytes[start_byte].append(consumer)
-            else:
-                start_bytes[start_byte] = [consumer]
-        return start_bytes
-
     def __watchdog(self):
-        """ Run in the background watchdog thread: checks the number of timeouts per minute. If the
-        number of timeouts is larger than 1, the watchdog callback is called. """
+        """ Run in the background watchdog thread: checks the number of failed commands per period.
+        If more than 1 command failed and the failed commands are at least watchdog_rate of all
+        commands, the watchdog callback is called. """
         while not self.__stop:
-            (timeouts, self.__timeouts) = (self.__timeouts, 0)
-            if timeouts > 1:
+            with self.__counters_lock:
+                (timeouts, self.__timeouts) = (self.__timeouts, 0)
+                (commands, self.__commands) = (self.__commands, 0)
+            if timeouts > 1 and timeouts >= self.__watchdog_rate * commands:
                 sys.stderr.write("Watchdog detected problems in communication !\n")
                 self.__watchdog_callback()
             time.sleep(self.__watchdog_period)
@@ -332,7 +544,7 @@ class MasterCommunicator(object):
         def consumer_done(consumer):
             """ Callback for when consumer is done. ReadState does not access parent directly. """
             if isinstance(consumer, Consumer):
-                self.__consumers.remove(consumer)
+                self.__unregister_consumer(consumer)
 
         class ReadState(object):
             """" The read state keeps track of the current consumer and the partial result
@@ -355,14 +567,16 @@ class MasterCommunicator(object):
                 self.partial_result = None
 
             def consume(self, data):
-                """ Consume the bytes in data using the current_consumer, and return the bytes
-                that were not used. """
+                """ Consume the bytes in data using the current_consumer, and return the number
+                of bytes that were used. """
                 try:
                     (bytes_consumed, result, done) = \
-                        read_state.current_consumer.consume(data, read_state.partial_result)
+                        self.current_consumer.consume(data, self.partial_result)
                 except ValueError, value_error:
                     sys.stderr.write("Got ValueError: " + str(value_error))
-                    return ""
+                    self.current_consumer = None
+                    self.partial_result = None
+                    return len(data)
                 else:
                     if done:
                         consumer_done(self.current_consumer)
@@ -371,63 +585,228 @@ class MasterCommunicator(object):
                         self.current_consumer = None
                         self.partial_result = None
 
-                        return data[bytes_consumed:]
+                        return bytes_consumed
                     else:
                         self.partial_result = result
-                        return ""
+                        return len(data)
 
         read_state = ReadState()
-        data = ""
+        data = bytearray()
+        recv_buffer = bytearray(MasterCommunicator.RECV_BUFFER_SIZE)
+        recv_view = memoryview(recv_buffer)
+
+        def pass_on(leftovers):
+            """ Send bytes that were not consumed to the passthrough or maintenance queue. """
+            if not self.__maintenance_mode:
+                self.__passthrough_queue.put(leftovers)
+            else:
+                self.__maintenance_queue.put(leftovers)
 
         while not self.__stop:
-            data += self.__serial.read(1)
-            num_bytes = self.__serial.inWaiting()
-            if num_bytes > 0:
-                data += self.__serial.read(num_bytes)
-            if data != None and len(data) > 0:
-                self.__serial_bytes_read += (1 + num_bytes)
+            # Bytes held back as the possible start of a prefix are only waited on shortly.
+            holding = len(data) > 0 and not read_state.should_resume()
+            timeout = MasterCommunicator.HOLD_TIMEOUT if holding else None
+
+            num_bytes = self.__transport.recv_into(recv_buffer, timeout)
+            if num_bytes == 0:
+                if holding:
+                    # No more data arrived, the held bytes are not the start of a prefix.
+                    pass_on(str(data))
+                    del data[:]
+            else:
+                data += recv_view[:num_bytes]
+                self.__serial_bytes_read += num_bytes
+                self.__stats.record_bytes(num_bytes)
 
                 if self.__verbose:
-                    print "%.3f read from serial: %s" % (time.time(), printable(data))
-
-                if read_state.should_resume():
-                    data = read_state.consume(data)
-
-                # No else here: data might not be empty when current_consumer is done
-                if read_state.should_find_consumer():
-                    start_bytes = self.__get_start_bytes()
-                    leftovers = "" # for unconsumed bytes; these will go to the passthrough.
-
-                    while len(data) > 0:
-                        if data[0] in start_bytes:
-                            # Prefixes are 3 bytes, make sure we have enough data to match
-                            if len(data) >= 3:
-                                match = False
-                                for consumer in start_bytes[data[0]]:
-                                    if data[:3] == consumer.get_prefix():
-                                        # Found matching consumer
-                                        read_state.set_consumer(consumer)
-                                        data = read_state.consume(data[3:]) # Strip off prefix
-                                        # Consumers might have changed, update start_bytes
-                                        start_bytes = self.__get_start_bytes()
-                                        match = True
-                                        break
-                                if match:
-                                    continue
-                            else:
-                                # All commands end with '\r\n', there are no prefixes that start
-                                # with \r\n so the last bytes of a command will not get stuck
-                                # waiting for the next serial.read()
-                                break
-
-                        leftovers += data[0]
-                        data = data[1:]
-
-                    if len(leftovers) > 0:
-                        if not self.__maintenance_mode:
-                            self.__passthrough_queue.put(leftovers)
-                        else:
-                            self.__maintenance_queue.put(leftovers)
+                    print "%.3f read from serial: %s" % (time.time(), printable(str(data)))
+
+                position = 0
+                leftovers = [] # for unconsumed bytes; these will go to the passthrough.
+
+                while position < len(data):
+                    if read_state.should_resume():
+                        position += read_state.consume(str(data[position:]))
+                        continue
+
+                    # Scan for the first byte of a prefix, without copying the data.
+                    (start, end) = (position, len(data))
+                    match = None
+                    if self.__start_bytes is not None:
+                        match = self.__start_bytes.search(data, position)
+                    position = end if match is None else match.start()
+
+                    if position + 3 > end:
+                        if position < end:
+                            # Prefixes are 3 bytes, wait for more data to match. If no data
+                            # arrives within HOLD_TIMEOUT, the bytes go to the passthrough.
+                            leftovers.append(data[start:position])
+                            break
+                        position = end
+                    else:
+                        consumers = self.__consumer_index.get(str(data[position:position + 3]))
+                        if consumers is not None:
+                            leftovers.append(data[start:position])
+                            read_state.set_consumer(consumers[0])
+                            position += 3 # Strip off prefix
+                            continue
+                        position += 1
+
+                    leftovers.append(data[start:position])
+
+                del data[:position]
+
+                leftovers = "".join([str(leftover) for leftover in leftovers])
+                if len(leftovers) > 0:
+                    pass_on(leftovers)
+
+
+class AdaptiveTimeout(object):
+    """ Learns the timeout per action from the latencies of the replies: the timeout is the
+    average latency plus DEVIATIONS times the average deviation (both exponentially weighted),
+    limited to [min_timeout, max_timeout]. Until MIN_SAMPLES replies were received for an action,
+    the default timeout is used. After a timeout, the learned timeout for the action is doubled (up
+    to max_timeout) until the next reply. The AdaptiveTimeout is used by the threads that send
+    commands and the read thread, the state is guarded by a lock.
+    """
+
+    DEVIATIONS = 4
+    MIN_SAMPLES = 5
+
+    def __init__(self, default=1.0, min_timeout=0.25, max_timeout=5.0, weight=0.125):
+        """ Create an AdaptiveTimeout, the timeouts are in seconds. """
+        self.__default = default
+        self.__min_timeout = min_timeout
+        self.__max_timeout = max_timeout
+        self.__weight = weight
+        self.__actions = {} # action -> [samples, average, deviation, backoff]
+        self.__lock = Lock()
+
+    def get_timeout(self, action):
+        """ Get the timeout for an action (in seconds). """
+        with self.__lock:
+            state = self.__actions.get(action)
+            if state is None:
+                return self.__default
+            (samples, average, deviation, backoff) = state
+
+        if samples < AdaptiveTimeout.MIN_SAMPLES:
+            return self.__default
+        else:
+            timeout = max(self.__min_timeout, average + AdaptiveTimeout.DEVIATIONS * deviation)
+            return min(self.__max_timeout, timeout * backoff)
+
+    def add_measurement(self, action, latency):
+        """ Add the latency of a reply (in seconds). """
+        with self.__lock:
+            state = self.__actions.get(action)
+            if state is None:
+                self.__actions[action] = [1, latency, latency / 2, 1]
+            else:
+                state[0] += 1
+                state[2] += self.__weight * (abs(latency - state[1]) - state[2])
+                state[1] += self.__weight * (latency - state[1])
+                state[3] = 1
+
+    def add_timeout(self, action):
+        """ Register a timeout for an action. """
+        with self.__lock:
+            state = self.__actions.setdefault(action, [0, 0.0, 0.0, 1])
+            state[3] *= 2
+
+    def get_timeouts(self):
+        """ Get the current timeout for all actions that were used.
+
+        :returns: dict that maps the action on the timeout (in seconds).
+        """
+        with self.__lock:
+            actions = self.__actions.keys()
+        return dict([(action, self.get_timeout(action)) for action in actions])
+
+
+class CommandWindow(object):
+    """ The CommandWindow limits the number of commands that are waiting for an answer from the
+    master. Passthrough data requires exclusive access to the master: acquire_exclusive waits until
+    all outstanding commands are done and blocks new commands until release_exclusive is called.
+    Unlike a Lock, the window can be released by another thread than the one that acquired it.
+
+    The threads that are waiting for a place get it in order of priority (lowest number first),
+    threads with the same priority get it in order of arrival.
+    """
+
+    def __init__(self, size, num_priorities=1):
+        """ Create a CommandWindow that allows size commands in flight. """
+        self.__size = size
+        self.__in_flight = 0
+        self.__exclusive = False
+        self.__condition = Condition()
+        self.__waiting = [] # heap of (priority, sequence)
+        self.__num_waiting = [0] * num_priorities
+        self.__sequence = 0
+
+    def acquire(self, priority=0):
+        """ Take a place in the window, blocks until a place is available and no thread with a
+        higher priority is waiting. """
+        with self.__condition:
+            if not self.__exclusive and self.__in_flight < self.__size and \
+                    len(self.__waiting) == 0:
+                self.__in_flight += 1
+                return
+
+            ticket = (priority, self.__sequence)
+            self.__sequence += 1
+            heapq.heappush(self.__waiting, ticket)
+            self.__num_waiting[priority] += 1
+
+            while self.__exclusive or self.__in_flight >= self.__size or \
+                    self.__waiting[0] != ticket:
+                self.__condition.wait()
+
+            heapq.heappop(self.__waiting)
+            self.__num_waiting[priority] -= 1
+            self.__in_flight += 1
+            self.__condition.notify_all() # The next waiting thread might get a place too.
+
+    def try_acquire(self):
+        """ Take a place in the window if one is available and no other thread is waiting.
+
+        :returns: True if a place was taken, False otherwise.
+        """
+        with self.__condition:
+            if not self.__exclusive and self.__in_flight < self.__size and \
+                    len(self.__waiting) == 0:
+                self.__in_flight += 1
+                return True
+            return False
+
+    def release(self):
+        """ Release a place in the window. """
+        with self.__condition:
+            self.__in_flight -= 1
+            self.__condition.notify_all()
+
+    def acquire_exclusive(self):
+        """ Get exclusive access, blocks until all places in the window are released. """
+        with self.__condition:
+            while self.__exclusive:
+                self.__condition.wait()
+            self.__exclusive = True
+            while self.__in_flight > 0:
+                self.__condition.wait()
+
+    def release_exclusive(self):
+        """ Release the exclusive access. """
+        with self.__condition:
+            self.__exclusive = False
+            self.__condition.notify_all()
+
+    def get_in_flight(self):
+        """ Get the number of commands in flight. """
+        return self.__in_flight
+
+    def get_waiting(self):
+        """ Get the number of threads that are waiting for a place, per priority. """
+        return list(self.__num_waiting)
 
 
 class InMaintenanceModeException(Exception):
@@ -447,6 +826,8 @@ class Consumer(object):
     def __init__(self, cmd, cid):
         self.cmd = cmd
         self.cid = cid
+        self.send_time = None
+        self.receive_time = None
         self.__queue = Queue()
 
     def get_prefix(self):
@@ -471,6 +852,7 @@ class Consumer(object):
 
     def deliver(self, output):
         """ Deliver output to the thread waiting on get(). """
+        self.receive_time = time.time()
         self.__queue.put(output)
 
 
@@ -25,7 +25,15 @@ Created on Sep 22, 2012
 
 @author: fryckbos
 '''
+import sys
 import time
+import traceback
+from threading import Thread, Condition, Event
+
+import master_api
+from master_communicator import MasterCommunicator
+from eeprom_models import OutputConfiguration
+from serial_utils import CommunicationTimedOutException
 
 class OutputStatus(object):
     """ Contains a cached version of the current output of the controller. """
@@ -67,3 +75,248 @@ class OutputStatus(object):
     def get_outputs(self):
         """ Return the list of Outputs. """
         return self.__outputs
+
+
+class OutputReader(object):
+    """ Reads the output table from the master. The configuration of the outputs is read from the
+    eeprom banks (these are cached by the EepromController), the status and dimmer come from the
+    last OL message. The ctimer is not stored in the eeprom and the OL message does not contain
+    the dimmer of the outputs that are off: master_api.read_output is used for the outputs that are
+    on and for the outputs of which the dimmer is not known yet (all outputs if no OL message was
+    received yet). The read_output commands are pipelined at PRIORITY_LOW, so interactive commands
+    get in between.
+    """
+
+    def __init__(self, master_communicator, eeprom_controller):
+        """ Create an OutputReader.
+
+        :param master_communicator: the communicator used to send the read_output commands.
+        :type master_communicator: :class`master.master_communicator.MasterCommunicator`
+        :param eeprom_controller: the controller used to read the output configuration.
+        :type eeprom_controller: :class`master.eeprom_controller.EepromController`
+        """
+        self.__master_communicator = master_communicator
+        self.__eeprom_controller = eeprom_controller
+
+    def read(self, on_outputs, last_outputs=None):
+        """ Read all output information.
+
+        :param on_outputs: list of tuples (id, dimmer) of the outputs that are on from the last \
+        OL message, None if no OL message was received yet.
+        :param last_outputs: the outputs of the previous read, the outputs that are off keep \
+        the dimmer value the master reported. None if there was no previous read.
+        :returns: a list of dicts with the keys 'id', 'type', 'name', 'timer', 'floor_level', \
+        'status', 'dimmer' and 'ctimer'. The configuration comes from the eeprom for all outputs, \
+        for the outputs that were read using read_output the status, dimmer and ctimer come from \
+        master_api.read_output.
+        """
+        configs = self.__eeprom_controller.read_all(OutputConfiguration,
+                                                    ['module_type', 'name', 'timer', 'floor'])
+
+        dimmers = {}
+        for output in last_outputs or []:
+            dimmers[output['id']] = output['dimmer']
+
+        if on_outputs is None:
+            to_read = [config.id for config in configs]
+        else:
+            on_dict = dict(on_outputs)
+            to_read = [config.id for config in configs
+                       if config.id in on_dict or config.id not in dimmers]
+
+        read = {}
+        for output in self.__master_communicator.do_commands(
+                [(master_api.read_output(), {'id' : id}) for id in to_read],
+                priority=MasterCommunicator.PRIORITY_LOW):
+            read[output['id']] = output
+
+        outputs = []
+        for config in configs:
+            output = {'id' : config.id, 'type' : config.module_type, 'name' : config.name,
+                      'timer' : config.timer, 'floor_level' : config.floor, 'status' : 0,
+                      'dimmer' : dimmers.get(config.id), 'ctimer' : 0}
+            if config.id in read:
+                for key in ['status', 'dimmer', 'ctimer']:
+                    output[key] = read[config.id][key]
+            outputs.append(output)
+        return outputs
+
+
+class OutputCommandQueue(object):
+    """ Queue for the basic actions that change the state of an output. The commands are dispatched
+    to the master in batches: a command is sent right away when the queue is idle, the commands
+    that arrive while a batch is being sent form the next batch. Commands for the same output in a
+    batch are coalesced. A command replaces an
+    earlier pending command of the same kind (status, dimmer or timer) for the same output, turning
+    an output off replaces all pending commands for that output. The outputs in a batch are
+    dispatched in priority order, the commands are pipelined using do_commands.
+    """
+
+    STATUS = 'status'
+    DIMMER = 'dimmer'
+    TIMER = 'timer'
+
+    def __init__(self, master_communicator):
+        """ Create an OutputCommandQueue.
+
+        :param master_communicator: the communicator used to send the commands.
+        :type master_communicator: :class`master.master_communicator.MasterCommunicator`
+        """
+        self.__master_communicator = master_communicator
+
+        self.__pending = {} # output id -> PendingOutput
+        self.__sequence = 0
+        self.__condition = Condition()
+
+        self.__stop = False
+        self.__thread = Thread(target=self.__run, name="OutputCommandQueue dispatch thread")
+        self.__thread.daemon = True
+
+    def start(self):
+        """ Start the background dispatch thread. """
+        self.__stop = False
+        self.__thread.start()
+
+    def stop(self):
+        """ Stop the background dispatch thread, pending commands are still dispatched. """
+        with self.__condition:
+            self.__stop = True
+            self.__condition.notify_all()
+
+    def put(self, output_id, kind, action_type, priority=MasterCommunicator.PRIORITY_NORMAL):
+        """ Queue a basic action for an output.
+
+        :param output_id: The id of the output, used as action_number for the basic action.
+        :type output_id: Integer [0, 240]
+        :param kind: The kind of command: STATUS, DIMMER or TIMER.
+        :param action_type: The action type of the basic action.
+        :type action_type: Integer
+        :param priority: MasterCommunicator.PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+        :returns: :class`OutputCommandFuture` that is done when the command was executed.
+        """
+        if kind not in [OutputCommandQueue.STATUS, OutputCommandQueue.DIMMER,
+                        OutputCommandQueue.TIMER]:
+            raise ValueError("Unknown kind of output command: %s" % kind)
+
+        future = OutputCommandFuture()
+        with self.__condition:
+            if output_id not in self.__pending:
+                self.__pending[output_id] = PendingOutput(output_id, priority, self.__sequence)
+                self.__sequence += 1
+
+            pending = self.__pending[output_id]
+            pending.priority = min(pending.priority, priority)
+
+            if kind == OutputCommandQueue.STATUS and action_type == master_api.BA_LIGHT_OFF:
+                pending.replace(None, kind, action_type, future)
+            else:
+                pending.replace(kind, kind, action_type, future)
+
+            self.__condition.notify_all()
+
+        return future
+
+    def __run(self):
+        """ Code for the background dispatch thread. """
+        while True:
+            with self.__condition:
+                while len(self.__pending) == 0 and not self.__stop:
+                    self.__condition.wait()
+                if len(self.__pending) == 0:
+                    break
+                (pending, self.__pending) = (self.__pending, {})
+
+            try:
+                self.__dispatch(sorted(pending.values(),
+                                       key=lambda p: (p.priority, p.sequence)))
+            except Exception:
+                sys.stderr.write("Error while dispatching output commands\n")
+                traceback.print_exc()
+
+    def __dispatch(self, outputs):
+        """ Send the commands for a list of PendingOutputs to the master and complete the futures.
+        Every future is completed with the result of its own command: a command that failed does
+        not fail the other commands in the batch. """
+        commands = []
+        futures = []
+        for output in outputs:
+            for (_, action_type, command_futures) in output.commands:
+                commands.append((master_api.basic_action(),
+                                 {"action_type" : action_type, "action_number" : output.id}))
+                futures.append(command_futures)
+
+        try:
+            results = self.__master_communicator.do_commands(
+                            commands, priority=MasterCommunicator.PRIORITY_HIGH,
+                            return_exceptions=True)
+        except Exception, exception:
+            # The batch was not executed (eg. maintenance mode) or the serial port failed.
+            for command_futures in futures:
+                for future in command_futures:
+                    future.set_exception(exception)
+        else:
+            for (result, command_futures) in zip(results, futures):
+                for future in command_futures:
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+
+
+class PendingOutput(object):
+    """ The commands that are waiting in the OutputCommandQueue for one output. """
+
+    def __init__(self, id, priority, sequence):
+        self.id = id
+        self.priority = priority
+        self.sequence = sequence
+        self.commands = [] # list of (kind, action_type, list of futures), in order of arrival
+
+    def replace(self, replaced_kind, kind, action_type, future):
+        """ Add a command, the pending commands of replaced_kind (all commands if None) are
+        removed: their futures are completed by the new command. """
+        futures = [future]
+        remaining = []
+        for command in self.commands:
+            if replaced_kind is None or command[0] == replaced_kind:
+                futures = command[2] + futures
+            else:
+                remaining.append(command)
+        self.commands = remaining + [(kind, action_type, futures)]
+
+
+class OutputCommandFuture(object):
+    """ The result of a command in the OutputCommandQueue. """
+
+    def __init__(self):
+        self.__event = Event()
+        self.__result = None
+        self.__exception = None
+
+    def set_result(self, result):
+        """ Complete the future with the output of the master. """
+        self.__result = result
+        self.__event.set()
+
+    def set_exception(self, exception):
+        """ Complete the future with an exception. """
+        self.__exception = exception
+        self.__event.set()
+
+    def done(self):
+        """ Check if the command was executed. """
+        return self.__event.is_set()
+
+    def result(self, timeout=None):
+        """ Wait until the command was executed.
+
+        :param timeout: The number of seconds to wait, None waits until the command is done.
+        :returns: the output of the master for the command.
+        :raises: CommunicationTimedOutException if the command is not done within the timeout, \
+        the exception of the master communicator if the command failed.
+        """
+        if not self.__event.wait(timeout):
+            raise CommunicationTimedOutException()
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
@@ -29,7 +29,8 @@ class ThermostatStatus(object):
 
     def __init__(self, thermostats, refresh_period=600):
         """ Create a status object using a list of thermostats (can be None),
-        and a refresh period: the refresh has to be invoked explicitly. """
+        and a refresh period: the refresh has to be invoked explicitly. If the refresh period
+        is None, the status should only be refreshed after force_refresh. """
         self.__thermostats = thermostats
         self.__refresh_period = refresh_period
         self.__last_refresh = time.time()
@@ -40,6 +41,8 @@ class ThermostatStatus(object):
 
     def should_refresh(self):
         """ Check whether the status should be refreshed. """
+        if self.__refresh_period is None:
+            return self.__last_refresh == 0
         return time.time() >= self.__last_refresh + self.__refresh_period
 
     def update(self, thermostats):
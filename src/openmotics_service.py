@@ -100,7 +100,16 @@ def main():
     passthrough_serial = Serial(passthrough_serial_port, 19200)
     power_serial = RS485(Serial(power_serial_port, 115200))
 
-    master_communicator = MasterCommunicator(controller_serial)
+    pipeline_depth = 1
+    if config.has_option('OpenMotics', 'controller_pipeline_depth'):
+        pipeline_depth = config.getint('OpenMotics', 'controller_pipeline_depth')
+
+    read_retries = 1
+    if config.has_option('OpenMotics', 'controller_read_retries'):
+        read_retries = config.getint('OpenMotics', 'controller_read_retries')
+
+    master_communicator = MasterCommunicator(controller_serial, pipeline_depth=pipeline_depth,
+                                             read_retries=read_retries)
     master_communicator.start()
 
     power_controller = PowerController(constants.get_power_database_file())
@@ -108,7 +117,13 @@ def main():
     power_communicator = PowerCommunicator(power_serial, power_controller)
     power_communicator.start()
 
-    gateway_api = GatewayApi(master_communicator, power_communicator, power_controller)
+    power_sample_period = 1.0
+    if config.has_option('OpenMotics', 'power_sample_period'):
+        power_sample_period = config.getfloat('OpenMotics', 'power_sample_period')
+
+    gateway_api = GatewayApi(master_communicator, power_communicator, power_controller,
+                             constants.get_eeprom_cache_database_file(), power_sample_period,
+                             constants.get_energy_store_dir())
 
     maintenance_service = MaintenanceService(gateway_api, constants.get_ssl_private_key_file(),
                                              constants.get_ssl_certificate_file())
@@ -0,0 +1,252 @@
+'''
+OpenMotics - Gateway
+Copyright (C) 2014 - OpenMotics <info@openmotics.com>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+'''
+The EnergyStore keeps the history of the power measurements of the power modules on disk.
+
+@author: fryckbos
+'''
+import logging
+LOGGER = logging.getLogger("openmotics")
+
+import os
+import mmap
+import time
+import struct
+from threading import Lock
+
+class EnergyStore(object):
+    """ Round-robin store for the power of the inputs of the power modules. Each module has one
+    file with a fixed size, the file contains a tier of slots for each resolution. A slot contains
+    the start time of the slot, the number of samples, the average power of the 8 inputs and the
+    increase of the day and night energy counters of the 8 inputs. A sample is added to the current
+    slot of every tier, a slot is overwritten when the time wraps around the tier.
+
+    The last energy counters are kept in the file: the increase of the counters since the last
+    sample (also across restarts) is added to the slot of the new sample, so the counter increases
+    in the history add up to the counters of the module.
+    """
+
+    # (resolution in seconds, number of slots): 1 hour of seconds, 1 day of minutes,
+    # 30 days of quarters and 5 years of days.
+    TIERS = [(1, 3600), (60, 1440), (900, 2880), (86400, 1830)]
+
+    NUM_INPUTS = 8
+
+    MAGIC = 'OMES'
+    VERSION = 2
+    HEADER = struct.Struct('<4sHH')
+    TIER = struct.Struct('<II')
+    HEADER_SIZE = 64
+
+    # The time of the last counters (0 if there are none), the day and the night counters.
+    COUNTERS = struct.Struct('<d%dd' % (2 * NUM_INPUTS))
+
+    # The start of the slot, the number of samples, the average power, the increase of the day
+    # counters and the increase of the night counters.
+    RECORD = struct.Struct('<IH%df' % (3 * NUM_INPUTS))
+
+    def __init__(self, directory, tiers=None):
+        """ Create an EnergyStore.
+
+        :param directory: the directory that contains the files of the modules.
+        :param tiers: list of tuples (resolution, number of slots), ordered from fine to coarse.
+        """
+        self.__directory = directory
+        self.__tiers = tiers if tiers is not None else EnergyStore.TIERS
+
+        self.__offsets = []
+        offset = EnergyStore.HEADER_SIZE + EnergyStore.COUNTERS.size
+        for (_, slots) in self.__tiers:
+            self.__offsets.append(offset)
+            offset += slots * EnergyStore.RECORD.size
+        self.__file_size = offset
+
+        self.__files = {} # module id -> (file, mmap)
+        self.__lock = Lock()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def get_file_size(self):
+        """ Get the size of the file of one module (in bytes). """
+        return self.__file_size
+
+    def __get_header(self):
+        """ Get the header of a file: the magic, version and the tiers. """
+        header = EnergyStore.HEADER.pack(EnergyStore.MAGIC, EnergyStore.VERSION,
+                                         len(self.__tiers))
+        for (resolution, slots) in self.__tiers:
+            header += EnergyStore.TIER.pack(resolution, slots)
+        return header.ljust(EnergyStore.HEADER_SIZE, '\x00')
+
+    def __get_map(self, module_id, create):
+        """ Get the mmap for a module. If create is set, the file is created if it does not exist
+        and a file with a different layout is replaced, otherwise None is returned for a module
+        without a valid file. Should be called while holding the lock. """
+        if module_id not in self.__files:
+            filename = os.path.join(self.__directory, 'module_%d.dat' % module_id)
+            header = self.__get_header()
+
+            if os.path.exists(filename) and os.path.getsize(filename) == self.__file_size:
+                data_file = open(filename, 'r+b')
+                if data_file.read(len(header)) != header:
+                    data_file.close()
+                    data_file = None
+                    if create:
+                        LOGGER.warning("Replacing energy store %s: different layout", filename)
+            else:
+                data_file = None
+
+            if data_file is None:
+                if not create:
+                    return None
+                data_file = open(filename, 'w+b')
+                data_file.write(header)
+                data_file.truncate(self.__file_size)
+                data_file.flush()
+
+            self.__files[module_id] = (data_file, mmap.mmap(data_file.fileno(), self.__file_size))
+
+        return self.__files[module_id][1]
+
+    def add(self, module_id, power, timestamp=None, counters=None):
+        """ Add a sample of the power of the inputs of a module.
+
+        :param module_id: the id of the module.
+        :param power: list with the power (W) of the 8 inputs.
+        :param timestamp: the time of the sample, None for now.
+        :param counters: list with the [day, night] energy counters (Wh) of the 8 inputs, None if \
+        the counters were not read.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.__lock:
+            data = self.__get_map(module_id, True)
+            deltas = self.__update_counters(data, timestamp, counters)
+
+            num = EnergyStore.NUM_INPUTS
+            timestamp = int(timestamp)
+            for (tier, (resolution, slots)) in enumerate(self.__tiers):
+                slot_start = timestamp - timestamp % resolution
+                offset = self.__offsets[tier] + (slot_start / resolution % slots) * \
+                            EnergyStore.RECORD.size
+
+                record = EnergyStore.RECORD.unpack_from(data, offset)
+                if record[0] != slot_start or record[1] == 0:
+                    averages = power
+                    count = 1
+                    increases = deltas
+                else:
+                    count = min(record[1] + 1, 65535)
+                    averages = [average + (value - average) / count
+                                for (average, value) in zip(record[2:2 + num], power)]
+                    increases = [old + delta for (old, delta) in zip(record[2 + num:], deltas)]
+
+                EnergyStore.RECORD.pack_into(data, offset, slot_start, count,
+                                             *(list(averages) + list(increases)))
+
+    @staticmethod
+    def __update_counters(data, timestamp, counters):
+        """ Store the new energy counters of a module and get the increase since the last
+        counters. A counter that decreased was reset, its increase is the new value. Should be
+        called while holding the lock.
+
+        :returns: list with the increase of the 8 day counters followed by the 8 night counters.
+        """
+        num = EnergyStore.NUM_INPUTS
+        if counters is None:
+            return [0.0] * (2 * num)
+
+        new = [counter[0] for counter in counters] + [counter[1] for counter in counters]
+        last = EnergyStore.COUNTERS.unpack_from(data, EnergyStore.HEADER_SIZE)
+        if last[0] == 0:
+            deltas = [0.0] * (2 * num)
+        else:
+            deltas = [value - old if value >= old else value
+                      for (old, value) in zip(last[1:], new)]
+
+        EnergyStore.COUNTERS.pack_into(data, EnergyStore.HEADER_SIZE, timestamp, *new)
+        return deltas
+
+    def get_history(self, module_id, start, end=None, resolution=None):
+        """ Get the average power of the inputs of a module for each slot in [start, end]. Slots
+        without samples are skipped. No file is created for a module without samples.
+
+        :param start: the start of the range (timestamp).
+        :param end: the end of the range (timestamp), None for now.
+        :param resolution: the resolution (in seconds) of the slots, None to use the finest
+        resolution that covers the range.
+        :returns: dict with 'resolution' and 'data': list of [timestamp, [power of the 8 inputs \
+        (W)], [energy of the 8 inputs (Wh)], [[day, night] increase of the energy counters of the \
+        8 inputs (Wh)]]. The energy is the average power times the slot duration.
+        :raises: ValueError if the resolution is not one of the tiers.
+        """
+        now = int(time.time())
+        end = now if end is None else int(end)
+        start = int(start)
+
+        tier = self.__get_tier(start, now, resolution)
+        (resolution, slots) = self.__tiers[tier]
+
+        last_slot = end - end % resolution
+        first_slot = max(start - start % resolution, last_slot - (slots - 1) * resolution)
+
+        num = EnergyStore.NUM_INPUTS
+        output = []
+        with self.__lock:
+            data = self.__get_map(module_id, False)
+            if data is None:
+                return {'resolution' : resolution, 'data' : output}
+
+            for slot_start in xrange(first_slot, last_slot + 1, resolution):
+                offset = self.__offsets[tier] + (slot_start / resolution % slots) * \
+                            EnergyStore.RECORD.size
+                record = EnergyStore.RECORD.unpack_from(data, offset)
+                if record[0] == slot_start and record[1] > 0:
+                    power = list(record[2:2 + num])
+                    (day, night) = (record[2 + num:2 + 2 * num], record[2 + 2 * num:])
+                    output.append([slot_start, power,
+                                   [value * resolution / 3600.0 for value in power],
+                                   [list(counters) for counters in zip(day, night)]])
+
+        return {'resolution' : resolution, 'data' : output}
+
+    def __get_tier(self, start, now, resolution):
+        """ Get the index of the tier for a range that starts at start. """
+        if resolution is not None:
+            for (tier, (tier_resolution, _)) in enumerate(self.__tiers):
+                if tier_resolution == int(resolution):
+                    return tier
+            raise ValueError("Unknown resolution %s, should be one of %s" %
+                             (resolution, [tier[0] for tier in self.__tiers]))
+
+        for (tier, (tier_resolution, slots)) in enumerate(self.__tiers):
+            if now - start < tier_resolution * slots:
+                return tier
+        return len(self.__tiers) - 1
+
+    def close(self):
+        """ Close the files of the EnergyStore. """
+        with self.__lock:
+            for (data_file, data) in self.__files.values():
+                data.close()
+                data_file.close()
+            self.__files = {}
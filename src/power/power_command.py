@@ -40,12 +40,12 @@ CRC_TABLE = [0, 49, 98, 83, 196, 245, 166, 151, 185, 136, 219, 234, 125, 76, 31,
              240, 163, 146, 5, 52, 103, 86, 120, 73, 26, 43, 188, 141, 222, 239, 130, 179, 224, 209,
              70, 119, 36, 21, 59, 10, 89, 104, 255, 206, 157, 172]
 
-def crc7(to_send):
+def crc7(to_send, ret=0):
     """ Calculate the crc7 checksum of a string.
     :param to_send: input string
+    :param ret: the crc7 of the preceding bytes, used to calculate the crc7 incrementally.
     :rtype: integer
     """
-    ret = 0
     for part in to_send:
         ret = CRC_TABLE[ret ^ ord(part)]
     return ret
@@ -54,6 +54,8 @@ def crc7(to_send):
 class PowerCommand(object):
     """ A PowerCommand is an command that can be send to a Power Module over RS485. The commands
     look like this: 'STR' 'E' Address CID Mode(G/S) Type LEN Data CRC7 '\r\n'.
+
+    A PowerCommand is immutable: the commands in power_api are shared by all callers.
     """
 
     def __init__(self, mode, type, input_format, output_format):
@@ -70,6 +72,10 @@ class PowerCommand(object):
         self.input_format = input_format
         self.output_format = output_format
 
+        self.__mode_type = str(mode) + str(type)
+        self.__input_struct = struct.Struct(input_format)
+        self.__output_struct = struct.Struct(output_format)
+
     def create_input(self, address, cid, *data):
         """ Create an input string for the power module using this command and the provided fields.
 
@@ -77,10 +83,9 @@ class PowerCommand(object):
         :param cid: 1 byte, communication id
         :param data: data to send to the power module
         """
-        data = struct.pack(self.input_format, *data)
+        data = self.__input_struct.pack(*data)
 
-        command = "E" + chr(address) + chr(cid) + str(self.mode) + str(self.type)
-        command += chr(len(data)) + str(data)
+        command = "E" + chr(address) + chr(cid) + self.__mode_type + chr(len(data)) + data
         return "STR" + command + chr(crc7(command)) + "\r\n"
 
     def create_output(self, address, cid, *data):
@@ -92,18 +97,17 @@ class PowerCommand(object):
         :type fields: dict
         :rtype: string
         """
-        data = struct.pack(self.output_format, *data)
-        command = "E" + chr(address) + chr(cid) + str(self.mode) + str(self.type)
-        command += chr(len(data)) + str(data)
+        data = self.__output_struct.pack(*data)
+        command = "E" + chr(address) + chr(cid) + self.__mode_type + chr(len(data)) + data
         return "RTR" + command + chr(crc7(command)) + "\r\n"
 
     def check_header(self, header, address, cid):
         """ Check if the header matches the command, when an address and cid is provided. """
-        return header[:-1] == "E" + chr(address) + chr(cid) + str(self.mode) + str(self.type)
+        return header[:-1] == "E" + chr(address) + chr(cid) + self.__mode_type
 
     def check_header_partial(self, header):
         """ Check if the header matches the command, does not check address and cid. """
-        return header[3:-1] == self.mode + self.type
+        return header[3:-1] == self.__mode_type
 
     def read_output(self, data):
         """ Read the output for a command from the serial port.
@@ -111,4 +115,4 @@ class PowerCommand(object):
         :param cid: 1 byte, communication id
         :param serial: serial port interface (instance of pyserial.Serial)
         """
-        return struct.unpack(self.output_format, data)
+        return self.__output_struct.unpack(data)
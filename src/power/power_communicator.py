@@ -32,7 +32,7 @@ import traceback
 import time
 from threading import Thread, Lock
 
-from serial_utils import printable, CommunicationTimedOutException
+from serial_utils import printable, CommunicationTimedOutException, CommunicationStats
 
 import power.power_api as power_api
 from power.power_command import crc7
@@ -41,7 +41,9 @@ from power.time_keeper import TimeKeeper
 class PowerCommunicator(object):
     """ Uses a serial port to communicate with the power modules. """
 
-    def __init__(self, serial, power_controller, verbose=False, time_keeper_period=60,
+    BAUDRATE = 115200
+
+    def __init__(self, serial, power_controller, verbose=False, time_keeper_period=3600,
                  address_mode_timeout=300):
         """ Default constructor.
 
@@ -54,6 +56,9 @@ class PowerCommunicator(object):
         self.__serial_lock = Lock()
         self.__serial_bytes_written = 0
         self.__serial_bytes_read = 0
+        self.__stats = CommunicationStats(PowerCommunicator.BAUDRATE)
+        self.__parser = PowerFrameParser()
+        self.__health = {} # address -> PowerModuleHealth
         self.__cid = 1
 
         self.__address_mode = False
@@ -91,6 +96,30 @@ class PowerCommunicator(object):
         else:
             return time.time() - self.__last_success
 
+    def get_communication_statistics(self):
+        """ Get the communication statistics: latency histograms per command type and per power
+        module, the number of timeouts and crc failures, the time waited for the serial lock and
+        the bus utilisation. See :class`serial_utils.CommunicationStats`. The framing statistics
+        of the :class`PowerFrameParser` are added under 'framing'. """
+        stats = self.__stats.to_dict()
+        stats['framing'] = self.__parser.get_statistics()
+        return stats
+
+    def get_module_health(self):
+        """ Get the health of the power modules that were contacted.
+
+        :returns: dict with the address as key and the dict of :class`PowerModuleHealth` as value.
+        """
+        now = time.time()
+        return dict([(address, health.to_dict(now))
+                     for (address, health) in self.__health.items()])
+
+    def __get_health(self, address):
+        """ Get the PowerModuleHealth for an address. """
+        if address not in self.__health:
+            self.__health[address] = PowerModuleHealth()
+        return self.__health[address]
+
     def __get_cid(self):
         """ Get a communication id """
         (ret, self.__cid) = (self.__cid, (self.__cid % 255) + 1)
@@ -106,6 +135,7 @@ class PowerCommunicator(object):
             print "%.3f writing to power: %s" % (time.time(), printable(data))
         self.__serial.write(data)
         self.__serial_bytes_written += len(data)
+        self.__stats.record_bytes(len(data))
 
     def do_command(self, address, cmd, *data):
         """ Send a command over the serial port and block until an answer is received.
@@ -119,6 +149,8 @@ class PowerCommunicator(object):
         :param *data: data for the command
         :raises: :class`CommunicationTimedOutException` if power module did not respond in time
         :raises: :class`InAddressModeException` if communicator is in address mode
+        :raises: :class`ModuleUnavailableException` if the power module failed repeatedly and is \
+        not probed yet.
         :returns: dict containing the output fields of the command
         """
         if self.__address_mode:
@@ -128,13 +160,24 @@ class PowerCommunicator(object):
             """ Send the command once. """
             cid = self.__get_cid()
             bytes = cmd.create_input(address, cid, *data)
+            action = cmd.mode + cmd.type
 
+            start = time.time()
             self.__write_to_serial(bytes)
 
             if address == power_api.BROADCAST_ADDRESS:
                 return None # No reply on broadcast messages !
             else:
-                (header, data) = self.__read_from_serial()
+                try:
+                    (header, data) = self.__read_from_serial()
+                except CommunicationTimedOutException:
+                    self.__stats.record_failure('timeout', action)
+                    raise
+                except CrcCheckFailedException:
+                    self.__stats.record_failure('crc', action)
+                    raise
+
+                self.__stats.record_command(action, time.time() - start, address)
 
                 if not cmd.check_header(header, address, cid):
                     raise Exception("Header did not match command")
@@ -142,14 +185,35 @@ class PowerCommunicator(object):
                 self.__last_success = time.time()
                 return cmd.read_output(data)
 
+        start = time.time()
         with self.__serial_lock:
+            self.__stats.record_wait(time.time() - start)
+
+            health = None
+            if address != power_api.BROADCAST_ADDRESS:
+                health = self.__get_health(address)
+                if not health.allow(time.time()):
+                    raise ModuleUnavailableException(address)
+
             try:
-                return do_once(address, cmd, *data)
+                try:
+                    ret = do_once(address, cmd, *data)
+                except:
+                    if health is not None and health.is_open():
+                        raise # Probe of an unavailable module: don't retry.
+
+                    # Communication timed out, or header did not match, try again in 100 ms.
+                    print "First communication timed out !"
+                    time.sleep(0.1)
+                    ret = do_once(address, cmd, *data)
             except:
-                # Communication timed out, or header did not match, try again in 100 ms.
-                print "First communication timed out !"
-                time.sleep(0.1)
-                return do_once(address, cmd, *data)
+                if health is not None:
+                    health.record_failure(time.time())
+                raise
+            else:
+                if health is not None:
+                    health.record_success(time.time())
+                return ret
 
     def start_address_mode(self):
         """ Start address mode.
@@ -228,16 +292,13 @@ class PowerCommunicator(object):
         return self.__address_mode
 
     def __read_from_serial(self):
-        """ Read a PowerCommand from the serial port. """
-        phase = 0
-        index = 0
+        """ Read a PowerCommand from the serial port. Bytes that are read after the PowerCommand
+        are kept by the parser for the next read.
 
-        header = ""
-        length = 0
-        data = ""
-        crc = 0
-
-        while phase < 8:
+        :returns: tuple (header, data)
+        """
+        frame = self.__parser.get_frame()
+        while frame is None:
             bytes = self.__serial.read(1)
 
             if bytes == None or len(bytes) == 0:
@@ -248,62 +309,177 @@ class PowerCommunicator(object):
                 bytes += self.__serial.read(num_bytes)
 
             self.__serial_bytes_read += len(bytes)
+            self.__stats.record_bytes(len(bytes))
             if self.__verbose:
                 print "%.3f read from power: %s" % (time.time(), printable(bytes))
 
-            for byte in bytes:
-                if phase == 0:         ## Skip non 'R' bytes
-                    if byte == 'R':
-                        phase = 1
-                    else:
-                        phase = 0
-                elif phase == 1:       ## Expect 'T'
-                    if byte == 'T':
-                        phase = 2
-                    else:
-                        raise Exception("Unexpected character")
-                elif phase == 2:       ## Expect 'R'
-                    if byte == 'R':
-                        phase = 3
-                        index = 0
-                    else:
-                        raise Exception("Unexpected character")
-                elif phase == 3:        ## Read the header fields
-                    header += byte
-                    index += 1
-                    if index == 8:
-                        length = ord(byte)
-                        if length > 0:
-                            phase = 4
-                            index = 0
-                        else:
-                            phase = 5
-                elif phase == 4:        ## Read the data
-                    data += byte
-                    index += 1
-                    if index == length:
-                        phase = 5
-                elif phase == 5:        ## Read the CRC code
-                    crc = ord(byte)
-                    phase = 6
-                elif phase == 6:        ## Expect '\r'
-                    if byte == '\r':
-                        phase = 7
-                    else:
-                        raise Exception("Unexpected character")
-                elif phase == 7:        ## Expect '\n'
-                    if byte == '\n':
-                        phase = 8
-                    else:
-                        raise Exception("Unexpected character")
+            self.__parser.feed(bytes)
+            frame = self.__parser.get_frame()
+
+        return frame
+
+
+class PowerFrameParser(object):
+    """ Parses the frames sent by the power modules: 'RTR' header data crc7 '\r\n'. The header
+    is 8 bytes: 'E' address cid mode type (3 bytes) length. Bytes that are not part of a frame are
+    skipped: after a framing error the parser resynchronizes on the next 'RTR' marker. The bytes
+    after a frame are kept for the next frame. The crc7 of a frame is updated with the header and
+    data bytes as they arrive, every byte is only used once.
+    """
 
-        if crc7(header + data) != crc:
-            raise Exception("CRC doesn't match")
+    MARKER = 'RTR'
+    HEADER_LENGTH = 8
 
-        return (header, data)
+    def __init__(self):
+        """ Default constructor. """
+        self.__buffer = bytearray()
+        self.__statistics = {'frames' : 0, 'skipped_bytes' : 0, 'framing_errors' : 0,
+                             'crc_errors' : 0}
+        self.__reset_crc()
+
+    def __reset_crc(self):
+        """ Start the crc7 for a frame at the start of the buffer. """
+        self.__crc = 0
+        self.__crc_end = len(PowerFrameParser.MARKER) # the bytes before crc_end are in the crc
+
+    def feed(self, data):
+        """ Add bytes read from the serial port. """
+        self.__buffer += data
+
+    def __skip(self, num_bytes):
+        """ Drop bytes that are not part of a frame. """
+        if num_bytes > 0:
+            del self.__buffer[:num_bytes]
+            self.__statistics['skipped_bytes'] += num_bytes
+            self.__reset_crc()
+
+    def get_frame(self):
+        """ Get the next frame from the bytes that were fed to the parser.
+
+        :returns: tuple (header, data), None if no complete frame is available yet.
+        :raises: :class`CrcCheckFailedException` if the crc of the frame does not match, the
+        frame is dropped.
+        """
+        marker_length = len(PowerFrameParser.MARKER)
+        data_start = marker_length + PowerFrameParser.HEADER_LENGTH
+
+        while True:
+            start = self.__buffer.find(PowerFrameParser.MARKER)
+            if start == -1:
+                # Keep the end of the buffer if it is the beginning of a marker.
+                keep = 0
+                for length in range(marker_length - 1, 0, -1):
+                    if self.__buffer.endswith(PowerFrameParser.MARKER[:length]):
+                        keep = length
+                        break
+                self.__skip(len(self.__buffer) - keep)
+                return None
+
+            self.__skip(start)
+            if len(self.__buffer) < data_start:
+                return None
+
+            length = self.__buffer[data_start - 1]
+            end = data_start + length + 3
+            if self.__buffer[marker_length] != ord('E') or \
+                    (len(self.__buffer) >= end and self.__buffer[end - 2:end] != '\r\n'):
+                # Not a frame: skip the marker and look for the next one.
+                self.__statistics['framing_errors'] += 1
+                self.__skip(1)
+                continue
+
+            crc_end = min(len(self.__buffer), data_start + length)
+            if crc_end > self.__crc_end:
+                self.__crc = crc7(str(self.__buffer[self.__crc_end:crc_end]), self.__crc)
+                self.__crc_end = crc_end
+
+            if len(self.__buffer) < end:
+                return None
+
+            header = str(self.__buffer[marker_length:data_start])
+            data = str(self.__buffer[data_start:data_start + length])
+            crc = self.__buffer[data_start + length]
+            del self.__buffer[:end]
+            frame_crc = self.__crc
+            self.__reset_crc()
+
+            if frame_crc != crc:
+                self.__statistics['crc_errors'] += 1
+                raise CrcCheckFailedException()
+
+            self.__statistics['frames'] += 1
+            return (header, data)
+
+    def get_statistics(self):
+        """ Get the number of frames, skipped bytes, framing errors and crc errors. """
+        return dict(self.__statistics)
+
+
+class PowerModuleHealth(object):
+    """ Circuit breaker for a power module. After FAILURE_THRESHOLD failed commands in a row, the
+    module is unavailable: commands fail immediately, except for one probe after a backoff. The
+    backoff starts at BACKOFF seconds and doubles after every failed probe, up to MAX_BACKOFF.
+    """
+
+    FAILURE_THRESHOLD = 3
+    BACKOFF = 5.0
+    MAX_BACKOFF = 300.0
+
+    def __init__(self):
+        """ Default constructor. """
+        self.__failures = 0
+        self.__last_success = None
+        self.__probe_at = 0
+
+    def is_open(self):
+        """ Check if the module is unavailable. """
+        return self.__failures >= PowerModuleHealth.FAILURE_THRESHOLD
+
+    def allow(self, now):
+        """ Check if a command can be sent to the module. """
+        return not self.is_open() or now >= self.__probe_at
+
+    def record_success(self, now):
+        """ Record a successful command. """
+        self.__failures = 0
+        self.__last_success = now
+
+    def record_failure(self, now):
+        """ Record a failed command. """
+        self.__failures += 1
+        if self.is_open():
+            backoff = PowerModuleHealth.BACKOFF * \
+                        2 ** min(self.__failures - PowerModuleHealth.FAILURE_THRESHOLD, 16)
+            self.__probe_at = now + min(backoff, PowerModuleHealth.MAX_BACKOFF)
+
+    def to_dict(self, now):
+        """ Get the state ('ok', 'failing' or 'unavailable'), the number of failures in a row, the
+        time of the last success and the number of seconds until the next probe. """
+        if self.is_open():
+            state = 'unavailable'
+        elif self.__failures > 0:
+            state = 'failing'
+        else:
+            state = 'ok'
+
+        return {'state' : state, 'failures' : self.__failures,
+                'last_success' : self.__last_success,
+                'next_probe' : max(0, self.__probe_at - now) if self.is_open() else 0}
 
 
 class InAddressModeException(Exception):
     """ Raised when the power communication is in address mode. """
     def __init__(self):
         Exception.__init__(self)
+
+
+class ModuleUnavailableException(Exception):
+    """ Raised when a command is sent to a power module that failed repeatedly. """
+    def __init__(self, address):
+        Exception.__init__(self, "Power module %s is unavailable" % address)
+
+
+class CrcCheckFailedException(Exception):
+    """ Raised when the CRC of a message from a power module does not match. """
+    def __init__(self):
+        Exception.__init__(self, "CRC doesn't match")
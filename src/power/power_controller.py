@@ -24,9 +24,60 @@ power modules and their address.
 
 import sqlite3
 import os.path
+from threading import Lock
+
+NUM_INPUTS = 8
+
+class PowerModule(object):
+    """ The configuration of a power module: the name, the address and the name, sensor type and
+    time configuration of each input. """
+
+    def __init__(self, id, address, name=u'', inputs=None, sensors=None, times=None):
+        """ Create a PowerModule, the inputs, sensors and times are lists with 8 elements. """
+        self.id = id
+        self.address = address
+        self.name = name
+        self.inputs = inputs if inputs is not None else [u''] * NUM_INPUTS
+        self.sensors = sensors if sensors is not None else [0] * NUM_INPUTS
+        self.times = times if times is not None else [None] * NUM_INPUTS
+
+    @staticmethod
+    def from_row(row):
+        """ Create a PowerModule from a row with the columns of get_columns(). """
+        return PowerModule(row[0], row[2], row[1], list(row[3:11]), list(row[11:19]),
+                           list(row[19:27]))
+
+    @staticmethod
+    def from_dict(module, id, address):
+        """ Create a PowerModule from a dict with the keys of to_dict(), without id and address.
+        """
+        return PowerModule(id, address, module['name'],
+                           [module['input%d' % i] for i in range(NUM_INPUTS)],
+                           [module['sensor%d' % i] for i in range(NUM_INPUTS)],
+                           [module['times%d' % i] for i in range(NUM_INPUTS)])
+
+    @staticmethod
+    def get_columns():
+        """ Get the names of the columns of the power_modules table. """
+        return ['id', 'name', 'address'] + ['input%d' % i for i in range(NUM_INPUTS)] + \
+               ['sensor%d' % i for i in range(NUM_INPUTS)] + \
+               ['times%d' % i for i in range(NUM_INPUTS)]
+
+    def to_dict(self):
+        """ Get a new dict with the columns of the power module as keys. """
+        output = {'id': self.id, 'name': self.name, 'address': self.address}
+        for i in range(NUM_INPUTS):
+            output['input%d' % i] = self.inputs[i]
+            output['sensor%d' % i] = self.sensors[i]
+            output['times%d' % i] = self.times[i]
+        return output
+
 
 class PowerController(object):
-    """ The PowerController keeps track of the registered power modules. """
+    """ The PowerController keeps track of the registered power modules. The modules are loaded
+    from the database when the PowerController is created and kept in memory, changes are written
+    through to the database. The PowerController assumes it is the only writer of the database.
+    """
 
     def __init__(self, db_filename):
         """ Constructor a new PowerController.
@@ -40,6 +91,12 @@ class PowerController(object):
         if new_database:
             self.__create_tables()
 
+        self.__lock = Lock()
+        self.__modules = {} # id -> PowerModule
+        self.__addresses = {} # address -> PowerModule
+        self.__listeners = []
+        self.__load()
+
     def __create_tables(self):
         """ Create the power tables. """
         self.__cursor.execute("CREATE TABLE power_modules (id INTEGER PRIMARY KEY, "
@@ -55,42 +112,46 @@ class PowerController(object):
                               "times0 TEXT, times1 TEXT, times2 TEXT, times3 TEXT, "
                               "times4 TEXT, times5 TEXT, times6 TEXT, times7 TEXT );")
 
+    def __load(self):
+        """ Load the power modules from the database. """
+        query = "SELECT %s FROM power_modules;" % ", ".join(PowerModule.get_columns())
+        for row in self.__cursor.execute(query):
+            self.__add(PowerModule.from_row(row))
+
+    def __add(self, module):
+        """ Add a PowerModule to the in-memory registry. """
+        self.__modules[module.id] = module
+        self.__addresses[module.address] = module
+
+    def add_change_listener(self, listener):
+        """ Add a listener that is called (without arguments) after a module was added or changed.
+        """
+        self.__listeners.append(listener)
+
+    def __notify(self):
+        """ Call the change listeners, this should not happen while holding the lock. """
+        for listener in self.__listeners:
+            listener()
+
     def get_power_modules(self):
         """ Get a dict containing all power modules. The key of the dict is the id of the module,
         the value is a dict containing 'id', 'name', 'address', 'input0', 'input1', 'input2',
         'input3', 'input4', 'input5', 'input6', 'input7', 'sensor0', 'sensor1', 'sensor2',
         'sensor3', 'sensor4', 'sensor5', 'sensor6', 'sensor7', 'times0', 'times1', 'times2',
-        'times3', 'times4', 'times5', 'times6', 'times7'.
+        'times3', 'times4', 'times5', 'times6', 'times7'. The dicts are copies, they can be
+        changed by the caller.
         """
-        power_modules = {}
-        for row in self.__cursor.execute("SELECT id, name, address, input0, input1, input2, "
-                                         "input3, input4, input5, input6, input7, sensor0, "
-                                         "sensor1, sensor2, sensor3, sensor4, sensor5, sensor6, "
-                                         "sensor7, times0, times1, times2, times3, times4, "
-                                         "times5, times6, times7 FROM power_modules;"):
-            power_modules[row[0]] = {'id': row[0], 'name': row[1], 'address': row[2],
-                                     'input0': row[3], 'input1': row[4], 'input2': row[5],
-                                     'input3':row[6], 'input4':row[7], 'input5': row[8],
-                                     'input6':row[9], 'input7':row[10],
-                                     'sensor0': row[11], 'sensor1': row[12], 'sensor2': row[13],
-                                     'sensor3':row[14], 'sensor4':row[15], 'sensor5': row[16],
-                                     'sensor6':row[17], 'sensor7':row[18], 'times0':row[19],
-                                     'times1':row[20], 'times2':row[21], 'times3':row[22],
-                                     'times4':row[23], 'times5':row[24], 'times6':row[25],
-                                     'times7':row[26]}
-        return power_modules
+        with self.__lock:
+            return dict([(module.id, module.to_dict()) for module in self.__modules.values()])
 
     def get_address(self, id):
         """ Get the address of a module when the module id is provided. """
-        for row in self.__cursor.execute("SELECT address FROM power_modules WHERE id=?;",
-                                         (id,)):
-            return row[0]
+        module = self.__modules.get(id)
+        return module.address if module is not None else None
 
     def module_exists(self, address):
         """ Check if a module with a certain address exists. """
-        for row in self.__cursor.execute("SELECT count(id) FROM power_modules WHERE address=?;",
-                                         (address,)):
-            return row[0] > 0
+        return address in self.__addresses
 
     def update_power_module(self, module):
         """ Update the name and names of the inputs of the power module.
@@ -100,39 +161,54 @@ class PowerController(object):
         'sensor3', 'sensor4', 'sensor5', 'sensor6', 'sensor7', 'times0', 'times1', 'times2', \
         'times3', 'times4', 'times5', 'times6', 'times7'.
         """
-        self.__cursor.execute("UPDATE power_modules SET "
-                              "name=?, input0=?, input1=?, input2=?, input3=?, "
-                              "input4=?, input5=?, input6=?, input7=?, sensor0=?, sensor1=?, "
-                              "sensor2=?, sensor3=?, sensor4=?, sensor5=?, sensor6=?, sensor7=?, "
-                              "times0=?, times1=?, times2=?, times3=?, times4=?, times5=?, "
-                              "times6=?, times7=? WHERE id=?;",
-                              (module['name'], module['input0'], module['input1'],
-                               module['input2'], module['input3'], module['input4'],
-                               module['input5'], module['input6'], module['input7'],
-                               module['sensor0'], module['sensor1'], module['sensor2'],
-                               module['sensor3'], module['sensor4'], module['sensor5'],
-                               module['sensor6'], module['sensor7'], module['times0'],
-                               module['times1'], module['times2'], module['times3'],
-                               module['times4'], module['times5'], module['times6'],
-                               module['times7'], module['id']))
-        self.__connection.commit()
+        with self.__lock:
+            self.__cursor.execute("UPDATE power_modules SET "
+                                  "name=?, input0=?, input1=?, input2=?, input3=?, "
+                                  "input4=?, input5=?, input6=?, input7=?, sensor0=?, sensor1=?, "
+                                  "sensor2=?, sensor3=?, sensor4=?, sensor5=?, sensor6=?, "
+                                  "sensor7=?, times0=?, times1=?, times2=?, times3=?, times4=?, "
+                                  "times5=?, times6=?, times7=? WHERE id=?;",
+                                  (module['name'], module['input0'], module['input1'],
+                                   module['input2'], module['input3'], module['input4'],
+                                   module['input5'], module['input6'], module['input7'],
+                                   module['sensor0'], module['sensor1'], module['sensor2'],
+                                   module['sensor3'], module['sensor4'], module['sensor5'],
+                                   module['sensor6'], module['sensor7'], module['times0'],
+                                   module['times1'], module['times2'], module['times3'],
+                                   module['times4'], module['times5'], module['times6'],
+                                   module['times7'], module['id']))
+            self.__connection.commit()
+
+            old = self.__modules.get(module['id'])
+            if old is not None:
+                self.__add(PowerModule.from_dict(module, old.id, old.address))
+        self.__notify()
 
     def register_power_module(self, address):
         """ Register a new power module using an address. """
-        self.__cursor.execute("INSERT INTO power_modules(address) VALUES (?);", (address,))
-        self.__connection.commit()
+        with self.__lock:
+            self.__cursor.execute("INSERT INTO power_modules(address) VALUES (?);", (address,))
+            self.__connection.commit()
+            self.__add(PowerModule(self.__cursor.lastrowid, address))
+        self.__notify()
 
     def readdress_power_module(self, old_address, new_address):
         """ Change the address of a power module. """
-        self.__cursor.execute("UPDATE power_modules SET address=? WHERE address=?;",
-                              (new_address, old_address))
-        self.__connection.commit()
+        with self.__lock:
+            self.__cursor.execute("UPDATE power_modules SET address=? WHERE address=?;",
+                                  (new_address, old_address))
+            self.__connection.commit()
+
+            for module in self.__modules.values():
+                if module.address == old_address:
+                    module.address = new_address
+            self.__addresses = dict([(module.address, module)
+                                     for module in self.__modules.values()])
+        self.__notify()
 
     def get_free_address(self):
         """ Get a free address for a power module. """
-        max_address = 0
-        for row in self.__cursor.execute("SELECT address FROM power_modules;"):
-            max_address = max(max_address, row[0])
+        max_address = max(self.__addresses.keys()) if len(self.__addresses) > 0 else 0
         return max_address + 1 if max_address < 255 else 1
 
     def close(self):
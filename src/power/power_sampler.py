@@ -0,0 +1,281 @@
+'''
+OpenMotics - Gateway
+Copyright (C) 2014 - OpenMotics <info@openmotics.com>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+'''
+The PowerSampler reads the realtime power values of the power modules in a background thread.
+
+@author: fryckbos
+'''
+import logging
+LOGGER = logging.getLogger("openmotics")
+
+import time
+import math
+from threading import Thread, Lock, Event
+
+import power.power_api as power_api
+from power.power_communicator import ModuleUnavailableException
+
+class PowerSampler(object):
+    """ The PowerSampler samples the realtime power values (voltage, frequency, current and power)
+    of the power modules in a background thread. Every period one module is sampled, the modules
+    are sampled round-robin: the load on the RS485 bus does not depend on the number of clients
+    that read the realtime power. The last sample of each module is kept in memory, the power
+    of the samples is added to the :class`EnergyStore` if one is provided, together with the
+    energy counters that are read with every sample in that case. Readers never sample
+    the modules themselves: they get the last samples with their timestamps, too old samples are
+    sampled by the background thread as soon as possible. The last energy
+    counters that were read are kept as well, they are returned for modules that do not respond.
+    """
+
+    def __init__(self, power_communicator, power_controller, period=1.0, energy_store=None):
+        """ Create a PowerSampler.
+
+        :param period: the number of seconds between sampling two modules.
+        :param energy_store: instance of :class`EnergyStore` or None.
+        """
+        self.__power_communicator = power_communicator
+        self.__power_controller = power_controller
+        self.__period = period
+        self.__energy_store = energy_store
+
+        self.__samples = {} # module id -> (timestamp, values)
+        self.__failed = set() # ids of the modules for which the last sample failed
+        self.__energy = {} # module id -> (timestamp, energy counters)
+        self.__energy_failed = set() # ids of the modules for which the last energy read failed
+        self.__samples_lock = Lock()
+        self.__next_index = 0
+        self.__refresh = set() # ids of the modules that are sampled before the next module
+
+        self.__thread = None
+        self.__stop = False
+        self.__wakeup = Event()
+
+    def start(self):
+        """ Start the background thread of the PowerSampler. """
+        if self.__thread == None:
+            LOGGER.info("Starting PowerSampler")
+            self.__stop = False
+            self.__thread = Thread(target=self.__run, name="PowerSampler thread")
+            self.__thread.daemon = True
+            self.__thread.start()
+        else:
+            raise Exception("PowerSampler thread already running.")
+
+    def stop(self):
+        """ Stop the background thread of the PowerSampler. """
+        if self.__thread != None:
+            self.__stop = True
+            self.__wakeup.set()
+        else:
+            raise Exception("PowerSampler thread not running.")
+
+    def __run(self):
+        """ Code for the background thread. """
+        while not self.__stop:
+            self.__wakeup.clear()
+            try:
+                self.sample_next()
+            except:
+                LOGGER.exception("Exception in PowerSampler")
+
+            with self.__samples_lock:
+                refresh = len(self.__refresh) > 0
+            if not refresh and not self.__stop:
+                self.__wakeup.wait(self.__period)
+
+        LOGGER.info("Stopped PowerSampler")
+        self.__thread = None
+
+    def sample_next(self):
+        """ Sample the next module: the modules with a too old sample for a reader come first,
+        the other modules are sampled in the order of their id. """
+        modules = self.__power_controller.get_power_modules()
+        self.__remove_old_modules(modules)
+        if len(modules) == 0:
+            return
+
+        with self.__samples_lock:
+            refresh = sorted(self.__refresh)
+            module_id = refresh[0] if len(refresh) > 0 else None
+            self.__refresh.discard(module_id)
+
+        if module_id is None:
+            ids = sorted(modules.keys())
+            module_id = ids[self.__next_index % len(ids)]
+            self.__next_index = (self.__next_index + 1) % len(ids)
+
+        self.__try_sample(module_id, modules[module_id]['address'])
+
+    def __remove_old_modules(self, modules):
+        """ Remove the samples of modules that are no longer registered. """
+        with self.__samples_lock:
+            for cache in [self.__samples, self.__energy]:
+                for module_id in cache.keys():
+                    if module_id not in modules:
+                        del cache[module_id]
+            self.__failed.intersection_update(modules.keys())
+            self.__refresh.intersection_update(modules.keys())
+            self.__energy_failed.intersection_update(modules.keys())
+
+    def __sample(self, module_id, address):
+        """ Read the realtime power values of a module and store them.
+
+        :returns: list with [voltage, frequency, current, power] for each input of the module.
+        """
+        volt = self.__power_communicator.do_command(address, power_api.get_voltage())[0]
+        freq = self.__power_communicator.do_command(address, power_api.get_frequency())[0]
+        current = self.__power_communicator.do_command(address, power_api.get_current())
+        power = self.__power_communicator.do_command(address, power_api.get_power())
+
+        values = []
+        for i in range(0, 8):
+            values.append([convert_nan(volt), convert_nan(freq), convert_nan(current[i]),
+                           convert_nan(power[i])])
+
+        counters = None
+        if self.__energy_store is not None:
+            counters = self.__read_energy(address)
+
+        now = time.time()
+        with self.__samples_lock:
+            self.__samples[module_id] = (now, values)
+            self.__failed.discard(module_id)
+            if counters is not None:
+                self.__energy[module_id] = (now, counters)
+                self.__energy_failed.discard(module_id)
+
+        if self.__energy_store is not None:
+            self.__energy_store.add(module_id, [value[3] for value in values], now, counters)
+
+        return values
+
+    def __read_energy(self, address):
+        """ Read the energy counters of a module.
+
+        :returns: list with [day, night] for each input of the module.
+        """
+        day = self.__power_communicator.do_command(address, power_api.get_day_energy())
+        night = self.__power_communicator.do_command(address, power_api.get_night_energy())
+        return [[convert_nan(day[i]), convert_nan(night[i])] for i in range(0, 8)]
+
+    def __try_sample(self, module_id, address):
+        """ Sample a module, errors are logged.
+
+        :returns: the values, None if the module could not be sampled.
+        """
+        try:
+            return self.__sample(module_id, address)
+        except ModuleUnavailableException:
+            pass # The module failed before, it is probed by the PowerCommunicator.
+        except Exception as exception:
+            LOGGER.error("Got Exception for power module %s: %s", module_id, exception)
+
+        with self.__samples_lock:
+            self.__failed.add(module_id)
+        return None
+
+    def get_realtime_power(self, max_age=None):
+        """ Get the last realtime power values of all modules, the modules are not sampled by the
+        caller. The modules without a sample, or with a sample that is older than max_age seconds,
+        are sampled by the background thread as soon as possible. If the background thread is not
+        running, the caller samples these modules.
+
+        :param max_age: the maximum age of the samples in seconds, None to use the last sample.
+        :returns: tuple (dict with the module id as key and the following array as value: \
+        [voltage, frequency, current, power], dict with the module id as key and the time of \
+        the sample as value, list of the ids of the stale modules). A module is stale if the \
+        last sample failed.
+        """
+        now = time.time()
+        modules = self.__power_controller.get_power_modules()
+
+        with self.__samples_lock:
+            old = [module_id for module_id in sorted(modules.keys())
+                   if module_id not in self.__samples or \
+                      (max_age is not None and now - self.__samples[module_id][0] > max_age)]
+
+        if self.__thread is None:
+            for module_id in old:
+                self.__try_sample(module_id, modules[module_id]['address'])
+        elif len(old) > 0:
+            with self.__samples_lock:
+                self.__refresh.update(old)
+            self.__wakeup.set()
+
+        (output, timestamps, stale) = (dict(), dict(), [])
+        with self.__samples_lock:
+            for module_id in sorted(modules.keys()):
+                if module_id in self.__samples:
+                    (timestamps[str(module_id)], output[str(module_id)]) = \
+                        self.__samples[module_id]
+                if module_id in self.__failed:
+                    stale.append(str(module_id))
+
+        return (output, timestamps, stale)
+
+    def get_stale(self):
+        """ Get the ids of the modules for which the last sample failed.
+
+        :returns: sorted list of module ids (strings).
+        """
+        with self.__samples_lock:
+            return [str(module_id) for module_id in sorted(self.__failed)]
+
+    def read_total_energy(self):
+        """ Read the energy counters (day and night) of all modules. For the modules that do not
+        respond, the last counters that were read are returned and the module is stale.
+
+        :returns: tuple (dict with the module id as key and the following array as value: \
+        [day, night] for each input, dict with the module id as key and the time the counters \
+        were read as value, list of the ids of the stale modules).
+        """
+        modules = self.__power_controller.get_power_modules()
+        self.__remove_old_modules(modules)
+
+        for module_id in sorted(modules.keys()):
+            address = modules[module_id]['address']
+            values = None
+            try:
+                values = self.__read_energy(address)
+            except ModuleUnavailableException:
+                pass # The module failed before, it is probed by the PowerCommunicator.
+            except Exception as exception:
+                LOGGER.error("Got Exception for power module %s: %s", module_id, exception)
+
+            with self.__samples_lock:
+                if values is None:
+                    self.__energy_failed.add(module_id)
+                else:
+                    self.__energy[module_id] = (time.time(), values)
+                    self.__energy_failed.discard(module_id)
+
+        with self.__samples_lock:
+            output = dict([(str(module_id), values)
+                           for (module_id, (_, values)) in self.__energy.items()])
+            timestamps = dict([(str(module_id), timestamp)
+                               for (module_id, (timestamp, _)) in self.__energy.items()])
+            stale = [str(module_id) for module_id in sorted(self.__energy_failed)]
+
+        return (output, timestamps, stale)
+
+
+def convert_nan(number):
+    """ Convert nan to 0. """
+    return 0.0 if math.isnan(number) else number
@@ -26,23 +26,42 @@ import logging
 LOGGER = logging.getLogger("openmotics")
 
 import time
+from bisect import bisect_right
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Event
 
 import power.power_api as power_api
 
+MINUTES_PER_WEEK = 7 * 24 * 60
+
 class TimeKeeper(object):
-    """ The TimeKeeper keeps track of time and sets the day or night mode on the power modules. """
+    """ The TimeKeeper keeps track of time and sets the day or night mode on the power modules.
+    The background thread sleeps until the next day/night transition of the modules. The
+    PowerController wakes the thread when a module is added or changed. The mode is only sent to
+    a module when it changes, a mode that could not be set is retried after RETRY_DELAY seconds.
+    """
+
+    RETRY_DELAY = 60
 
     def __init__(self, power_communicator, power_controller, period):
+        """ Create a TimeKeeper.
+
+        :param period: the maximum number of seconds the thread sleeps, this guards against \
+        changes of the clock (eg. daylight saving time).
+        """
         self.__power_communicator = power_communicator
         self.__power_controller = power_controller
         self.__period = period
 
         self.__mode = {}
+        self.__schedules = {} # times -> Schedule
 
         self.__thread = None
         self.__stop = False
+        self.__wakeup = Event()
+
+        if power_controller is not None:
+            power_controller.add_change_listener(self.wakeup)
 
     def start(self):
         """ Start the background thread of the TimeKeeper. """
@@ -59,53 +78,166 @@ class TimeKeeper(object):
         """ Stop the background thread in the TimeKeeper. """
         if self.__thread != None:
             self.__stop = True
+            self.__wakeup.set()
         else:
             raise Exception("TimeKeeper thread not running.")
 
+    def wakeup(self):
+        """ Wake the background thread: the modes are set again for the current configuration of
+        the power modules. """
+        self.__wakeup.set()
+
     def __run(self):
         """ Code for the background thread. """
         while not self.__stop:
+            self.__wakeup.clear()
+            timeout = TimeKeeper.RETRY_DELAY
             try:
-                self.__run_once()
+                timeout = self.run_once(datetime.now())
             except:
                 LOGGER.exception("Exception in TimeKeeper")
 
-            time.sleep(self.__period)
+            if not self.__stop:
+                self.__wakeup.wait(min(timeout, self.__period))
 
         LOGGER.info("Stopped TimeKeeper")
         self.__thread = None
 
-    def __run_once(self):
-        """ One run of the background thread. """
-        date = datetime.now()
+    def run_once(self, date):
+        """ Set the mode of the power modules for a date.
+
+        :returns: the number of seconds until the next day/night transition, at most RETRY_DELAY \
+        if the mode could not be set on a module.
+        """
+        minute = get_minute_of_week(date)
+        until_next = MINUTES_PER_WEEK
+
+        schedules = {}
+        modes = {}
         for module in self.__power_controller.get_power_modules().values():
             daynight = []
             for i in range(8):
-                if self.is_day_time(module['times%d' % i], date):
-                    daynight.append(power_api.DAY)
-                else:
-                    daynight.append(power_api.NIGHT)
+                times = module['times%d' % i]
+                schedule = schedules.get(times) or self.__schedules.get(times) or \
+                                Schedule(times)
+                schedules[times] = schedule
+
+                daynight.append(power_api.DAY if schedule.is_day(minute) else power_api.NIGHT)
+                until_next = min(until_next, schedule.get_minutes_to_next(minute))
+
+            modes[module['address']] = daynight
 
-            self.__set_mode(module['address'], daynight)
+        self.__schedules = schedules
+        timeout = until_next * 60 - date.second - date.microsecond / 1000000.0
+        if not self.__set_modes(modes):
+            timeout = min(timeout, TimeKeeper.RETRY_DELAY)
+        return timeout
 
     def is_day_time(self, times, date):
         """ Check if a date is in day time. """
-        if times == None:
-            times = [0 for _ in range(14)]
-        else:
-            times = [int(t.replace(":", "")) for t in times.split(",")]
+        schedule = self.__schedules.get(times) or Schedule(times)
+        return schedule.is_day(get_minute_of_week(date))
 
-        day_of_week = date.weekday() # 0 = Monday, 6 = Sunday
-        current_time = date.hour * 100 + date.minute
+    def __set_modes(self, modes):
+        """ Set the modes of the power modules (dict with address as key). If the mode changes
+        on more than one module and all modules get the same mode, the mode is broadcasted.
 
-        start = times[day_of_week * 2]
-        stop = times[day_of_week * 2 + 1]
+        :returns: False if the mode could not be set on a module.
+        """
+        changed = [address for (address, bytes) in modes.items()
+                   if self.__mode.get(address) != bytes]
 
-        return current_time >= start and current_time < stop
+        if len(changed) > 1 and all([bytes == modes[changed[0]] for bytes in modes.values()]):
+            bytes = modes[changed[0]]
+            LOGGER.info("Setting day/night mode to " + str(bytes) + " on all modules")
+            try:
+                self.__power_communicator.do_command(power_api.BROADCAST_ADDRESS,
+                                                     power_api.set_day_night(), *bytes)
+            except Exception as exception:
+                LOGGER.error("Could not broadcast day/night mode to the power modules: %s",
+                             exception)
+                return False
+            self.__mode = dict([(address, bytes) for address in modes])
+            return True
+
+        success = True
+        for address in changed:
+            try:
+                self.__set_mode(address, modes[address])
+            except Exception as exception:
+                LOGGER.error("Could not set day/night mode on power module %s: %s",
+                             address, exception)
+                success = False
+        return success
 
     def __set_mode(self, address, bytes):
         """ Set the power modules mode. """
-        if address not in self.__mode or self.__mode[address] != bytes:
-            LOGGER.info("Setting day/night mode to " + str(bytes))
-            self.__power_communicator.do_command(address, power_api.set_day_night(), *bytes)
-            self.__mode[address] = bytes
+        LOGGER.info("Setting day/night mode to " + str(bytes))
+        self.__power_communicator.do_command(address, power_api.set_day_night(), *bytes)
+        self.__mode[address] = bytes
+
+
+class Schedule(object):
+    """ The day time of a power module input, compiled to a table of day/night transitions
+    in minutes since the start of the week (Monday 00:00). """
+
+    def __init__(self, times):
+        """ Compile the times of an input.
+
+        :param times: comma separated string with the start and stop (HH:MM) of the day time for \
+        each day of the week starting on Monday, None for no day time. Days with a malformed or \
+        missing start or stop have no day time.
+        """
+        transitions = []
+        if times:
+            minutes = [parse_time(t) for t in times.split(",")]
+            if len(minutes) != 14 or None in minutes:
+                LOGGER.warning("Invalid day/night times for power module input: %s", times)
+
+            for day in range(min(7, len(minutes) / 2)):
+                (start, stop) = (minutes[day * 2], minutes[day * 2 + 1])
+                if start is not None and stop is not None and start < stop:
+                    transitions.append(((day * 1440 + start) % MINUTES_PER_WEEK, power_api.DAY))
+                    transitions.append(((day * 1440 + stop) % MINUTES_PER_WEEK, power_api.NIGHT))
+
+        # A day that stops at 24:00 and a day that starts at 00:00 are contiguous: the NIGHT
+        # transition sorts before the DAY transition on the same minute.
+        transitions.sort()
+        self.__minutes = [minute for (minute, _) in transitions]
+        self.__modes = [mode for (_, mode) in transitions]
+
+    def is_day(self, minute):
+        """ Check if a minute of the week is in day time. """
+        if len(self.__minutes) == 0:
+            return False
+        index = bisect_right(self.__minutes, minute) - 1 # -1 wraps to last week
+        return self.__modes[index] == power_api.DAY
+
+    def get_minutes_to_next(self, minute):
+        """ Get the number of minutes from a minute of the week to the next transition. """
+        if len(self.__minutes) == 0:
+            return MINUTES_PER_WEEK
+        index = bisect_right(self.__minutes, minute)
+        if index == len(self.__minutes):
+            return self.__minutes[0] + MINUTES_PER_WEEK - minute
+        return self.__minutes[index] - minute
+
+
+def parse_time(time_string):
+    """ Parse a time (HH:MM) to the number of minutes since midnight.
+
+    :returns: the number of minutes in [0, 1440], None if the time is malformed.
+    """
+    parts = time_string.strip().split(":")
+    if len(parts) != 2 or not parts[0].isdigit() or not parts[1].isdigit():
+        return None
+
+    (hours, minutes) = (int(parts[0]), int(parts[1]))
+    if minutes >= 60 or hours * 60 + minutes > 1440:
+        return None
+    return hours * 60 + minutes
+
+
+def get_minute_of_week(date):
+    """ Get the number of minutes since the start of the week (Monday 00:00) of a date. """
+    return date.weekday() * 1440 + date.hour * 60 + date.minute
@@ -18,14 +18,21 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
 """
-Serial tools contains the RS485 wrapper, printable and CommunicationTimedOutException.
+Serial tools contains the RS485 wrapper, printable, CommunicationTimedOutException, the
+transports that are used by the read threads and the communication statistics.
 
 Created on Dec 29, 2012
 
 @author: fryckbos
 """
+import io
+import time
 import struct
 import fcntl
+import select
+from bisect import bisect_left
+from threading import Lock
+from collections import deque
 
 class CommunicationTimedOutException(Exception):
     """ An exception that is raised when the master did not respond in time. """
@@ -61,3 +68,238 @@ class RS485(object):
     def inWaiting(self): #pylint: disable=C0103
         """ Get the number of bytes pending to be read """
         return self.__serial.inWaiting()
+
+
+class PollTransport(object):
+    """ Transport for file descriptor backed streams: a pyserial Serial, a pty or a socket. The
+    transport waits for data using poll and drains all available bytes into the receive buffer
+    using a single read call.
+
+    A transport provides write(data) and recv_into(buffer): recv_into blocks until data is
+    available (or the timeout expires) and returns the number of bytes that were put in buffer.
+    """
+
+    def __init__(self, stream, timeout=1.0):
+        """ Create a PollTransport.
+
+        :param stream: object with fileno(), a write(data) or sendall(data) method is used to write.
+        :param timeout: the maximum number of seconds recv_into blocks, the read thread checks \
+        whether it should stop after every timeout.
+        """
+        self.__stream = stream
+        self.__timeout_ms = int(timeout * 1000)
+        self.__poll = select.poll()
+        self.__poll.register(stream.fileno(), select.POLLIN | select.POLLPRI)
+
+        if hasattr(stream, 'sendall'):
+            self.__write = stream.sendall
+            self.__readinto = stream.recv_into
+        else:
+            self.__write = stream.write
+            self.__readinto = io.FileIO(stream.fileno(), 'r', closefd=False).readinto
+
+    def write(self, data):
+        """ Write data to the stream. """
+        self.__write(data)
+
+    def recv_into(self, buffer, timeout=None):
+        """ Wait for data and read all available bytes (up to len(buffer)) into buffer.
+
+        :param timeout: the maximum number of seconds to wait, None for the transport timeout.
+        :returns: the number of bytes read, 0 if no data was received within the timeout.
+        :raises: IOError if the other end of the stream was closed.
+        """
+        timeout_ms = self.__timeout_ms if timeout is None else int(timeout * 1000)
+        if len(self.__poll.poll(timeout_ms)) == 0:
+            return 0
+
+        num_bytes = self.__readinto(buffer)
+        if num_bytes == 0:
+            raise IOError("The stream was closed")
+        return num_bytes if num_bytes is not None else 0
+
+
+class BlockingTransport(object):
+    """ Transport for objects that only replicate the pyserial read and inWaiting interface: one
+    byte is read blocking, the remaining bytes are read using inWaiting. """
+
+    POLL_INTERVAL = 0.005
+
+    def __init__(self, serial):
+        """ Create a BlockingTransport for serial. """
+        self.__serial = serial
+
+    def write(self, data):
+        """ Write data to the serial port. """
+        self.__serial.write(data)
+
+    def recv_into(self, buffer, timeout=None):
+        """ Read at least one byte into buffer.
+
+        :param timeout: if not None, the maximum number of seconds to wait for the first byte.
+        :returns: the number of bytes read, 0 if no data was received within the timeout.
+        """
+        if timeout is not None:
+            end = time.time() + timeout
+            while self.__serial.inWaiting() == 0:
+                if time.time() >= end:
+                    return 0
+                time.sleep(BlockingTransport.POLL_INTERVAL)
+
+        data = self.__serial.read(1)
+        num_bytes = min(self.__serial.inWaiting(), len(buffer) - len(data))
+        if num_bytes > 0:
+            data += self.__serial.read(num_bytes)
+
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def get_transport(serial):
+    """ Get the transport for a serial port: a PollTransport if the port has a file descriptor, a
+    BlockingTransport otherwise. Transports are returned as is.
+    """
+    if isinstance(serial, (PollTransport, BlockingTransport)):
+        return serial
+    elif hasattr(serial, 'fileno'):
+        return PollTransport(serial)
+    else:
+        return BlockingTransport(serial)
+
+
+class LatencyHistogram(object):
+    """ Histogram of latencies with fixed buckets, adding a sample is a bisect and two
+    additions. """
+
+    BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+
+    def __init__(self):
+        self.__counts = [0] * (len(LatencyHistogram.BOUNDS) + 1)
+        self.__count = 0
+        self.__total = 0.0
+        self.__max = 0.0
+
+    def add(self, latency):
+        """ Add a sample (in seconds). """
+        self.__counts[bisect_left(LatencyHistogram.BOUNDS, latency)] += 1
+        self.__count += 1
+        self.__total += latency
+        if latency > self.__max:
+            self.__max = latency
+
+    def get_percentile(self, percentile):
+        """ Get the upper bound of the bucket that contains the percentile (in [0, 100]), the
+        maximum latency is used for the last bucket. None if there are no samples. """
+        if self.__count == 0:
+            return None
+
+        rank = percentile / 100.0 * self.__count
+        seen = 0
+        for (index, count) in enumerate(self.__counts):
+            seen += count
+            if seen >= rank and count > 0:
+                if index < len(LatencyHistogram.BOUNDS):
+                    return min(LatencyHistogram.BOUNDS[index], self.__max)
+                break
+        return self.__max
+
+    def to_dict(self):
+        """ Get the histogram as a dict: count, mean, max, p50, p90, p99 (in seconds) and buckets:
+        list of [upper bound, count], the upper bound of the last bucket is None. """
+        bounds = LatencyHistogram.BOUNDS + [None]
+        return {'count' : self.__count,
+                'mean' : self.__total / self.__count if self.__count > 0 else None,
+                'max' : self.__max,
+                'p50' : self.get_percentile(50),
+                'p90' : self.get_percentile(90),
+                'p99' : self.get_percentile(99),
+                'buckets' : [[bounds[i], self.__counts[i]] for i in range(len(bounds))
+                             if self.__counts[i] > 0]}
+
+
+class CommunicationStats(object):
+    """ Keeps the statistics of the communication over a serial bus: latency histograms per action
+    and per module, failure counters, the time spent waiting for the bus and the bus utilisation
+    over the last window seconds. """
+
+    def __init__(self, baudrate, window=60):
+        """ Create CommunicationStats.
+
+        :param baudrate: the baudrate of the bus, used to calculate the utilisation.
+        :param window: the number of seconds used for the bus utilisation.
+        """
+        self.__bytes_per_second = baudrate / 10.0 # 8 data bits, start and stop bit.
+        self.__window = window
+        self.__lock = Lock()
+
+        self.__actions = {}
+        self.__modules = {}
+        self.__failures = {}
+        self.__wait = LatencyHistogram()
+        self.__lanes = {}
+        self.__bytes = deque() # [second, bytes] for the last window seconds
+
+    def record_command(self, action, latency, module=None):
+        """ Record the latency (in seconds) of a command. """
+        with self.__lock:
+            if action not in self.__actions:
+                self.__actions[action] = LatencyHistogram()
+            self.__actions[action].add(latency)
+
+            if module is not None:
+                if module not in self.__modules:
+                    self.__modules[module] = LatencyHistogram()
+                self.__modules[module].add(latency)
+
+    def record_failure(self, kind, action):
+        """ Record a failed command, kind is the type of failure (eg. 'timeout' or 'crc'). """
+        with self.__lock:
+            failures = self.__failures.setdefault(kind, {})
+            failures[action] = failures.get(action, 0) + 1
+
+    def record_wait(self, wait, lane=None):
+        """ Record the time (in seconds) a command waited before it could use the bus, lane
+        identifies the queue the command waited in (if there are multiple queues). """
+        with self.__lock:
+            self.__wait.add(wait)
+            if lane is not None:
+                if lane not in self.__lanes:
+                    self.__lanes[lane] = LatencyHistogram()
+                self.__lanes[lane].add(wait)
+
+    def record_bytes(self, num_bytes):
+        """ Record the number of bytes that were sent or received on the bus. """
+        second = int(time.time())
+        with self.__lock:
+            if len(self.__bytes) > 0 and self.__bytes[-1][0] == second:
+                self.__bytes[-1][1] += num_bytes
+            else:
+                self.__bytes.append([second, num_bytes])
+                while self.__bytes[0][0] <= second - self.__window:
+                    self.__bytes.popleft()
+
+    def get_utilisation(self):
+        """ Get the fraction of the bus capacity that was used in the last window seconds. """
+        since = int(time.time()) - self.__window
+        with self.__lock:
+            num_bytes = sum([count for (second, count) in self.__bytes if second > since])
+        return num_bytes / (self.__bytes_per_second * self.__window)
+
+    def to_dict(self):
+        """ Get the statistics as a dict with keys actions, modules (dicts that map the action or
+        module on the LatencyHistogram dict), failures (dict that maps the kind of failure on a dict
+        with the count per action), wait (LatencyHistogram dict), lanes (dict that maps the lane on
+        the LatencyHistogram dict of the wait time in that lane) and utilisation. """
+        with self.__lock:
+            ret = {'actions' : dict([(str(action), histogram.to_dict())
+                                     for (action, histogram) in self.__actions.items()]),
+                   'modules' : dict([(str(module), histogram.to_dict())
+                                     for (module, histogram) in self.__modules.items()]),
+                   'failures' : dict([(kind, dict([(str(action), count)
+                                                   for (action, count) in failures.items()]))
+                                      for (kind, failures) in self.__failures.items()]),
+                   'wait' : self.__wait.to_dict(),
+                   'lanes' : dict([(str(lane), histogram.to_dict())
+                                   for (lane, histogram) in self.__lanes.items()])}
+        ret['utilisation'] = self.get_utilisation()
+        return ret
@@ -33,6 +33,9 @@ python -m gateway_tests.users_tests
 echo "Running scheduling tests"
 python -m gateway_tests.scheduling_tests
 
+echo "Running status cache tests"
+python -m gateway_tests.status_cache_tests
+
 echo "Running power controller tests"
 python -m power_tests.power_controller_tests
 
@@ -42,6 +45,12 @@ python -m power_tests.power_communicator_tests
 echo "Running time keeper tests"
 python -m power_tests.time_keeper_tests
 
+echo "Running power sampler tests"
+python -m power_tests.power_sampler_tests
+
+echo "Running energy store tests"
+python -m power_tests.energy_store_tests
+
 echo "Running plugin base tests"
 python -m plugins_tests.base_tests
 
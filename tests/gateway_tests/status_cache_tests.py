@@ -0,0 +1,120 @@
+'''
+OpenMotics - Gateway
+Copyright (C) 2014 - OpenMotics <info@openmotics.com>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+'''
+Tests for the status_cache module.
+
+@author: fryckbos
+'''
+import unittest
+import time
+from threading import Thread, Event
+
+from gateway.status_cache import StatusCache
+
+class StatusCacheTest(unittest.TestCase):
+    """ Tests for StatusCache. """
+
+    def setUp(self): #pylint: disable=C0103
+        """ Run before each test. """
+        self.reads = 0
+
+    def __read(self):
+        """ Count the reads and return the number of reads. """
+        self.reads += 1
+        return self.reads
+
+    def test_ttl(self):
+        """ Test that the value is read again when it is older than the ttl or max_age. """
+        cache = StatusCache({'source' : 0.05})
+
+        (value, age) = cache.get('source', self.__read)
+        self.assertEquals(1, value)
+        self.assertTrue(age < 0.05)
+        self.assertEquals(1, cache.get('source', self.__read)[0])
+
+        time.sleep(0.06)
+        self.assertEquals(2, cache.get('source', self.__read)[0])
+
+        self.assertEquals(2, cache.get('source', self.__read, max_age=10)[0])
+        self.assertEquals(3, cache.get('source', self.__read, max_age=0)[0])
+
+        cache.invalidate('source')
+        self.assertEquals(4, cache.get('source', self.__read, max_age=10)[0])
+
+    def test_exception(self):
+        """ Test that an exception is raised and not cached. """
+        cache = StatusCache({'source' : 10})
+
+        def fail():
+            """ Raise an exception. """
+            raise ValueError("Master did not respond")
+
+        self.assertRaises(ValueError, cache.get, 'source', fail)
+        self.assertEquals(1, cache.get('source', self.__read)[0])
+
+    def test_single_flight(self):
+        """ Test that concurrent callers wait for one read. """
+        cache = StatusCache({'source' : 10})
+        release = Event()
+
+        def slow_read():
+            """ Wait until released. """
+            release.wait()
+            return self.__read()
+
+        results = []
+        threads = [Thread(target=lambda: results.append(cache.get('source', slow_read)[0]))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(1, self.reads)
+        self.assertEquals([1] * 5, results)
+
+    def test_invalidate_during_read(self):
+        """ Test that a read that was in progress during invalidate is not cached. """
+        cache = StatusCache({'source' : 10})
+        started = Event()
+        release = Event()
+
+        def slow_read():
+            """ Wait until released. """
+            started.set()
+            release.wait()
+            return self.__read()
+
+        thread = Thread(target=lambda: cache.get('source', slow_read))
+        thread.start()
+        started.wait()
+
+        cache.invalidate('source')
+        release.set()
+        thread.join()
+
+        self.assertEquals(2, cache.get('source', self.__read)[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -24,10 +24,13 @@ Created on Sep 2, 2013
 @author: fryckbos
 '''
 import unittest
+import os
+import sqlite3
 
 from master.eeprom_controller import EepromController, EepromFile, EepromModel, EepromAddress, \
                                      EepromData, EepromId, EepromString, EepromByte, EepromWord, \
-                                     CompositeDataType, EepromActions, EepromSignedTemp
+                                     CompositeDataType, EepromActions, EepromSignedTemp, \
+                                     EepromBankCache, EepromReadPlanner
 import master.master_api as master_api
 
 
@@ -309,7 +312,7 @@ class MasterCommunicatorDummy(object):
         self.__list_function = list_function
         self.__write_function = write_function
 
-    def do_command(self, cmd, data):
+    def do_command(self, cmd, data, priority=None):
         """ Execute a command on the master dummy. """
         if cmd == master_api.eeprom_list():
             return self.__list_function(data)
@@ -324,6 +327,29 @@ class MasterCommunicatorDummy(object):
             raise Exception("Command %s not found" % cmd)
 
 
+class MasterEepromDummy(object):
+    """ Dummy for the eeprom of the master, writes are kept. """
+
+    def __init__(self, banks=None):
+        """ Create an eeprom with 256 banks, banks maps the bank number on the data. """
+        self.banks = banks if banks is not None else \
+                     dict([(bank, chr(bank) * 256) for bank in range(256)])
+        self.reads = []
+        self.writes = []
+
+    def read(self, data):
+        """ Read a bank. """
+        self.reads.append(data["bank"])
+        return {"data" : self.banks[data["bank"]]}
+
+    def write(self, data):
+        """ Write to a bank. """
+        self.writes.append(data)
+        bank = self.banks[data["bank"]]
+        self.banks[data["bank"]] = bank[:data["address"]] + data["data"] + \
+                                   bank[data["address"] + len(data["data"]):]
+
+
 class EepromFileTest(unittest.TestCase):
     """ Tests for EepromFile. """
 
@@ -344,6 +370,23 @@ class EepromFileTest(unittest.TestCase):
         self.assertEquals(address, data[0].address)
         self.assertEquals("abc", data[0].bytes)
 
+    def test_read_invalidate_concurrent(self):
+        """ Test that a cached bank that is invalidated while another bank is read is still
+        returned. """
+        eeprom_file = None
+
+        def read(data):
+            """ Read dummy, bank 1 is invalidated while bank 2 is read. """
+            if data["bank"] == 2:
+                eeprom_file.invalidate_banks([1])
+            return {"data" : chr(data["bank"]) * 256}
+
+        eeprom_file = EepromFile(MasterCommunicatorDummy(read))
+        eeprom_file.read([EepromAddress(1, 0, 256)])
+
+        data = eeprom_file.read([EepromAddress(1, 0, 3), EepromAddress(2, 0, 256)])
+        self.assertEquals(["\x01" * 3, "\x02" * 256], [piece.bytes for piece in data])
+
     def test_read_one_bank_two_addresses(self):
         """ Test read from one bank with two addresses. """
         def read(data):
@@ -507,6 +550,33 @@ class EepromFileTest(unittest.TestCase):
         self.assertTrue('write1' in done)
         self.assertTrue('write2' in done)
 
+    def test_write_end_of_bank(self):
+        """ Test writing the last bytes of a bank. """
+        writes = []
+
+        communicator = MasterCommunicatorDummy(lambda data: {"data" : "\xff" * 256},
+                                               writes.append)
+
+        eeprom_file = EepromFile(communicator)
+        eeprom_file.write([EepromData(EepromAddress(1, 250, 6), "abcdef")])
+
+        self.assertEquals([{"bank" : 1, "address" : 250, "data" : "abcdef"}], writes)
+
+    def test_get_write_extents(self):
+        """ Test the extents that are written for the changes in a bank. """
+        old = bytearray("\xff" * 256)
+
+        self.assertEquals([], EepromFile.get_write_extents(old, bytearray(old)))
+
+        new = bytearray(old)
+        new[0] = "a"
+        new[9] = "b"
+        new[10] = "c"
+        new[100:103] = "def"
+        new[255] = "g"
+        self.assertEquals([(0, 10), (10, 1), (100, 3), (255, 1)],
+                          EepromFile.get_write_extents(old, new))
+
     def test_cache(self):
         """ Test the caching of banks. """
         state = { 'count' : 0 }
@@ -641,6 +711,355 @@ class EepromFileTest(unittest.TestCase):
         self.assertEquals(2, state['read'])
         self.assertEquals(1, state['write'])
 
+    def test_backup_incremental(self):
+        """ Test that an incremental backup only contains the changed banks. """
+        master = MasterEepromDummy()
+        reads = master.reads
+        eeprom_file = EepromFile(MasterCommunicatorDummy(master.read, master.write))
+
+        (backup_id, banks) = eeprom_file.get_backup()
+        self.assertEquals(256, len(banks))
+        self.assertEquals(256, len(reads))
+        self.assertEquals("\x05" * 256, banks[5])
+
+        # The banks are taken from the cache, only the volatile banks are read again.
+        eeprom_file.add_volatile_banks([9])
+        reads[:] = []
+        (same_id, banks) = eeprom_file.get_backup(backup_id)
+        self.assertEquals(backup_id, same_id)
+        self.assertEquals({}, banks)
+        self.assertEquals([9], reads)
+
+        # The master changed a volatile bank behind the cache.
+        master.banks[9] = "\x00" * 256
+        (changed_id, banks) = eeprom_file.get_backup(backup_id)
+        self.assertNotEquals(backup_id, changed_id)
+        self.assertEquals({9 : "\x00" * 256}, banks)
+        master.banks[9] = "\x09" * 256
+        eeprom_file.get_backup()
+
+        eeprom_file.write([EepromData(EepromAddress(7, 10, 3), "abc")])
+        (new_id, banks) = eeprom_file.get_backup(backup_id)
+        self.assertNotEquals(backup_id, new_id)
+        self.assertEquals([7], banks.keys())
+        self.assertEquals("\x07" * 10 + "abc" + "\x07" * 243, banks[7])
+
+        # An unknown backup id results in a full backup
+        (_, banks) = eeprom_file.get_backup("unknown")
+        self.assertEquals(256, len(banks))
+
+    def test_iter_banks(self):
+        """ Test that the banks are read one at a time and that the iteration can be resumed. """
+        reads = []
+
+        def read(data):
+            """ Read dummy. """
+            reads.append(data["bank"])
+            return {"data" : chr(data["bank"]) * 256}
+
+        eeprom_file = EepromFile(MasterCommunicatorDummy(read))
+
+        banks = eeprom_file.iter_banks(250)
+        self.assertEquals([], reads)
+        self.assertEquals((250, "\xfa" * 256), banks.next())
+        self.assertEquals([250], reads)
+        self.assertEquals([251, 252, 253, 254, 255], [bank for (bank, _) in banks])
+
+        # The cached banks are not read again, the volatile banks are.
+        eeprom_file.add_volatile_banks([252])
+        reads[:] = []
+        self.assertEquals(6, len(list(eeprom_file.iter_banks(250))))
+        self.assertEquals([252], reads)
+
+        try:
+            list(eeprom_file.iter_banks(256))
+            self.fail("Should not get here !")
+        except ValueError:
+            pass
+
+    def test_restore(self):
+        """ Test that a restore only writes the banks that changed. """
+        master = MasterEepromDummy(dict([(bank, "\xff" * 256) for bank in range(256)]))
+        writes = master.writes
+        eeprom_file = EepromFile(MasterCommunicatorDummy(master.read, master.write))
+
+        backup = bytearray("\xff" * 256 * 256)
+        backup[3 * 256 + 20:3 * 256 + 22] = "ab"
+        written = eeprom_file.restore(str(backup))
+
+        self.assertEquals([(3, 20, 2)], written)
+        self.assertEquals([{"bank" : 3, "address" : 20, "data" : "ab"}], writes)
+
+        # The banks are compared with the master, not with the cache.
+        writes[:] = []
+        master.reads[:] = []
+        self.assertEquals([], eeprom_file.restore(str(backup)))
+        self.assertEquals([], writes)
+        self.assertEquals(range(256), master.reads)
+
+        try:
+            eeprom_file.restore("\xff" * 100)
+            self.fail("Should not get here !")
+        except ValueError:
+            pass
+
+    def test_restore_stale_cache(self):
+        """ Test that a restore compares the banks with the master and not with a stale cache. """
+        master = MasterEepromDummy(dict([(bank, "\xff" * 256) for bank in range(256)]))
+        eeprom_file = EepromFile(MasterCommunicatorDummy(master.read, master.write))
+        self.assertEquals("\xff" * 256, eeprom_file.read([EepromAddress(3, 0, 256)])[0].bytes)
+
+        # The master changes bank 3 behind the cache, the backup is equal to the stale cache.
+        master.banks[3] = "\xff" * 20 + "ab" + "\xff" * 234
+        self.assertEquals([(3, 20, 2)], eeprom_file.restore("\xff" * 256 * 256))
+        self.assertEquals("\xff" * 256, master.banks[3])
+        self.assertEquals("\xff" * 256, eeprom_file.read([EepromAddress(3, 0, 256)])[0].bytes)
+
+    def test_invalidate_model(self):
+        """ Test that the banks of the fields of a model are read again after invalidate. """
+        reads = []
+
+        def read(data):
+            """ Read dummy. """
+            reads.append(data["bank"])
+            return {"data" : "\xff" * 256}
+
+        controller = EepromController(EepromFile(MasterCommunicatorDummy(read)))
+        controller.read(Model1, 1)
+        self.assertEquals([1], reads)
+
+        controller.invalidate_model(Model1, ['name'])
+        controller.read(Model1, 1)
+        self.assertEquals([1, 1], reads)
+
+    def test_add_volatile_model(self):
+        """ Test that the banks of the volatile fields of a model are read again for a backup. """
+        master = MasterEepromDummy()
+        controller = EepromController(EepromFile(MasterCommunicatorDummy(master.read,
+                                                                         master.write)))
+        controller.add_volatile_model(Model1, ['name'])
+        controller.get_backup()
+
+        master.reads[:] = []
+        controller.get_backup()
+        self.assertEquals([1], master.reads)
+
+
+class EepromReadPlannerTest(unittest.TestCase):
+    """ Tests for EepromReadPlanner. """
+
+    def test_merge_ranges(self):
+        """ Test merging overlapping and adjacent addresses. """
+        addresses = [EepromAddress(1, 20, 5), EepromAddress(1, 0, 4), EepromAddress(1, 4, 2),
+                     EepromAddress(1, 22, 10), EepromAddress(1, 40, 1)]
+        self.assertEquals([[0, 6], [20, 32], [40, 41]],
+                          EepromReadPlanner.merge_ranges(addresses))
+
+    def test_get_reads(self):
+        """ Test covering ranges with reads. """
+        self.assertEquals([(0, 6), (20, 10), (30, 2)],
+                          EepromReadPlanner.get_reads([[0, 6], [20, 32]]))
+        self.assertEquals([(0, 10), (10, 2)], EepromReadPlanner.get_reads([[0, 3], [5, 12]]))
+        self.assertEquals([(246, 10)], EepromReadPlanner.get_reads([[250, 251], [255, 256]]))
+        self.assertEquals([(240, 5), (246, 10)], EepromReadPlanner.get_reads([[240, 245],
+                                                                            [252, 256]]))
+
+    def test_plan(self):
+        """ Test the choice between reads and lists. """
+        planner = EepromReadPlanner(read_latency=0.02, list_latency=0.13)
+        per_bank = {1 : [EepromAddress(1, 0, 1), EepromAddress(1, 100, 2)],
+                    2 : [EepromAddress(2, i * 20, 1) for i in range(7)]}
+
+        self.assertEquals([{'command' : 'RE', 'bank' : 1, 'addr' : 0, 'num' : 1},
+                           {'command' : 'RE', 'bank' : 1, 'addr' : 100, 'num' : 2},
+                           {'command' : 'EL', 'bank' : 2}], planner.plan(per_bank))
+
+        # The list is a lot slower than measured initially: read bank 2 using reads.
+        for _ in range(20):
+            planner.add_measurement('EL', 0.5)
+        self.assertEquals(9, len(planner.plan(per_bank)))
+
+    def test_file_plan(self):
+        """ Test that the EepromFile uses the plan and doesn't plan for cached banks. """
+        reads = []
+
+        def read(data):
+            """ Read dummy. """
+            reads.append(data["bank"])
+            return {"data" : "".join([chr(i) for i in range(256)])}
+
+        eeprom_file = EepromFile(MasterCommunicatorDummy(read))
+        addresses = [EepromAddress(1, 250, 6), EepromAddress(2, 0, 256)]
+        self.assertEquals([{'command' : 'RE', 'bank' : 1, 'addr' : 246, 'num' : 10},
+                           {'command' : 'EL', 'bank' : 2}], eeprom_file.plan_read(addresses))
+
+        data = eeprom_file.read(addresses)
+        self.assertEquals("".join([chr(i) for i in range(250, 256)]), data[0].bytes)
+        self.assertEquals([1, 2], reads)
+        self.assertEquals([{'command' : 'RE', 'bank' : 1, 'addr' : 246, 'num' : 10}],
+                          eeprom_file.plan_read(addresses))
+        self.assertEquals(set(['RE', 'EL']), set(eeprom_file.get_read_latencies().keys()))
+
+
+class EepromBankCacheTest(unittest.TestCase):
+    """ Tests for EepromBankCache and the persistent cache in EepromFile. """
+
+    FILE = "test_eeprom_cache.db"
+
+    def setUp(self): #pylint: disable=C0103
+        """ Run before each test. """
+        if os.path.exists(EepromBankCacheTest.FILE):
+            os.remove(EepromBankCacheTest.FILE)
+
+    def tearDown(self): #pylint: disable=C0103
+        """ Run after each test. """
+        if os.path.exists(EepromBankCacheTest.FILE):
+            os.remove(EepromBankCacheTest.FILE)
+
+    def test_store_load(self):
+        """ Test storing and loading banks, dirty banks are not loaded. """
+        cache = EepromBankCache(EepromBankCacheTest.FILE)
+        cache.store(1, "\x01" * 256)
+        cache.store(2, "\x02" * 256)
+        cache.store(3, "\x03" * 256)
+        cache.mark_dirty(3)
+
+        cache = EepromBankCache(EepromBankCacheTest.FILE)
+        self.assertEquals({1 : "\x01" * 256, 2 : "\x02" * 256}, cache.load())
+        self.assertEquals([1, 2], [info['bank'] for info in cache.get_bank_info()])
+
+        cache.store(2, "\x04" * 256, written=True)
+        info = cache.get_bank_info()
+        self.assertEquals(None, info[0]['write_time'])
+        self.assertNotEquals(None, info[1]['write_time'])
+        self.assertFalse(info[1]['dirty'])
+
+        cache.clear()
+        self.assertEquals({}, cache.load())
+
+    def test_invalid_checksum(self):
+        """ Test that a bank with an invalid checksum is not loaded. """
+        cache = EepromBankCache(EepromBankCacheTest.FILE)
+        cache.store(1, "\x01" * 256)
+        cache.store(2, "\x02" * 256)
+
+        connection = sqlite3.connect(EepromBankCacheTest.FILE)
+        connection.execute("UPDATE banks SET checksum=0 WHERE bank=2;")
+        connection.commit()
+        connection.close()
+
+        self.assertEquals({1 : "\x01" * 256}, cache.load())
+        self.assertEquals([1], [info['bank'] for info in cache.get_bank_info()])
+
+    def test_warm_restart(self):
+        """ Test that the banks are used right away after a restart and that all loaded banks are
+        verified. """
+        banks = {1 : "abc" + "\xff" * 253, 2 : "def" + "\xff" * 253, 3 : "ghi" + "\xff" * 253}
+        reads = []
+
+        def read(data):
+            """ Read dummy. """
+            reads.append(data["bank"])
+            return {"data" : banks[data["bank"]]}
+
+        addresses = [EepromAddress(bank, i * 10, 10) for bank in [1, 2, 3] for i in range(10)]
+
+        eeprom_file = EepromFile(MasterCommunicatorDummy(read),
+                                 EepromBankCache(EepromBankCacheTest.FILE))
+        eeprom_file.read(addresses)
+        self.assertEquals([1, 2, 3], reads)
+
+        # The banks are read from the cache without touching the master.
+        reads[:] = []
+        eeprom_file = EepromFile(MasterCommunicatorDummy(read),
+                                 EepromBankCache(EepromBankCacheTest.FILE))
+        data = eeprom_file.read(addresses)
+        self.assertEquals("abc" + "\xff" * 7, data[0].bytes)
+        self.assertEquals([], reads)
+        self.assertEquals([False] * 3, [info['verified'] for info in eeprom_file.get_cache_info()])
+
+        # Every loaded bank is compared with the master.
+        self.assertEquals([], eeprom_file.verify_cache())
+        self.assertEquals([1, 2, 3], reads)
+        self.assertEquals([True] * 3, [info['verified'] for info in eeprom_file.get_cache_info()])
+
+        reads[:] = []
+        eeprom_file.read(addresses)
+        self.assertEquals([], reads)
+
+        # The master changed while the gateway was down, the changed banks are replaced.
+        banks[2] = "\x00" * 256
+        reads[:] = []
+        eeprom_file = EepromFile(MasterCommunicatorDummy(read),
+                                 EepromBankCache(EepromBankCacheTest.FILE))
+        self.assertEquals([2], eeprom_file.verify_cache())
+        self.assertEquals([1, 2, 3], reads)
+        self.assertEquals([True] * 3, [info['verified'] for info in eeprom_file.get_cache_info()])
+
+        reads[:] = []
+        data = eeprom_file.read(addresses)
+        self.assertEquals(["\x00" * 10] * 10, [piece.bytes for piece in data[10:20]])
+        self.assertEquals([], reads)
+
+        # The replaced bank is kept in the persistent cache.
+        self.assertEquals("\x00" * 256, EepromBankCache(EepromBankCacheTest.FILE).load()[2])
+
+    def test_backup_unverified(self):
+        """ Test that backups read the banks that are not verified yet from the master. """
+        master = MasterEepromDummy()
+        cache = EepromBankCache(EepromBankCacheTest.FILE)
+        cache.store(4, "\x00" * 256)
+
+        eeprom_file = EepromFile(MasterCommunicatorDummy(master.read, master.write), cache)
+        self.assertEquals("\x00" * 256, eeprom_file.read([EepromAddress(4, 0, 256)])[0].bytes)
+        self.assertEquals([], master.reads)
+
+        (_, banks) = eeprom_file.get_backup()
+        self.assertEquals("\x04" * 256, banks[4])
+        self.assertEquals(range(256), master.reads)
+
+        # The backup verified the bank, verify_cache has nothing left to do.
+        master.reads[:] = []
+        self.assertEquals([], eeprom_file.verify_cache())
+        self.assertEquals([], master.reads)
+
+    def test_existing_database(self):
+        """ Test that the tables are created in an existing database without tables. """
+        sqlite3.connect(EepromBankCacheTest.FILE).close()
+        cache = EepromBankCache(EepromBankCacheTest.FILE)
+        cache.store(1, "\x01" * 256)
+        self.assertEquals({1 : "\x01" * 256}, cache.load())
+
+    def test_write_and_invalidate(self):
+        """ Test that writes are stored in the persistent cache and that invalidate clears it. """
+        def read(data):
+            """ Read dummy. """
+            return {"data" : "\xff" * 256}
+
+        cache = EepromBankCache(EepromBankCacheTest.FILE)
+        eeprom_file = EepromFile(MasterCommunicatorDummy(read, lambda data: None), cache)
+        eeprom_file.write([EepromData(EepromAddress(1, 2, 3), "abc")])
+
+        self.assertEquals({1 : "\xff\xff" + "abc" + "\xff" * 251}, cache.load())
+        info = eeprom_file.get_cache_info()
+        self.assertEquals(1, len(info))
+        self.assertNotEquals(None, info[0]['write_time'])
+
+        eeprom_file.invalidate_cache()
+        self.assertEquals({}, cache.load())
+
+    def test_backup_hashes(self):
+        """ Test that the backup hashes are kept over a restart. """
+        cache = EepromBankCache(EepromBankCacheTest.FILE)
+        for i in range(5):
+            cache.store_backup_hashes("id%d" % i, ["a%d" % i, "b"], 3)
+        self.assertEquals(None, cache.get_backup_hashes("unknown"))
+
+        cache = EepromBankCache(EepromBankCacheTest.FILE)
+        self.assertEquals(["a4", "b"], cache.get_backup_hashes("id4"))
+        self.assertEquals(["a2", "b"], cache.get_backup_hashes("id2"))
+        self.assertEquals(None, cache.get_backup_hashes("id1"))
+
 
 class EepromModelTest(unittest.TestCase):
     """ Tests for EepromModel. """
@@ -913,6 +1332,38 @@ class EepromModelTest(unittest.TestCase):
         except TypeError as type_error:
             self.assertTrue("id" in str(type_error))
 
+    def test_layout_cache(self):
+        """ Test that the address generators are only called once per id. """
+        calls = []
+
+        def address(id):
+            """ Address generator that counts the calls. """
+            calls.append(id)
+            return (1, id * 2)
+
+        class CountModel(EepromModel):
+            """ Model with a counting address generator. """
+            id = EepromId(10)
+            link = EepromByte(address)
+            status = CompositeDataType([('a', EepromByte(lambda id: (2, id))),
+                                        ('b', EepromByte(address))])
+
+        for _ in range(3):
+            self.assertEquals([EepromAddress(1, 6, 1), EepromAddress(2, 3, 1),
+                               EepromAddress(1, 6, 1)], CountModel.get_addresses(3))
+        self.assertEquals([3, 3], calls)
+
+        model = CountModel.from_bank_data({1 : "".join([chr(i) for i in range(256)]),
+                                           2 : "\x00" * 3 + "\x07" + "\x00" * 252}, 3)
+        self.assertEquals(6, model.link)
+        self.assertEquals([7, 6], model.status)
+
+        model = CountModel.from_bank_data({1 : "\x06" * 256,
+                                           2 : "\x00" * 3 + "\x07" + "\x00" * 252}, 3, ["status"])
+        self.assertEquals([7, 6], model.status)
+        self.assertFalse("link" in model.__dict__)
+        self.assertEquals([3, 3], calls)
+
 
 class CompositeDataTypeTest(unittest.TestCase):
     """ Tests for CompositeDataType. """
@@ -26,6 +26,7 @@ Created on Oct 13, 2012
 '''
 import unittest
 
+import master.master_api as master_api
 from master.master_api import Svt
 
 class SvtTest(unittest.TestCase):
@@ -55,6 +56,26 @@ class SvtTest(unittest.TestCase):
             byte_value = chr(value)
             self.assertEquals(byte_value, Svt.from_byte(byte_value).get_byte())
 
+
+class SpecTest(unittest.TestCase):
+    """ Tests for the specs in master_api. """
+
+    def test_shared(self):
+        """ Test that every call returns the same MasterCommandSpec. """
+        self.assertTrue(master_api.read_output() is master_api.read_output())
+        self.assertEquals("ro", master_api.read_output().action)
+        self.assertEquals("read_output", master_api.read_output.__name__)
+
+    def test_immutable_fields(self):
+        """ Test that the fields of a shared spec can not be changed. """
+        fields = master_api.basic_action().input_fields
+
+        def set_field():
+            """ Replace a field of the spec. """
+            fields[0] = None
+
+        self.assertRaises(TypeError, set_field)
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -0,0 +1,390 @@
+'''
+OpenMotics - Gateway
+Copyright (C) 2014 - OpenMotics <info@openmotics.com>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+'''
+Benchmarks for the master communication, run using: python -m master_tests.master_benchmarks
+
+These are not unit tests: they print the throughput of the MasterCommunicator against a simulated
+master.
+
+@author: fryckbos
+'''
+import os
+import pty
+import tty
+import time
+import fcntl
+import random
+import struct
+import termios
+from threading import Thread, Timer, Condition, Event
+
+from master.master_communicator import MasterCommunicator, BackgroundConsumer
+from master.master_command import Result, NeedMoreBytesException
+import master.master_api as master_api
+from serial_utils import PollTransport
+
+
+class MasterSerialStub(object):
+    """ Simulates the serial port of a master: every command written to the stub is answered after
+    a fixed latency. Multiple commands can be answered at the same time, this models the transport
+    and processing delay that can be overlapped by pipelining.
+    """
+
+    def __init__(self, replies, latency=0.005):
+        """ Create a MasterSerialStub.
+
+        :param replies: dict that maps the action of a command on a tuple (spec, output fields).
+        :param latency: the number of seconds between a command and the answer.
+        """
+        self.__replies = replies
+        self.__latency = latency
+        self.__buffer = ""
+        self.__condition = Condition()
+
+    def write(self, data):
+        """ Parse the command and schedule the answer. """
+        action = data[3:5]
+        cid = ord(data[5])
+        (spec, fields) = self.__replies[action]
+        Timer(self.__latency, self.__reply, [spec.create_output(cid, fields)]).start()
+
+    def __reply(self, data):
+        """ Make the answer available for reading. """
+        with self.__condition:
+            self.__buffer += data
+            self.__condition.notify_all()
+
+    def read(self, size):
+        """ Read size bytes, blocks until data is available. """
+        with self.__condition:
+            while len(self.__buffer) == 0:
+                self.__condition.wait()
+            (ret, self.__buffer) = (self.__buffer[:size], self.__buffer[size:])
+            return ret
+
+    def inWaiting(self): #pylint: disable=C0103
+        """ Get the number of bytes pending to be read """
+        return len(self.__buffer)
+
+
+def get_replies():
+    """ Get the replies for the MasterSerialStub. """
+    return {'BA' : (master_api.basic_action(), {'resp' : 'OK'}),
+            'EL' : (master_api.eeprom_list(), {'bank' : 0, 'data' : '\xff' * 256})}
+
+
+def benchmark_throughput(pipeline_depth, num_commands=200, num_threads=1, latency=0.005):
+    """ Measure the number of commands per second for a pipeline depth.
+
+    :returns: commands per second (float).
+    """
+    comm = MasterCommunicator(MasterSerialStub(get_replies(), latency), init_master=False,
+                              pipeline_depth=pipeline_depth)
+    comm.start()
+
+    commands = [(master_api.basic_action(), {'action_type' : 1, 'action_number' : 2})
+                for _ in range(num_commands / num_threads)]
+
+    def run():
+        """ Execute the commands, using do_commands if only one thread is used. """
+        if num_threads == 1:
+            comm.do_commands(commands)
+        else:
+            for (cmd, fields) in commands:
+                comm.do_command(cmd, fields)
+
+    start = time.time()
+    threads = [Thread(target=run) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return len(commands) * num_threads / (time.time() - start)
+
+
+def benchmark_priority(priority, background=200, interactive=10, latency=0.005):
+    """ Measure the latency of interactive commands while a background job sends EL commands with
+    PRIORITY_LOW from 4 threads.
+
+    :param priority: the priority of the interactive commands.
+    :returns: the mean latency of the interactive commands (in seconds).
+    """
+    comm = MasterCommunicator(MasterSerialStub(get_replies(), latency), init_master=False)
+    comm.start()
+
+    def run_background():
+        """ Execute the background commands. """
+        for _ in range(background / 4):
+            comm.do_command(master_api.eeprom_list(), {'bank' : 0},
+                            priority=MasterCommunicator.PRIORITY_LOW)
+
+    threads = [Thread(target=run_background) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+
+    total = 0.0
+    for _ in range(interactive):
+        time.sleep(0.05)
+        start = time.time()
+        comm.do_command(master_api.basic_action(), {'action_type' : 1, 'action_number' : 2},
+                        priority=priority)
+        total += time.time() - start
+
+    for thread in threads:
+        thread.join()
+
+    return total / interactive
+
+
+class BurstSerialStub(object):
+    """ Serial port that returns a recorded burst of bytes in chunks, and blocks afterwards. """
+
+    def __init__(self, data, chunk_size):
+        self.__data = data
+        self.__chunk_size = chunk_size
+        self.__index = 0
+        self.__done = Event()
+
+    def write(self, data):
+        """ Writes are ignored. """
+        pass
+
+    def read(self, size):
+        """ Read size bytes, blocks forever at the end of the burst. """
+        if self.__index >= len(self.__data):
+            self.__done.wait()
+        ret = self.__data[self.__index:self.__index + size]
+        self.__index += len(ret)
+        return ret
+
+    def inWaiting(self): #pylint: disable=C0103
+        """ Get the number of bytes pending to be read, limited by the chunk size. """
+        return max(0, min(self.__chunk_size - 1, len(self.__data) - self.__index))
+
+
+def get_ol_il_burst(num_messages, seed=0):
+    """ Create a burst of OL and IL messages, like the master sends them when a scene is
+    executed.
+
+    :returns: tuple (number of OL messages, number of IL messages, burst string)
+    """
+    rand = random.Random(seed)
+    (num_ol, num_il, burst) = (0, 0, [])
+
+    for _ in range(num_messages):
+        if rand.random() < 0.7:
+            outputs = rand.sample(range(240), rand.randint(0, 20))
+            burst.append("OL\x00" + chr(len(outputs)) +
+                         "".join([chr(o) + chr(rand.randint(0, 63)) for o in outputs]) + "\r\n")
+            num_ol += 1
+        else:
+            burst.append("IL\x00" + chr(rand.randint(0, 239)) + chr(rand.randint(0, 239)) + "\r\n")
+            num_il += 1
+
+    return (num_ol, num_il, "".join(burst))
+
+
+def benchmark_parser(num_messages=5000, chunk_size=64, num_commands=10):
+    """ Measure the number of bytes per second that are parsed by the read thread. Next to the
+    background consumers for OL and IL, a number of consumers for outstanding commands are
+    registered.
+
+    :returns: tuple (bytes per second, messages per second).
+    """
+    (num_ol, num_il, burst) = get_ol_il_burst(num_messages)
+    done = Event()
+    counter = {'messages' : 0}
+
+    def callback(_):
+        """ Count the messages, set done when all messages are received. """
+        counter['messages'] += 1
+        if counter['messages'] == num_ol + num_il:
+            done.set()
+
+    comm = MasterCommunicator(BurstSerialStub(burst, chunk_size), init_master=False,
+                              pipeline_depth=num_commands + 1)
+    comm.register_consumer(BackgroundConsumer(master_api.output_list(), 0, callback))
+    comm.register_consumer(BackgroundConsumer(master_api.input_list(), 0, callback))
+
+    # Outstanding commands that are never answered, the parser has to skip them.
+    for i in range(num_commands):
+        comm.register_consumer(BackgroundConsumer(master_api.read_output(), 100 + i, callback))
+
+    start = time.time()
+    comm.start()
+    done.wait()
+    duration = time.time() - start
+
+    return (len(burst) / duration, (num_ol + num_il) / duration)
+
+
+class PtySerial(object):
+    """ Replicates the pyserial read and inWaiting interface on a pty, without a file descriptor:
+    the MasterCommunicator uses the read(1) / inWaiting loop for this object. """
+
+    def __init__(self, fd):
+        self.__fd = fd
+
+    def write(self, data):
+        """ Write data to the pty. """
+        os.write(self.__fd, data)
+
+    def read(self, size):
+        """ Read up to size bytes, blocks until data is available. """
+        return os.read(self.__fd, size)
+
+    def inWaiting(self): #pylint: disable=C0103
+        """ Get the number of bytes pending to be read. """
+        return struct.unpack('i', fcntl.ioctl(self.__fd, termios.FIONREAD, '\x00' * 4))[0]
+
+
+def benchmark_pty_parser(poll, num_messages=5000, chunk_size=64):
+    """ Measure the number of bytes per second that are read and parsed from a pty, the burst is
+    written in chunks by another thread.
+
+    :param poll: use the PollTransport if True, the read(1) / inWaiting loop otherwise.
+    :returns: bytes per second.
+    """
+    (num_ol, num_il, burst) = get_ol_il_burst(num_messages)
+    done = Event()
+    counter = {'messages' : 0}
+
+    def callback(_):
+        """ Count the messages, set done when all messages are received. """
+        counter['messages'] += 1
+        if counter['messages'] == num_ol + num_il:
+            done.set()
+
+    (master_fd, slave_fd) = pty.openpty()
+    tty.setraw(slave_fd)
+    stream = os.fdopen(master_fd, 'r+b', 0)
+    serial = PollTransport(stream, timeout=0.1) if poll else PtySerial(master_fd)
+
+    comm = MasterCommunicator(serial, init_master=False)
+    comm.register_consumer(BackgroundConsumer(master_api.output_list(), 0, callback))
+    comm.register_consumer(BackgroundConsumer(master_api.input_list(), 0, callback))
+    comm.start()
+
+    start = time.time()
+    for i in range(0, len(burst), chunk_size):
+        os.write(slave_fd, burst[i:i + chunk_size])
+    done.wait()
+    duration = time.time() - start
+
+    comm.stop()
+    return len(burst) / duration
+
+
+def benchmark_codec(num_iterations=20000):
+    """ Compare the compiled decoder of a MasterCommandSpec with decoding field by field, for the
+    read_output (ro) command. The field by field decoder is the generic
+    implementation that was used before the codecs were compiled. The output is also decoded when
+    it arrives one byte at a time, this uses the partial decoding path of consume_output.
+
+    :returns: tuple (compiled decodes per second, field by field decodes per second,
+                     byte at a time decodes per second)
+    """
+    spec = master_api.read_output()
+    fields = {'id' : 5, 'type' : 'O', 'light' : 1, 'timer' : 16, 'ctimer' : 32, 'status' : 1,
+              'dimmer' : 50, 'controller_out' : 0, 'max_power' : 100, 'floor_level' : 1,
+              'menu_position' : [1, 2, 3], 'name' : 'output 5'.ljust(16), 'crc' : [67, 0, 0],
+              'literal' : ''}
+    # The crc is the sum of the bytes before the crc and the '\r\n' literal.
+    crc = sum(bytearray(spec.create_output(1, fields)[3:-5]))
+    fields['crc'] = [67, crc / 256, crc % 256]
+    data = spec.create_output(1, fields)[3:]
+
+    def rate(function):
+        """ Get the number of calls per second. """
+        start = time.time()
+        for _ in range(num_iterations):
+            function()
+        return num_iterations / (time.time() - start)
+
+    def decode_field_by_field():
+        """ Decode the output like the generic implementation: every field is decoded separately,
+        a field that needs more bytes raises a NeedMoreBytesException. """
+        result = Result()
+        index = 0
+        for field in spec.output_fields:
+            num_bytes = field.get_min_decode_bytes()
+            while True:
+                try:
+                    result[field.name] = field.decode(data[index:index + num_bytes])
+                    break
+                except NeedMoreBytesException, exception:
+                    num_bytes = exception.bytes_required
+            result.field_index += 1
+            index += num_bytes
+        return result
+
+    def decode_byte_at_a_time():
+        """ Feed the output to consume_output one byte at a time. """
+        result = None
+        for byte in data:
+            (_, result, done) = spec.consume_output(byte, result)
+        assert done
+        return result
+
+    expected = spec.consume_output(data)[1]
+    assert expected.crc_valid and expected['name'] == fields['name']
+    assert decode_field_by_field().fields == expected.fields
+    assert decode_byte_at_a_time().fields == expected.fields
+
+    return (rate(lambda: spec.consume_output(data)),
+            rate(decode_field_by_field),
+            rate(decode_byte_at_a_time))
+
+
+def main():
+    """ Run the benchmarks. """
+    print "Pipelined throughput (5 ms master latency):"
+    for depth in [1, 2, 4, 8]:
+        print "  depth %d, do_commands:          %7.1f cmd/s" % (depth, benchmark_throughput(depth))
+        print "  depth %d, do_command 4 threads: %7.1f cmd/s" % \
+                (depth, benchmark_throughput(depth, num_threads=4))
+
+    print "Interactive latency during a background job (5 ms master latency):"
+    for (name, priority) in [('low', MasterCommunicator.PRIORITY_LOW),
+                             ('high', MasterCommunicator.PRIORITY_HIGH)]:
+        print "  priority %-4s: %5.1f ms" % (name, benchmark_priority(priority) * 1000)
+
+    print "Parser throughput for OL/IL bursts:"
+    for chunk_size in [1, 16, 256]:
+        (bytes_per_sec, msgs_per_sec) = benchmark_parser(chunk_size=chunk_size)
+        print "  chunks of %3d bytes: %9.0f bytes/s, %8.0f msg/s" % \
+                (chunk_size, bytes_per_sec, msgs_per_sec)
+
+    print "Codec throughput for ro:"
+    (compiled_dec, generic_dec, bytewise_dec) = benchmark_codec()
+    print "  decode: compiled %8.0f/s, field by field %8.0f/s, byte at a time %8.0f/s" % \
+            (compiled_dec, generic_dec, bytewise_dec)
+
+    print "Parser throughput over a pty:"
+    for chunk_size in [16, 256]:
+        print "  chunks of %3d bytes, read/inWaiting: %9.0f bytes/s" % \
+                (chunk_size, benchmark_pty_parser(False, chunk_size=chunk_size))
+        print "  chunks of %3d bytes, poll transport: %9.0f bytes/s" % \
+                (chunk_size, benchmark_pty_parser(True, chunk_size=chunk_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -323,6 +323,80 @@ class MasterCommandSpecTest(unittest.TestCase):
 
         self.assertEquals(input, type.encode(decoded))
 
+    def test_consume_output_byte_by_byte(self):
+        """ Test that the compiled decoder and the field by field decoder give the same result. """
+        status = master_api.status()
+        data = '\x01\x02\x03\x04\x05\x06\x07\x00\x01\x03\x89\x05\x01\r\n'
+
+        (bytes_consumed, full, done) = status.consume_output(data + 'ignored', None)
+        self.assertEquals((len(data), True), (bytes_consumed, done))
+        self.assertEquals(1, full["seconds"])
+        self.assertEquals(137, full["f2"])
+
+        result = None
+        for byte in data:
+            (bytes_consumed, result, done) = status.consume_output(byte, result)
+            self.assertEquals(1, bytes_consumed)
+
+        self.assertTrue(done)
+        self.assertEquals(full.fields, result.fields)
+
+    def test_consume_output_crc(self):
+        """ Test that the crc is checked before the output is decoded. """
+        read_output = master_api.read_output()
+        data = '\x05' + 'O' + '\x01' + '\x00\x10' + '\x00\x20' + '\x01' + '\x20' + '\x00' + \
+               '\x64' + '\x01' + '\x01\x02\x03' + 'output 5'.ljust(16)
+        crc = sum([ord(c) for c in data])
+        output = data + 'C' + chr(crc / 256) + chr(crc % 256) + '\r\n'
+
+        (bytes_consumed, result, done) = read_output.consume_output(output + 'ignored', None)
+        self.assertEquals((len(output), True, True), (bytes_consumed, done, result.crc_valid))
+        self.assertEquals(16, result["timer"])
+        self.assertEquals([1, 2, 3], result["menu_position"])
+        self.assertEquals('output 5'.ljust(16), result["name"])
+        self.assertEquals([ord('C'), crc / 256, crc % 256], result["crc"])
+
+        # Byte by byte: the output is decoded when all bytes are received.
+        result = None
+        for byte in output:
+            (bytes_consumed, result, done) = read_output.consume_output(byte, result)
+            self.assertEquals(1, bytes_consumed)
+        self.assertEquals((True, True, 16), (done, result.crc_valid, result["timer"]))
+
+        # Invalid crc: the output is consumed, but not decoded.
+        output = data + 'C' + chr(crc / 256) + chr(crc % 256 + 1) + '\r\n'
+        (bytes_consumed, result, done) = read_output.consume_output(output, None)
+        self.assertEquals((len(output), True, False), (bytes_consumed, done, result.crc_valid))
+        self.assertEquals({}, result.fields)
+
+    def test_consume_output_crc_varlength(self):
+        """ Test the crc check on an output with a variable length field. """
+        error_list = master_api.error_list()
+        data = '\x01O\x14\x00\x01'
+        crc = sum([ord(c) for c in data])
+        output = data + 'C' + chr(crc / 256) + chr(crc % 256) + '\r\n'
+
+        (bytes_consumed, result, done) = error_list.consume_output(output[:3], None)
+        self.assertEquals((3, False), (bytes_consumed, done))
+        (bytes_consumed, result, done) = error_list.consume_output(output[3:], result)
+        self.assertEquals((len(output) - 3, True, True),
+                          (bytes_consumed, done, result.crc_valid))
+        self.assertEquals([('O20', 1)], result["errors"])
+
+    def test_consume_output_wrong_literal(self):
+        """ Test that a wrong literal raises a ValueError. """
+        basic_action = master_api.basic_action()
+        self.assertRaises(ValueError, basic_action.consume_output,
+                          'OK' + '\x00' * 11 + '\r\r', None)
+
+    def test_create_input_invalid(self):
+        """ Test that invalid values raise a ValueError. """
+        basic_action = master_api.basic_action()
+        self.assertRaises(ValueError, basic_action.create_input, 1,
+                          {"action_type": 256, "action_number": 1})
+        self.assertRaises(ValueError, basic_action.create_input, 1,
+                          {"action_type": -1, "action_number": 1})
+
     def test_output_has_crc(self):
         """ Test for MasterCommandSpec.output_has_crc. """
         self.assertFalse(master_api.basic_action().output_has_crc())
@@ -27,13 +27,15 @@ Created on Sep 10, 2012
 import unittest
 import threading
 import time
+import socket
 
 from master.master_communicator import MasterCommunicator, InMaintenanceModeException, \
-                                       BackgroundConsumer, CrcCheckFailedException
+                                       BackgroundConsumer, CrcCheckFailedException, CommandWindow, \
+                                       AdaptiveTimeout
 import master.master_api as master_api
 
 from serial_tests import SerialMock, sin, sout
-from serial_utils import CommunicationTimedOutException
+from serial_utils import CommunicationTimedOutException, PollTransport
 
 class MasterCommunicatorTest(unittest.TestCase):
     """ Tests for MasterCommunicator class """
@@ -54,6 +56,44 @@ class MasterCommunicatorTest(unittest.TestCase):
         output = comm.do_command(action, in_fields)
         self.assertEquals("OK", output["resp"])
 
+        stats = comm.get_communication_statistics()
+        self.assertEquals(1, stats['actions']['BA']['count'])
+        self.assertEquals(1, stats['wait']['count'])
+        self.assertEquals(1, stats['lanes']['normal']['count'])
+        self.assertEquals({'high' : 0, 'normal' : 0, 'low' : 0}, stats['queue'])
+        self.assertEquals({}, stats['failures'])
+        self.assertTrue(stats['utilisation'] > 0)
+
+    def test_do_command_socket_transport(self):
+        """ Test do_command over a socket that stands in for the serial port. """
+        action = master_api.basic_action()
+        in_fields = {"action_type": 1, "action_number": 2}
+        out_fields = {"resp": "OK"}
+
+        (left, right) = socket.socketpair()
+        comm = MasterCommunicator(PollTransport(left, timeout=0.1), init_master=False)
+        comm.start()
+
+        def master():
+            """ Answers the command, the answer is split over two writes. """
+            command = right.recv(1024)
+            self.assertEquals(action.create_input(1, in_fields), command)
+            answer = action.create_output(1, out_fields)
+            right.sendall(answer[:4])
+            time.sleep(0.01)
+            right.sendall(answer[4:])
+
+        threading.Thread(target=master).start()
+
+        output = comm.do_command(action, in_fields)
+        self.assertEquals("OK", output["resp"])
+        self.assertEquals(len(action.create_output(1, out_fields)), comm.get_bytes_read())
+
+        comm.stop()
+        time.sleep(0.2) # Wait until the read thread stops polling the socket.
+        left.close()
+        right.close()
+
     def test_do_command_timeout(self):
         """ Test for timeout in MasterCommunicator.do_command. """
         action = master_api.basic_action()
@@ -70,6 +110,64 @@ class MasterCommunicatorTest(unittest.TestCase):
         except CommunicationTimedOutException:
             pass
 
+        stats = comm.get_communication_statistics()
+        self.assertEquals({'timeout' : {'BA' : 1}}, stats['failures'])
+
+    def test_do_command_read_retry(self):
+        """ Test that an idempotent read command is sent again after a timeout. """
+        action = master_api.eeprom_list()
+        in_fields = {"bank" : 1}
+        out_fields = {"bank" : 1, "data" : "\xff" * 256}
+
+        serial_mock = SerialMock([sin(action.create_input(1, in_fields)),
+                                  sin(action.create_input(2, in_fields)),
+                                  sout(action.create_output(2, out_fields))])
+
+        comm = MasterCommunicator(serial_mock, init_master=False)
+        comm.start()
+
+        output = comm.do_command(action, in_fields, timeout=0.1)
+        self.assertEquals("\xff" * 256, output["data"])
+
+        stats = comm.get_communication_statistics()
+        self.assertEquals({'timeout' : {'EL' : 1}}, stats['failures'])
+
+    def test_watchdog_rate(self):
+        """ Test that the watchdog does not fire when only a small fraction of the commands
+        timed out. """
+        action = master_api.basic_action()
+        in_fields = {"action_type": 1, "action_number": 2}
+        out_fields = {"resp": "OK"}
+
+        sequence = []
+        for cid in range(1, 9):
+            sequence.append(sin(action.create_input(cid, in_fields)))
+            sequence.append(sout(action.create_output(cid, out_fields)))
+        sequence.append(sin(action.create_input(9, in_fields)))
+        sequence.append(sin(action.create_input(10, in_fields)))
+
+        watchdog = {}
+
+        def callback():
+            """ Callback for the watchdog """
+            watchdog['done'] = True
+
+        comm = MasterCommunicator(SerialMock(sequence), init_master=False,
+                                  watchdog_period=0.5, watchdog_callback=callback)
+        comm.start()
+
+        for _ in range(8):
+            comm.do_command(action, in_fields)
+        for _ in range(2):
+            try:
+                comm.do_command(action, in_fields, timeout=0.05)
+                self.fail("Should not get here !")
+            except CommunicationTimedOutException:
+                pass
+
+        time.sleep(1.2)
+        self.assertFalse('done' in watchdog)
+
     def test_do_command_timeout_test_ongoing(self):
         """ Test if communication resumes after timeout. """
         action = master_api.basic_action()
@@ -92,6 +190,166 @@ class MasterCommunicatorTest(unittest.TestCase):
         output = comm.do_command(action, in_fields)
         self.assertEquals("OK", output["resp"])
 
+    def test_do_command_timeout_late_reply(self):
+        """ Test that a reply that arrives after the timeout is not consumed anymore. """
+        action = master_api.basic_action()
+        in_fields = {"action_type": 1, "action_number": 2}
+        out_fields = {"resp": "OK"}
+
+        serial_mock = SerialMock([sin(action.create_input(1, in_fields)),
+                                  sin(action.create_input(2, in_fields)),
+                                  sout(action.create_output(1, out_fields)),
+                                  sout(action.create_output(2, out_fields))])
+
+        comm = MasterCommunicator(serial_mock, init_master=False)
+        comm.start()
+
+        self.assertRaises(CommunicationTimedOutException,
+                          lambda: comm.do_command(action, in_fields, timeout=0.1))
+
+        self.assertEquals("OK", comm.do_command(action, in_fields)["resp"])
+        self.assertEquals(action.create_output(1, out_fields), comm.get_passthrough_data())
+
+    def test_do_commands_pipelined(self):
+        """ Test do_commands with multiple commands in flight, the answers are out of order. """
+        action = master_api.basic_action()
+        in_fields1 = {"action_type": 1, "action_number": 2}
+        in_fields2 = {"action_type": 3, "action_number": 4}
+        in_fields3 = {"action_type": 5, "action_number": 6}
+
+        serial_mock = SerialMock([sin(action.create_input(1, in_fields1)),
+                                  sin(action.create_input(2, in_fields2)),
+                                  sout(action.create_output(2, {"resp": "B2"}) +
+                                       action.create_output(1, {"resp": "B1"})),
+                                  sin(action.create_input(3, in_fields3)),
+                                  sout(action.create_output(3, {"resp": "B3"}))])
+
+        comm = MasterCommunicator(serial_mock, init_master=False, pipeline_depth=2)
+        comm.start()
+
+        results = comm.do_commands([(action, in_fields1), (action, in_fields2),
+                                    (action, in_fields3)])
+
+        self.assertEquals(["B1", "B2", "B3"], [result["resp"] for result in results])
+
+    def test_do_commands_timeout(self):
+        """ Test do_commands when one of the commands times out. """
+        action = master_api.basic_action()
+        in_fields = {"action_type": 1, "action_number": 2}
+        out_fields = {"resp": "OK"}
+
+        serial_mock = SerialMock([sin(action.create_input(1, in_fields)),
+                                  sin(action.create_input(2, in_fields)),
+                                  sout(action.create_output(2, out_fields)),
+                                  sin(action.create_input(3, in_fields)),
+                                  sout(action.create_output(3, out_fields))])
+
+        comm = MasterCommunicator(serial_mock, init_master=False, pipeline_depth=2)
+        comm.start()
+
+        self.assertRaises(CommunicationTimedOutException,
+                          lambda: comm.do_commands([(action, in_fields), (action, in_fields)],
+                                                   timeout=0.2))
+
+        # The command window is released, the next command can be executed.
+        self.assertEquals("OK", comm.do_command(action, in_fields)["resp"])
+
+    def test_do_commands_return_exceptions(self):
+        """ Test that do_commands continues after a timeout when return_exceptions is set. """
+        action = master_api.basic_action()
+        in_fields = {"action_type": 1, "action_number": 2}
+        out_fields = {"resp": "OK"}
+
+        serial_mock = SerialMock([sin(action.create_input(1, in_fields)),
+                                  sin(action.create_input(2, in_fields)),
+                                  sout(action.create_output(2, out_fields)),
+                                  sin(action.create_input(3, in_fields)),
+                                  sout(action.create_output(3, out_fields))])
+
+        comm = MasterCommunicator(serial_mock, init_master=False, pipeline_depth=2)
+        comm.start()
+
+        results = comm.do_commands([(action, in_fields)] * 3, timeout=0.2,
+                                   return_exceptions=True)
+
+        self.assertTrue(isinstance(results[0], CommunicationTimedOutException))
+        self.assertEquals(["OK", "OK"], [result["resp"] for result in results[1:]])
+        self.assertEquals(0, comm.get_communication_statistics()['in_flight'])
+
+    def test_do_commands_concurrent(self):
+        """ Test do_commands from two threads that both hold places in the command window when the
+        window fills up: they complete their own commands instead of waiting for each other. """
+        action = master_api.basic_action()
+        in_fields = {"action_type": 1, "action_number": 2}
+        length = len(action.create_input(1, in_fields))
+
+        (left, right) = socket.socketpair()
+        comm = MasterCommunicator(PollTransport(left, timeout=0.1), init_master=False,
+                                  pipeline_depth=4)
+        comm.start()
+
+        def master():
+            """ Answers every command. """
+            data = ""
+            while True:
+                received = right.recv(1024)
+                if len(received) == 0:
+                    break
+                data += received
+                while len(data) >= length:
+                    right.sendall(action.create_output(ord(data[5]), {"resp": "OK"}))
+                    data = data[length:]
+
+        master_thread = threading.Thread(target=master)
+        master_thread.daemon = True
+        master_thread.start()
+
+        class GatedCommands(list):
+            """ Commands that signal the other thread after the second command is sent and wait
+            for the other thread before the third command is sent. """
+            def __init__(self, sent, other_sent):
+                list.__init__(self, [(action, in_fields)] * 6)
+                self.sent = sent
+                self.other_sent = other_sent
+
+            def __iter__(self):
+                for (i, command) in enumerate(list.__iter__(self)):
+                    if i == 2:
+                        self.sent.set()
+                        self.other_sent.wait()
+                    yield command
+
+        (sent_a, sent_b) = (threading.Event(), threading.Event())
+        results = {}
+
+        def run(name, commands):
+            """ Execute the commands and store the results. """
+            results[name] = comm.do_commands(commands, timeout=1)
+
+        threads = [threading.Thread(target=run, args=('a', GatedCommands(sent_a, sent_b))),
+                   threading.Thread(target=run, args=('b', GatedCommands(sent_b, sent_a)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+        self.assertEquals(["OK"] * 6, [result["resp"] for result in results['a']])
+        self.assertEquals(["OK"] * 6, [result["resp"] for result in results['b']])
+        self.assertEquals(0, comm.get_communication_statistics()['in_flight'])
+
+        comm.stop()
+        time.sleep(0.2) # Wait until the read thread stops polling the socket.
+        left.close()
+        right.close()
+
+    def test_pipeline_depth(self):
+        """ Test the validation of the pipeline depth. """
+        self.assertRaises(ValueError, lambda: MasterCommunicator(None, pipeline_depth=0))
+        self.assertRaises(ValueError, lambda: MasterCommunicator(None, pipeline_depth=255))
+        self.assertEquals(4, MasterCommunicator(None, pipeline_depth=4).get_pipeline_depth())
+
     def test_do_command_passthrough(self):
         """ Test for the do_command with passthrough data. """
         action = master_api.basic_action()
@@ -167,6 +425,18 @@ class MasterCommunicatorTest(unittest.TestCase):
         self.assertEquals(" my ", comm.get_passthrough_data())
         self.assertEquals("data", comm.get_passthrough_data())
 
+    def test_passthrough_held_bytes(self):
+        """ Test that trailing bytes matching the start of a prefix are passed through when no
+        more data arrives. """
+        serial_mock = SerialMock([sout("passthrough O")])
+
+        comm = MasterCommunicator(serial_mock, init_master=False)
+        comm.register_consumer(BackgroundConsumer(master_api.output_list(), 0, lambda _: None))
+        comm.start()
+
+        self.assertEquals("passthrough ", comm.get_passthrough_data())
+        self.assertEquals("O", comm.get_passthrough_data())
+
     def test_maintenance_mode(self):
         """ Test the maintenance mode. """
         serial_mock = SerialMock([sin(master_api.to_cli_mode().create_input(0)),
@@ -253,6 +523,29 @@ class MasterCommunicatorTest(unittest.TestCase):
         self.assertEquals(3, got_output["phase"])
         self.assertEquals("junk here", comm.get_passthrough_data())
 
+    def test_background_consumers_same_start_byte(self):
+        """ Test background consumers with prefixes that start with the same byte. """
+        serial_mock = SerialMock([
+                        sout("IOIL\x00\x01\x02\r\nIOL\x00\x01\x03\x0c\r\nI"),
+                        sout("L\x00\x04\x05\r\nIO\r\n")], 1)
+
+        comm = MasterCommunicator(serial_mock, init_master=False)
+
+        inputs = []
+        outputs = []
+        comm.register_consumer(BackgroundConsumer(master_api.input_list(), 0,
+                                                  lambda output: inputs.append(output["input"])))
+        comm.register_consumer(BackgroundConsumer(master_api.output_list(), 0,
+                                                  lambda output: outputs.append(output["outputs"])))
+        comm.start()
+
+        time.sleep(0.5)
+
+        self.assertEquals([1, 4], inputs)
+        self.assertEquals([[(3, int(12 * 10.0 / 6.0))]], outputs)
+        self.assertEquals("IOI", comm.get_passthrough_data())
+        self.assertEquals("IO\r\n", comm.get_passthrough_data())
+
     def test_bytes_counter(self):
         """ Test the number of bytes written and read from the serial port. """
         action = master_api.basic_action()
@@ -282,7 +575,6 @@ class MasterCommunicatorTest(unittest.TestCase):
                                   sin(action.create_input(2, in_fields)),
                                   sin(action.create_input(3, in_fields))])
 
-        timeout = False
         watchdog = {}
 
         def callback():
@@ -293,31 +585,20 @@ class MasterCommunicatorTest(unittest.TestCase):
                                   watchdog_period=4, watchdog_callback=callback)
         comm.start()
 
-        try:
-            comm.do_command(action, in_fields)
-        except CommunicationTimedOutException:
-            timeout = True
+        # The watchdog checks at 0, 4 and 8 seconds, the timeouts are explicit: a learned timeout
+        # is doubled after every timeout.
+        self.assertRaises(CommunicationTimedOutException,
+                          lambda: comm.do_command(action, in_fields, timeout=0.5))
 
-        time.sleep(6)
-
-        self.assertTrue(timeout)
+        time.sleep(4.5)
         self.assertFalse('done' in watchdog)
 
-        try:
-            comm.do_command(action, in_fields)
-        except CommunicationTimedOutException:
-            timeout = True
-
-        self.assertTrue(timeout)
+        self.assertRaises(CommunicationTimedOutException,
+                          lambda: comm.do_command(action, in_fields, timeout=0.5))
+        self.assertRaises(CommunicationTimedOutException,
+                          lambda: comm.do_command(action, in_fields, timeout=0.5))
 
-        try:
-            comm.do_command(action, in_fields)
-        except CommunicationTimedOutException:
-            timeout = True
-
-        time.sleep(6)
-
-        self.assertTrue(timeout)
+        time.sleep(4)
         self.assertTrue('done' in watchdog)
 
     def test_crc_checking(self):
@@ -349,6 +630,105 @@ class MasterCommunicatorTest(unittest.TestCase):
         self.assertRaises(CrcCheckFailedException, lambda: comm.do_command(action))
 
 
+class AdaptiveTimeoutTest(unittest.TestCase):
+    """ Tests for AdaptiveTimeout. """
+
+    def test_learn(self):
+        """ Test that the timeout is learned from the latencies. """
+        timeouts = AdaptiveTimeout(default=1.0, min_timeout=0.1, max_timeout=3.0)
+        self.assertEquals(1.0, timeouts.get_timeout('BA'))
+
+        for _ in range(AdaptiveTimeout.MIN_SAMPLES):
+            timeouts.add_measurement('BA', 0.01)
+            timeouts.add_measurement('EL', 0.6)
+
+        self.assertEquals(0.1, timeouts.get_timeout('BA')) # limited by min_timeout
+        self.assertTrue(0.6 < timeouts.get_timeout('EL') < 1.5)
+
+        for _ in range(50):
+            timeouts.add_measurement('EL', 4.0)
+        self.assertEquals(3.0, timeouts.get_timeout('EL')) # limited by max_timeout
+
+        self.assertEquals(['BA', 'EL'], sorted(timeouts.get_timeouts().keys()))
+
+    def test_backoff(self):
+        """ Test that the timeout is doubled after a timeout, until the next reply. """
+        timeouts = AdaptiveTimeout(default=1.0, min_timeout=0.1, max_timeout=3.0)
+
+        timeouts.add_timeout('BA')
+        self.assertEquals(1.0, timeouts.get_timeout('BA')) # Nothing learned yet
+
+        for _ in range(AdaptiveTimeout.MIN_SAMPLES):
+            timeouts.add_measurement('BA', 0.01)
+        timeouts.add_timeout('BA')
+        self.assertEquals(0.2, timeouts.get_timeout('BA'))
+        timeouts.add_timeout('BA')
+        self.assertEquals(0.4, timeouts.get_timeout('BA'))
+
+        timeouts.add_measurement('BA', 0.01)
+        self.assertEquals(0.1, timeouts.get_timeout('BA'))
+
+
+class CommandWindowTest(unittest.TestCase):
+    """ Tests for CommandWindow. """
+
+    def test_priorities(self):
+        """ Test that waiting threads get a place in order of priority, then in order of
+        arrival. """
+        window = CommandWindow(1, 3)
+        window.acquire()
+        order = []
+
+        def acquire(name, priority):
+            """ Wait for a place in the window and record the order. """
+            window.acquire(priority)
+            order.append(name)
+
+        threads = []
+        for (name, priority) in [('low', 2), ('high1', 0), ('normal', 1), ('high2', 0)]:
+            thread = threading.Thread(target=acquire, args=(name, priority))
+            thread.start()
+            threads.append(thread)
+            while sum(window.get_waiting()) < len(threads):
+                time.sleep(0.001)
+
+        self.assertEquals([2, 1, 1], window.get_waiting())
+
+        for i in range(4):
+            window.release()
+            while len(order) < i + 1:
+                time.sleep(0.001)
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(['high1', 'high2', 'normal', 'low'], order)
+        self.assertEquals([0, 0, 0], window.get_waiting())
+        self.assertEquals(1, window.get_in_flight())
+
+    def test_try_acquire(self):
+        """ Test that try_acquire only takes a free place when nobody is waiting. """
+        window = CommandWindow(1, 3)
+        self.assertTrue(window.try_acquire())
+        self.assertFalse(window.try_acquire())
+        window.release()
+        window.acquire_exclusive()
+        self.assertFalse(window.try_acquire())
+        window.release_exclusive()
+        self.assertTrue(window.try_acquire())
+        self.assertEquals(1, window.get_in_flight())
+
+    def test_priorities_window(self):
+        """ Test that a free place is taken immediately when nobody is waiting. """
+        window = CommandWindow(2, 3)
+        window.acquire(2)
+        window.acquire(0)
+        self.assertEquals(2, window.get_in_flight())
+        window.release()
+        window.release()
+        self.assertEquals(0, window.get_in_flight())
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
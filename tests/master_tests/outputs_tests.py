@@ -26,8 +26,13 @@ Created on Sep 22, 2012
 '''
 import unittest
 import time
+from threading import Event
 
-from master.outputs import OutputStatus
+from master.outputs import OutputStatus, OutputReader, OutputCommandQueue
+from master.eeprom_models import OutputConfiguration
+from master.master_communicator import MasterCommunicator, InMaintenanceModeException
+import master.master_api as master_api
+from serial_utils import CommunicationTimedOutException
 
 class OutputStatusTest(unittest.TestCase):
     """ Tests for OutputStatus. """
@@ -93,6 +98,224 @@ class OutputStatusTest(unittest.TestCase):
         time.sleep(0.01)
         self.assertTrue(status.should_refresh())
 
+class MasterCommunicatorDummy(object):
+    """ Dummy for the MasterCommunicator that records the basic actions. """
+
+    def __init__(self, fail=False, timeouts=None):
+        self.batches = []
+        self.fail = fail
+        self.timeouts = timeouts or []
+        self.release = Event()
+        self.release.set()
+
+    def do_commands(self, commands, priority=None, return_exceptions=False):
+        """ Record the (action_type, action_number) tuples of a batch. The commands for the
+        outputs in timeouts time out. """
+        self.release.wait()
+        self.batches.append([(fields['action_type'], fields['action_number'])
+                             for (_, fields) in commands])
+        if self.fail:
+            raise InMaintenanceModeException()
+        assert return_exceptions
+        return [CommunicationTimedOutException() if fields['action_number'] in self.timeouts
+                else {'resp' : 'OK'} for (_, fields) in commands]
+
+
+class OutputCommandQueueTest(unittest.TestCase):
+    """ Tests for OutputCommandQueue. """
+
+    def test_coalesce(self):
+        """ Test that commands for the same output in a batch are coalesced. """
+        master = MasterCommunicatorDummy()
+        queue = OutputCommandQueue(master)
+
+        futures = [queue.put(1, OutputCommandQueue.DIMMER, master_api.BA_LIGHT_ON_DIMMER_10),
+                   queue.put(1, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON),
+                   queue.put(2, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON),
+                   queue.put(1, OutputCommandQueue.DIMMER, master_api.BA_LIGHT_ON_DIMMER_50),
+                   queue.put(2, OutputCommandQueue.STATUS, master_api.BA_LIGHT_OFF)]
+        queue.start()
+
+        for future in futures:
+            self.assertEquals({'resp' : 'OK'}, future.result(1))
+
+        self.assertEquals([[(master_api.BA_LIGHT_ON, 1), (master_api.BA_LIGHT_ON_DIMMER_50, 1),
+                            (master_api.BA_LIGHT_OFF, 2)]], master.batches)
+
+    def test_off_replaces_all(self):
+        """ Test that turning an output off replaces the pending dimmer and timer. """
+        master = MasterCommunicatorDummy()
+        queue = OutputCommandQueue(master)
+
+        queue.put(1, OutputCommandQueue.DIMMER, master_api.BA_LIGHT_ON_DIMMER_10)
+        queue.put(1, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON)
+        queue.put(1, OutputCommandQueue.TIMER, master_api.BA_LIGHT_ON_TIMER_150_OVERRULE)
+        future = queue.put(1, OutputCommandQueue.STATUS, master_api.BA_LIGHT_OFF)
+        queue.start()
+
+        future.result(1)
+        self.assertEquals([[(master_api.BA_LIGHT_OFF, 1)]], master.batches)
+
+    def test_priority(self):
+        """ Test that the outputs are dispatched in priority order. """
+        master = MasterCommunicatorDummy()
+        queue = OutputCommandQueue(master)
+
+        queue.put(1, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON,
+                  MasterCommunicator.PRIORITY_LOW)
+        queue.put(2, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON)
+        queue.put(3, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON,
+                  MasterCommunicator.PRIORITY_HIGH)
+        future = queue.put(4, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON)
+        queue.start()
+
+        future.result(1)
+        self.assertEquals([[(master_api.BA_LIGHT_ON, 3), (master_api.BA_LIGHT_ON, 2),
+                            (master_api.BA_LIGHT_ON, 4), (master_api.BA_LIGHT_ON, 1)]],
+                          master.batches)
+
+    def test_next_batch(self):
+        """ Test that commands that arrive during a dispatch are sent in the next batch. """
+        master = MasterCommunicatorDummy()
+        master.release.clear()
+        queue = OutputCommandQueue(master)
+        queue.start()
+
+        future1 = queue.put(1, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON)
+        time.sleep(0.1)
+        future2 = queue.put(1, OutputCommandQueue.STATUS, master_api.BA_LIGHT_OFF)
+        self.assertFalse(future1.done())
+        master.release.set()
+
+        future2.result(1)
+        self.assertTrue(future1.done())
+        self.assertEquals([[(master_api.BA_LIGHT_ON, 1)], [(master_api.BA_LIGHT_OFF, 1)]],
+                          master.batches)
+
+    def test_idle_dispatch(self):
+        """ Test that a command is sent right away when the queue is idle. """
+        master = MasterCommunicatorDummy()
+        queue = OutputCommandQueue(master)
+        queue.start()
+        time.sleep(0.05)
+
+        start = time.time()
+        queue.put(1, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON).result(1)
+        self.assertTrue(time.time() - start < 0.01)
+
+    def test_failure(self):
+        """ Test that the futures get the exception of the master communicator. """
+        master = MasterCommunicatorDummy(fail=True)
+        queue = OutputCommandQueue(master)
+        queue.start()
+
+        future = queue.put(1, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON)
+        self.assertRaises(InMaintenanceModeException, lambda: future.result(1))
+        self.assertRaises(ValueError, lambda: queue.put(1, 'color', 1))
+
+    def test_partial_failure(self):
+        """ Test that a command that times out only fails its own futures. """
+        master = MasterCommunicatorDummy(timeouts=[2])
+        queue = OutputCommandQueue(master)
+
+        futures = [queue.put(1, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON),
+                   queue.put(2, OutputCommandQueue.DIMMER, master_api.BA_LIGHT_ON_DIMMER_10),
+                   queue.put(2, OutputCommandQueue.DIMMER, master_api.BA_LIGHT_ON_DIMMER_50),
+                   queue.put(3, OutputCommandQueue.STATUS, master_api.BA_LIGHT_ON)]
+        queue.start()
+
+        self.assertEquals({'resp' : 'OK'}, futures[0].result(1))
+        self.assertRaises(CommunicationTimedOutException, lambda: futures[1].result(1))
+        self.assertRaises(CommunicationTimedOutException, lambda: futures[2].result(1))
+        self.assertEquals({'resp' : 'OK'}, futures[3].result(1))
+        self.assertEquals(1, len(master.batches))
+
+
+class EepromControllerDummy(object):
+    """ Dummy for the EepromController that returns the output configurations. """
+
+    def __init__(self, configs):
+        self.configs = configs
+
+    def read_all(self, eeprom_model, fields=None):
+        """ Return the output configurations. """
+        assert eeprom_model == OutputConfiguration
+        return self.configs
+
+
+class ReadOutputDummy(object):
+    """ Dummy for the MasterCommunicator that answers the read_output commands. """
+
+    def __init__(self):
+        self.batches = []
+
+    def do_commands(self, commands, priority=None):
+        """ Record the ids and priority of a batch, every output is on with ctimer 100. """
+        ids = [fields['id'] for (_, fields) in commands]
+        self.batches.append((ids, priority))
+        return [{'id' : id, 'type' : 'D', 'light' : 1, 'name' : 'read%d' % id, 'timer' : 200,
+                 'floor_level' : 1, 'status' : 1, 'dimmer' : 50, 'ctimer' : 100,
+                 'controller_out' : 1, 'max_power' : 1, 'menu_position' : [0, 0, 0]}
+                for id in ids]
+
+
+class OutputReaderTest(unittest.TestCase):
+    """ Tests for OutputReader. """
+
+    def setUp(self): #pylint: disable=C0103
+        """ Run before each test. """
+        self.eeprom = EepromControllerDummy(
+                [OutputConfiguration(id=id, module_type='D', name='out%d' % id, timer=200,
+                                     floor=1) for id in range(3)])
+
+    def test_cold_start(self):
+        """ Test that all outputs are read in one low priority batch if no OL was received. """
+        master = ReadOutputDummy()
+        reader = OutputReader(master, self.eeprom)
+
+        outputs = reader.read(None)
+        self.assertEquals([([0, 1, 2], MasterCommunicator.PRIORITY_LOW)], master.batches)
+        self.assertEquals(['out0', 'out1', 'out2'], [output['name'] for output in outputs])
+        self.assertEquals([100, 100, 100], [output['ctimer'] for output in outputs])
+        self.assertEquals({'id' : 0, 'type' : 'D', 'name' : 'out0', 'timer' : 200,
+                           'floor_level' : 1, 'status' : 1, 'dimmer' : 50, 'ctimer' : 100},
+                          outputs[0])
+
+    def test_ol_merge(self):
+        """ Test that only the outputs that are on are read once an OL was received. """
+        master = ReadOutputDummy()
+        reader = OutputReader(master, self.eeprom)
+        last_outputs = [{'id' : 0, 'dimmer' : 30}, {'id' : 1, 'dimmer' : 40},
+                        {'id' : 2, 'dimmer' : 0}]
+
+        outputs = reader.read([(1, 50)], last_outputs)
+        self.assertEquals([([1], MasterCommunicator.PRIORITY_LOW)], master.batches)
+
+        self.assertEquals({'id' : 0, 'type' : 'D', 'name' : 'out0', 'timer' : 200,
+                           'floor_level' : 1, 'status' : 0, 'dimmer' : 30, 'ctimer' : 0},
+                          outputs[0])
+        self.assertEquals(('out1', 1, 100),
+                          (outputs[1]['name'], outputs[1]['status'], outputs[1]['ctimer']))
+        self.assertEquals([sorted(outputs[0].keys())] * 3,
+                          [sorted(output.keys()) for output in outputs])
+        self.assertEquals((0, 0), (outputs[2]['status'], outputs[2]['dimmer']))
+
+        status = OutputStatus(outputs)
+        status.partial_update([(0, 10)])
+        self.assertEquals([(1, 10), (0, 50), (0, 0)],
+                          [(output['status'], output['dimmer'])
+                           for output in status.get_outputs()])
+
+        # The dimmer of the outputs that are off is not in the OL message, it is read.
+        outputs = reader.read([], None)
+        self.assertEquals(([0, 1, 2], MasterCommunicator.PRIORITY_LOW), master.batches[-1])
+        self.assertEquals([50, 50, 50], [output['dimmer'] for output in outputs])
+
+        outputs = reader.read([], [{'id' : 0, 'dimmer' : 30}])
+        self.assertEquals(([1, 2], MasterCommunicator.PRIORITY_LOW), master.batches[-1])
+        self.assertEquals([30, 50, 50], [output['dimmer'] for output in outputs])
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
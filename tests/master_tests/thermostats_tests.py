@@ -42,6 +42,18 @@ class ThermostatStatusTest(unittest.TestCase):
         time.sleep(0.01)
         self.assertTrue(status.should_refresh())
 
+    def test_no_refresh_period(self):
+        """ Test that a status without refresh period is only refreshed when forced. """
+        status = ThermostatStatus([], None)
+        time.sleep(0.01)
+        self.assertFalse(status.should_refresh())
+
+        status.force_refresh()
+        self.assertTrue(status.should_refresh())
+
+        status.update([])
+        self.assertFalse(status.should_refresh())
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
@@ -0,0 +1,142 @@
+'''
+OpenMotics - Gateway
+Copyright (C) 2014 - OpenMotics <info@openmotics.com>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+'''
+Tests for the EnergyStore.
+
+@author: fryckbos
+'''
+import unittest
+import os
+import shutil
+import time
+
+from power.energy_store import EnergyStore
+
+class EnergyStoreTest(unittest.TestCase):
+    """ Tests for EnergyStore. """
+
+    DIRECTORY = "energy_test"
+    TIERS = [(1, 10), (60, 5)]
+
+    def setUp(self): #pylint: disable=C0103
+        """ Run before each test. """
+        if os.path.exists(EnergyStoreTest.DIRECTORY):
+            shutil.rmtree(EnergyStoreTest.DIRECTORY)
+
+    def tearDown(self): #pylint: disable=C0103
+        """ Run after each test. """
+        if os.path.exists(EnergyStoreTest.DIRECTORY):
+            shutil.rmtree(EnergyStoreTest.DIRECTORY)
+
+    def test_add_and_get(self):
+        """ Test adding samples and reading them per resolution. """
+        store = EnergyStore(EnergyStoreTest.DIRECTORY, EnergyStoreTest.TIERS)
+        store.add(1, [100.0] * 8, 600)
+        store.add(1, [200.0] * 8, 600.5)
+        store.add(1, [60.0] + [0.0] * 7, 602)
+
+        history = store.get_history(1, 600, 605, resolution=1)
+        self.assertEquals(1, history['resolution'])
+        self.assertEquals([600, 602], [slot[0] for slot in history['data']])
+        self.assertEquals([150.0] * 8, history['data'][0][1])
+        self.assertEquals(60.0, history['data'][1][1][0])
+
+        history = store.get_history(1, 600, 605, resolution=60)
+        self.assertEquals(1, len(history['data']))
+        self.assertEquals(120.0, history['data'][0][1][0])
+        self.assertEquals(2.0, history['data'][0][2][0]) # 120 W for 1 minute = 2 Wh
+
+        self.assertEquals({'resolution' : 1, 'data' : []}, store.get_history(2, 600, 605, 1))
+        self.assertFalse(os.path.exists(os.path.join(EnergyStoreTest.DIRECTORY, 'module_2.dat')))
+        self.assertRaises(ValueError, store.get_history, 1, 600, 605, 10)
+        store.close()
+
+    def test_counters(self):
+        """ Test that the increase of the energy counters is added to the slots, also across a
+        restart of the store. """
+        store = EnergyStore(EnergyStoreTest.DIRECTORY, EnergyStoreTest.TIERS)
+        store.add(1, [10.0] * 8, 600, [[100.0, 50.0]] * 8)
+        store.add(1, [10.0] * 8, 601, [[102.5, 50.0]] * 8)
+        store.add(1, [10.0] * 8, 601.5)
+        store.add(1, [10.0] * 8, 602, [[103.0, 51.0]] + [[102.5, 50.0]] * 7)
+
+        history = store.get_history(1, 600, 602, resolution=1)
+        self.assertEquals([[0.0, 0.0], [2.5, 0.0], [0.5, 1.0]],
+                          [slot[3][0] for slot in history['data']])
+        self.assertEquals([0.0, 0.0], history['data'][2][3][1])
+
+        history = store.get_history(1, 600, 602, resolution=60)
+        self.assertEquals([3.0, 1.0], history['data'][0][3][0])
+        store.close()
+
+        # The last counters are kept in the file, a reset counter starts from 0.
+        store = EnergyStore(EnergyStoreTest.DIRECTORY, EnergyStoreTest.TIERS)
+        store.add(1, [10.0] * 8, 610, [[104.0, 2.0]] + [[102.5, 50.0]] * 7)
+        history = store.get_history(1, 610, 610, resolution=1)
+        self.assertEquals([[1.0, 2.0]] + [[0.0, 0.0]] * 7, history['data'][0][3])
+        store.close()
+
+    def test_wrap_around(self):
+        """ Test that old slots are overwritten and not returned. """
+        store = EnergyStore(EnergyStoreTest.DIRECTORY, EnergyStoreTest.TIERS)
+        for timestamp in range(1000, 1015):
+            store.add(1, [float(timestamp)] * 8, timestamp)
+
+        history = store.get_history(1, 1000, 1014, resolution=1)
+        self.assertEquals(range(1005, 1015), [slot[0] for slot in history['data']])
+        self.assertEquals(1014.0, history['data'][-1][1][0])
+
+        # The slot of 1003 was overwritten by 1013.
+        self.assertEquals([], store.get_history(1, 1003, 1003, resolution=1)['data'])
+        store.close()
+
+    def test_persistence(self):
+        """ Test that the samples are kept when the store is reopened, and that the files are
+        replaced by add if the tiers change. """
+        store = EnergyStore(EnergyStoreTest.DIRECTORY, EnergyStoreTest.TIERS)
+        store.add(3, [5.0] * 8, 1200)
+        store.close()
+
+        filename = os.path.join(EnergyStoreTest.DIRECTORY, 'module_3.dat')
+        self.assertEquals(store.get_file_size(), os.path.getsize(filename))
+
+        store = EnergyStore(EnergyStoreTest.DIRECTORY, EnergyStoreTest.TIERS)
+        self.assertEquals(1, len(store.get_history(3, 1200, 1200, 1)['data']))
+        store.close()
+
+        store = EnergyStore(EnergyStoreTest.DIRECTORY, [(1, 20)])
+        self.assertEquals([], store.get_history(3, 1200, 1200, 1)['data'])
+        self.assertNotEquals(store.get_file_size(), os.path.getsize(filename))
+        store.add(3, [5.0] * 8, 1300)
+        store.close()
+        self.assertEquals(store.get_file_size(), os.path.getsize(filename))
+
+    def test_select_resolution(self):
+        """ Test that the finest resolution that covers the range is used. """
+        store = EnergyStore(EnergyStoreTest.DIRECTORY, EnergyStoreTest.TIERS)
+        now = time.time()
+        self.assertEquals(1, store.get_history(1, now - 5)['resolution'])
+        self.assertEquals(60, store.get_history(1, now - 100)['resolution'])
+        self.assertEquals(60, store.get_history(1, now - 10000)['resolution'])
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
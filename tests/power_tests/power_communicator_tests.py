@@ -30,7 +30,9 @@ import time
 
 import power.power_api as power_api
 from power.power_controller import PowerController
-from power.power_communicator import PowerCommunicator, InAddressModeException
+from power.power_communicator import PowerCommunicator, InAddressModeException, \
+                                     PowerFrameParser, CrcCheckFailedException, \
+                                     ModuleUnavailableException, PowerModuleHealth
 
 from serial_tests import SerialMock, sin, sout
 from serial_utils import CommunicationTimedOutException
@@ -125,6 +127,83 @@ class PowerCommunicatorTest(unittest.TestCase):
 
         self.assertEquals((49.5, ), output)
 
+    def test_do_command_noise(self):
+        """ Test PowerCommunicator.do_command when there is noise on the bus. """
+        action = power_api.get_voltage()
+        out = action.create_output(1, 1, 49.5)
+
+        serial_mock = SerialMock(
+                        [sin(action.create_input(1, 1)),
+                         sout('\x00RT\xff' + out[:5]), sout(out[5:] + 'R')])
+
+        comm = self.__get_communicator(serial_mock)
+        comm.start()
+
+        self.assertEquals((49.5, ), comm.do_command(1, action))
+        self.assertEquals({'frames' : 1, 'skipped_bytes' : 4, 'framing_errors' : 0,
+                           'crc_errors' : 0}, comm.get_communication_statistics()['framing'])
+
+    def test_module_unavailable(self):
+        """ Test that a module that fails repeatedly is only probed after a backoff. """
+        action = power_api.get_voltage()
+
+        sequence = []
+        for cid in range(1, 7):
+            sequence.extend([sin(action.create_input(1, cid)), sout('')])
+        sequence.extend([sin(action.create_input(1, 7)), sout(''),
+                         sin(action.create_input(1, 8)), sout(action.create_output(1, 8, 49.5))])
+        serial_mock = SerialMock(sequence, 0.01)
+
+        comm = self.__get_communicator(serial_mock)
+        comm.start()
+
+        old_backoff = PowerModuleHealth.BACKOFF
+        try:
+            PowerModuleHealth.BACKOFF = 0.3
+
+            for _ in range(3):
+                self.assertRaises(CommunicationTimedOutException, comm.do_command, 1, action)
+            self.assertEquals('unavailable', comm.get_module_health()[1]['state'])
+
+            # No communication until the backoff expired.
+            self.assertRaises(ModuleUnavailableException, comm.do_command, 1, action)
+
+            # The probe is not retried and doubles the backoff.
+            time.sleep(0.35)
+            self.assertRaises(CommunicationTimedOutException, comm.do_command, 1, action)
+            self.assertEquals(4, comm.get_module_health()[1]['failures'])
+            self.assertRaises(ModuleUnavailableException, comm.do_command, 1, action)
+
+            time.sleep(0.65)
+            self.assertEquals((49.5, ), comm.do_command(1, action))
+        finally:
+            PowerModuleHealth.BACKOFF = old_backoff
+
+        self.assertEquals('ok', comm.get_module_health()[1]['state'])
+
+    def test_module_health_backoff(self):
+        """ Test the exponential backoff of PowerModuleHealth. """
+        health = PowerModuleHealth()
+        health.record_failure(0)
+        health.record_failure(0)
+        self.assertTrue(health.allow(0))
+        self.assertEquals('failing', health.to_dict(0)['state'])
+
+        health.record_failure(100)
+        self.assertFalse(health.allow(104))
+        self.assertTrue(health.allow(105))
+
+        health.record_failure(105)
+        self.assertEquals(10, health.to_dict(105)['next_probe'])
+
+        for _ in range(20):
+            health.record_failure(200)
+        self.assertEquals(PowerModuleHealth.MAX_BACKOFF, health.to_dict(200)['next_probe'])
+
+        health.record_success(300)
+        self.assertEquals({'state' : 'ok', 'failures' : 0, 'last_success' : 300,
+                           'next_probe' : 0}, health.to_dict(300))
+
     def test_wrong_response(self):
         """ Test PowerCommunicator.do_command when the power module returns a wrong response. """
         action_1 = power_api.get_voltage()
@@ -238,6 +317,65 @@ class PowerCommunicatorTest(unittest.TestCase):
         self.assertEquals((243, ), comm.do_command(1, action))
 
 
+class PowerFrameParserTest(unittest.TestCase):
+    """ Tests for PowerFrameParser class """
+
+    def test_frames(self):
+        """ Test parsing frames that are split and joined. """
+        out_1 = power_api.get_voltage().create_output(1, 1, 49.5)
+        out_2 = power_api.get_frequency().create_output(2, 2, 50.0)
+
+        parser = PowerFrameParser()
+        parser.feed(out_1[:10])
+        self.assertEquals(None, parser.get_frame())
+        parser.feed(out_1[10:] + out_2)
+        self.assertEquals((out_1[3:11], out_1[11:15]), parser.get_frame())
+        self.assertEquals((out_2[3:11], out_2[11:15]), parser.get_frame())
+        self.assertEquals(None, parser.get_frame())
+
+    def test_resync(self):
+        """ Test that the parser resynchronizes on the next frame after a framing error. """
+        out = power_api.get_voltage().create_output(1, 1, 49.5)
+
+        parser = PowerFrameParser()
+        # A truncated frame, followed by a complete frame.
+        parser.feed(out[:12] + out)
+        self.assertEquals((out[3:11], out[11:15]), parser.get_frame())
+        self.assertEquals({'frames' : 1, 'skipped_bytes' : 12, 'framing_errors' : 1,
+                           'crc_errors' : 0}, parser.get_statistics())
+
+    def test_crc_error(self):
+        """ Test that a frame with a wrong crc is dropped. """
+        out = power_api.get_voltage().create_output(1, 1, 49.5)
+        bad = out[:-3] + chr((ord(out[-3]) + 1) % 256) + out[-2:]
+
+        parser = PowerFrameParser()
+        parser.feed(bad + out)
+        self.assertRaises(CrcCheckFailedException, parser.get_frame)
+        self.assertEquals((out[3:11], out[11:15]), parser.get_frame())
+
+    def test_byte_at_a_time(self):
+        """ Test that the crc is calculated correctly when the frames arrive one byte at a time,
+        also after a crc error and a framing error. """
+        out = power_api.get_voltage().create_output(1, 1, 49.5)
+        bad = out[:-3] + chr((ord(out[-3]) + 1) % 256) + out[-2:]
+
+        parser = PowerFrameParser()
+        (frames, crc_errors) = ([], 0)
+        for byte in out + bad + out[:12] + out + out:
+            parser.feed(byte)
+            try:
+                frame = parser.get_frame()
+            except CrcCheckFailedException:
+                crc_errors += 1
+            else:
+                if frame is not None:
+                    frames.append(frame)
+
+        self.assertEquals([(out[3:11], out[11:15])] * 3, frames)
+        self.assertEquals(1, crc_errors)
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -149,6 +149,23 @@ class PowerControllerTest(unittest.TestCase):
                                'times6': None, 'times7': None}},
                           power_controller.get_power_modules())
 
+    def test_change_listener(self):
+        """ Test that the change listeners are called when a module is added or changed. """
+        power_controller = self.__get_controller()
+        changes = []
+        power_controller.add_change_listener(lambda: changes.append(True))
+
+        power_controller.register_power_module(1)
+        self.assertEquals(1, len(changes))
+
+        module = power_controller.get_power_modules()[1]
+        module['times0'] = "08:00,20:00"
+        power_controller.update_power_module(module)
+        self.assertEquals(2, len(changes))
+
+        power_controller.readdress_power_module(1, 2)
+        self.assertEquals(3, len(changes))
+
     def test_get_address(self):
         """ Test for get_address. """
         power_controller = self.__get_controller()
@@ -159,6 +176,35 @@ class PowerControllerTest(unittest.TestCase):
 
         self.assertEquals(3, power_controller.get_address(1))
 
+    def test_reload(self):
+        """ Test that the power modules are loaded from the database. """
+        power_controller = self.__get_controller()
+        power_controller.register_power_module(1)
+        power_controller.register_power_module(4)
+        power_controller.readdress_power_module(4, 7)
+
+        module = power_controller.get_power_modules()[1]
+        module.update({'name' : 'module1', 'input3' : 'in3', 'sensor2' : 2, 'times5' : '00:00'})
+        power_controller.update_power_module(module)
+        power_controller.close()
+
+        reloaded = self.__get_controller()
+        self.assertEquals(power_controller.get_power_modules(), reloaded.get_power_modules())
+        self.assertEquals('module1', reloaded.get_power_modules()[1]['name'])
+        self.assertEquals(7, reloaded.get_address(2))
+        self.assertTrue(reloaded.module_exists(7))
+        self.assertFalse(reloaded.module_exists(4))
+        self.assertEquals(8, reloaded.get_free_address())
+
+    def test_get_power_modules_copy(self):
+        """ Test that changing the result of get_power_modules does not change the registry. """
+        power_controller = self.__get_controller()
+        power_controller.register_power_module(1)
+
+        power_controller.get_power_modules()[1]['address'] = "E1"
+        self.assertEquals(1, power_controller.get_power_modules()[1]['address'])
+        self.assertEquals(None, power_controller.get_address(2))
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
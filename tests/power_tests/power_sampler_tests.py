@@ -0,0 +1,226 @@
+'''
+OpenMotics - Gateway
+Copyright (C) 2014 - OpenMotics <info@openmotics.com>
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''
+
+'''
+Tests for the PowerSampler.
+
+@author: fryckbos
+'''
+import unittest
+import time
+
+import power.power_api as power_api
+from power.power_sampler import PowerSampler
+
+class PowerControllerDummy(object):
+    """ Dummy that returns a fixed set of power modules. """
+
+    def __init__(self, modules):
+        self.modules = modules
+
+    def get_power_modules(self):
+        """ Get the power modules, only the address is used by the PowerSampler. """
+        return dict([(module_id, {'id' : module_id, 'address' : address})
+                     for (module_id, address) in self.modules.items()])
+
+
+class PowerCommunicatorDummy(object):
+    """ Dummy that returns the address of the module as voltage and records the commands. """
+
+    def __init__(self):
+        self.commands = []
+        self.fail = set()
+
+    def do_command(self, address, cmd):
+        """ Execute a command. """
+        self.commands.append((address, cmd.type))
+        if address in self.fail:
+            raise Exception("Module %d did not respond" % address)
+
+        if cmd == power_api.get_voltage() or cmd == power_api.get_frequency():
+            return (float(address), )
+        elif cmd == power_api.get_day_energy() or cmd == power_api.get_night_energy():
+            return tuple([address] * 8)
+        else:
+            return tuple([float('nan')] * 8)
+
+
+class PowerSamplerTest(unittest.TestCase):
+    """ Tests for PowerSampler. """
+
+    def test_round_robin(self):
+        """ Test that one module is sampled per call to sample_next, in the order of the ids. """
+        communicator = PowerCommunicatorDummy()
+        sampler = PowerSampler(communicator, PowerControllerDummy({1 : 10, 2 : 20}))
+
+        sampler.sample_next()
+        sampler.sample_next()
+        sampler.sample_next()
+
+        self.assertEquals([10] * 4 + [20] * 4 + [10] * 4,
+                          [address for (address, _) in communicator.commands])
+
+    def test_get_realtime_power(self):
+        """ Test that the samples are returned and only sampled again if they are too old. """
+        communicator = PowerCommunicatorDummy()
+        controller = PowerControllerDummy({1 : 10, 2 : 20})
+        sampler = PowerSampler(communicator, controller)
+
+        sampler.sample_next()
+        sampler.sample_next()
+        self.assertEquals(8, len(communicator.commands))
+
+        (output, timestamps, _) = sampler.get_realtime_power()
+        self.assertEquals(['1', '2'], sorted(output.keys()))
+        self.assertEquals(['1', '2'], sorted(timestamps.keys()))
+        self.assertEquals([10.0, 10.0, 0.0, 0.0], output['1'][0])
+        self.assertEquals([20.0, 20.0, 0.0, 0.0], output['2'][7])
+        self.assertEquals(8, len(communicator.commands))
+
+        time.sleep(0.05)
+        self.assertEquals((output, timestamps, []), sampler.get_realtime_power(max_age=1))
+        self.assertEquals(8, len(communicator.commands))
+
+        # Without a background thread, the caller samples the too old modules.
+        (_, new_timestamps, _) = sampler.get_realtime_power(max_age=0.01)
+        self.assertTrue(new_timestamps['1'] > timestamps['1'])
+        self.assertEquals(16, len(communicator.commands))
+
+        # A new module is sampled when it is read, a removed module is dropped.
+        controller.modules = {2 : 20, 3 : 30}
+        (output, _, _) = sampler.get_realtime_power()
+        self.assertEquals(['2', '3'], sorted(output.keys()))
+        self.assertEquals(20, len(communicator.commands))
+
+    def test_refresh_in_background(self):
+        """ Test that a reader gets the last samples right away and that the background thread
+        samples the too old modules before the next period. """
+        communicator = PowerCommunicatorDummy()
+        sampler = PowerSampler(communicator, PowerControllerDummy({1 : 10, 2 : 20}), 10)
+        sampler.start()
+        try:
+            # The first module is sampled when the thread starts, the second one is requested.
+            time.sleep(0.05)
+            (output, timestamps, _) = sampler.get_realtime_power()
+            self.assertEquals(['1'], timestamps.keys())
+
+            for _ in range(100):
+                if '2' in sampler.get_realtime_power()[1]:
+                    break
+                time.sleep(0.01)
+            self.assertEquals(8, len(communicator.commands))
+
+            (output, timestamps, _) = sampler.get_realtime_power()
+            self.assertEquals(['1', '2'], sorted(output.keys()))
+
+            # A too old sample is returned right away and refreshed by the thread.
+            time.sleep(0.05)
+            self.assertEquals(timestamps, sampler.get_realtime_power(max_age=0.01)[1])
+            for _ in range(100):
+                new_timestamps = sampler.get_realtime_power()[1]
+                if new_timestamps['1'] != timestamps['1'] and \
+                   new_timestamps['2'] != timestamps['2']:
+                    break
+                time.sleep(0.01)
+            self.assertEquals(16, len(communicator.commands))
+        finally:
+            sampler.stop()
+            time.sleep(0.1) # Let the thread stop before the interpreter exits.
+
+    def test_failing_module(self):
+        """ Test that a module that does not respond does not stop the sampling, and that its
+        last values are returned as stale. """
+        communicator = PowerCommunicatorDummy()
+        communicator.fail.add(10)
+        sampler = PowerSampler(communicator, PowerControllerDummy({1 : 10, 2 : 20}))
+
+        sampler.sample_next()
+        sampler.sample_next()
+
+        (output, _, stale) = sampler.get_realtime_power(max_age=1)
+        self.assertEquals((['2'], ['1']), (output.keys(), stale))
+        self.assertEquals(['1'], sampler.get_stale())
+
+        communicator.fail = set([20])
+        sampler.sample_next()
+        sampler.sample_next()
+
+        (output, _, stale) = sampler.get_realtime_power(max_age=1)
+        self.assertEquals((['1', '2'], ['2']), (sorted(output.keys()), stale))
+        self.assertEquals([20.0, 20.0, 0.0, 0.0], output['2'][0])
+        self.assertEquals(['2'], sampler.get_stale())
+
+    def test_read_total_energy(self):
+        """ Test that the last energy counters of a module that does not respond are returned with
+        the time they were read and that the module is stale. """
+        communicator = PowerCommunicatorDummy()
+        controller = PowerControllerDummy({1 : 10, 2 : 20})
+        sampler = PowerSampler(communicator, controller)
+
+        before = time.time()
+        (output, timestamps, stale) = sampler.read_total_energy()
+        self.assertEquals({'1' : [[10, 10]] * 8, '2' : [[20, 20]] * 8}, output)
+        self.assertEquals([], stale)
+        self.assertTrue(timestamps['1'] >= before and timestamps['2'] >= before)
+
+        time.sleep(0.01)
+        communicator.fail.add(20)
+        (new_output, new_timestamps, stale) = sampler.read_total_energy()
+        self.assertEquals(output, new_output)
+        self.assertEquals(['2'], stale)
+        self.assertTrue(new_timestamps['1'] > timestamps['1'])
+        self.assertEquals(timestamps['2'], new_timestamps['2'])
+
+        # A removed module is dropped.
+        controller.modules = {1 : 10}
+        self.assertEquals((['1'], []), (sampler.read_total_energy()[0].keys(),
+                                        sampler.read_total_energy()[2]))
+
+    def test_energy_store(self):
+        """ Test that the power of the samples is added to the energy store. """
+        class EnergyStoreDummy(object):
+            """ Records the added samples. """
+            def __init__(self):
+                self.samples = []
+
+            def add(self, module_id, power, timestamp, counters):
+                """ Add a sample. """
+                self.samples.append((module_id, power, counters))
+
+        store = EnergyStoreDummy()
+        sampler = PowerSampler(PowerCommunicatorDummy(), PowerControllerDummy({1 : 10}),
+                               energy_store=store)
+        sampler.sample_next()
+
+        self.assertEquals([(1, [0.0] * 8, [[10, 10]] * 8)], store.samples)
+
+    def test_background_thread(self):
+        """ Test that the background thread samples the modules. """
+        communicator = PowerCommunicatorDummy()
+        sampler = PowerSampler(communicator, PowerControllerDummy({1 : 10}), 0.01)
+        sampler.start()
+        time.sleep(0.1)
+        sampler.stop()
+
+        self.assertTrue(len(communicator.commands) >= 8)
+        self.assertEquals(['1'], sampler.get_realtime_power(max_age=1)[0].keys())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -23,13 +23,51 @@ Created on Mar 2, 2013
 @author: fryckbos
 '''
 import unittest
+import time
 from datetime import datetime
 
-from power.time_keeper import TimeKeeper
+import power.power_api as power_api
+from power.time_keeper import TimeKeeper, Schedule
 
 class PowerControllerDummy(object):
-    """ Dummy. """
-    pass
+    """ Dummy that returns a fixed set of power modules. """
+
+    def __init__(self, times=None):
+        self.times = times if times is not None else {}
+        self.listeners = []
+
+    def add_change_listener(self, listener):
+        """ Add a change listener. """
+        self.listeners.append(listener)
+
+    def change(self, address, times):
+        """ Change the times of a module and call the listeners. """
+        self.times[address] = times
+        for listener in self.listeners:
+            listener()
+
+    def get_power_modules(self):
+        """ Get the power modules: the key of times is the address, the value the times. """
+        modules = {}
+        for (address, times) in self.times.items():
+            modules[address] = {'id' : address, 'address' : address}
+            for i in range(8):
+                modules[address]['times%d' % i] = times
+        return modules
+
+
+class PowerCommunicatorDummy(object):
+    """ Dummy that records the commands. """
+
+    def __init__(self):
+        self.commands = []
+        self.fail = False
+
+    def do_command(self, address, cmd, *data):
+        """ Execute a command. """
+        self.commands.append((address, cmd.type, data))
+        if self.fail:
+            raise Exception("Power module %d did not respond" % address)
 
 class TimeKeeperTest(unittest.TestCase):
     """ Tests for TimeKeeper. """
@@ -80,6 +118,107 @@ class TimeKeeperTest(unittest.TestCase):
         self.assertFalse(tkeep.is_day_time(None, datetime(2013, 3, 10, 12, 20, 0))) # Sunday 12:00
         self.assertFalse(tkeep.is_day_time(None, datetime(2013, 3, 10, 18, 0, 0))) # Sunday 18:00
 
+    def test_schedule_wrap(self):
+        """ Test day time that continues over midnight and over the end of the week. """
+        schedule = Schedule(",".join(["18:00,24:00", "00:00,08:00"] * 3 + ["00:00,24:00"]))
+
+        self.assertFalse(schedule.is_day(0)) # Monday 00:00, Sunday stops at 24:00
+        self.assertEquals(18 * 60, schedule.get_minutes_to_next(0))
+        self.assertTrue(schedule.is_day(1440 + 60)) # Tuesday 01:00
+        self.assertEquals(7 * 60, schedule.get_minutes_to_next(1440 + 60))
+        self.assertFalse(schedule.is_day(1440 + 8 * 60)) # Tuesday 08:00
+        self.assertTrue(schedule.is_day(5 * 1440 + 60)) # Saturday 01:00, from Friday 18:00
+        self.assertTrue(schedule.is_day(6 * 1440 + 23 * 60)) # Sunday 23:00
+        self.assertEquals(60, schedule.get_minutes_to_next(6 * 1440 + 23 * 60))
+
+        self.assertFalse(Schedule(None).is_day(0))
+        self.assertEquals(7 * 1440, Schedule(None).get_minutes_to_next(0))
+
+    def test_schedule_malformed(self):
+        """ Test that malformed or missing times only remove the day time of their day. """
+        times = ",".join(["08:00,20:00", "8h,20:00", ",", "08:00,25:00"] +
+                         ["08:00,20:00"] * 2)
+        schedule = Schedule(times)
+
+        self.assertTrue(schedule.is_day(12 * 60)) # Monday 12:00
+        self.assertFalse(schedule.is_day(1440 + 12 * 60)) # Tuesday 12:00, malformed start
+        self.assertFalse(schedule.is_day(2 * 1440 + 12 * 60)) # Wednesday 12:00, empty
+        self.assertFalse(schedule.is_day(3 * 1440 + 12 * 60)) # Thursday 12:00, stop > 24:00
+        self.assertTrue(schedule.is_day(4 * 1440 + 12 * 60)) # Friday 12:00
+        self.assertFalse(schedule.is_day(6 * 1440 + 12 * 60)) # Sunday 12:00, missing
+
+        self.assertFalse(Schedule("").is_day(12 * 60))
+
+    def test_run_once_malformed(self):
+        """ Test that a module with malformed times does not stop the other modules. """
+        controller = PowerControllerDummy({1 : "garbage", 2 : ",".join(["08:00,20:00"] * 7)})
+        communicator = PowerCommunicatorDummy()
+        tkeep = TimeKeeper(communicator, controller, 60)
+
+        tkeep.run_once(datetime(2013, 3, 4, 12, 0, 0))
+        self.assertEquals([(1, 'SDN', tuple([power_api.NIGHT] * 8)),
+                           (2, 'SDN', tuple([power_api.DAY] * 8))], sorted(communicator.commands))
+
+    def test_run_once(self):
+        """ Test that the mode is only set when it changes, and broadcasted if the modules agree.
+        """
+        day = ",".join(["08:00,20:00"] * 7)
+        controller = PowerControllerDummy({1 : day, 2 : day})
+        communicator = PowerCommunicatorDummy()
+        tkeep = TimeKeeper(communicator, controller, 60)
+
+        # Monday 07:59:30: 30 seconds to the transition.
+        self.assertEquals(30, tkeep.run_once(datetime(2013, 3, 4, 7, 59, 30)))
+        self.assertEquals([(power_api.BROADCAST_ADDRESS, 'SDN', tuple([power_api.NIGHT] * 8))],
+                          communicator.commands)
+
+        self.assertEquals(12 * 3600, tkeep.run_once(datetime(2013, 3, 4, 8, 0, 0)))
+        self.assertEquals(2, len(communicator.commands))
+        self.assertEquals((power_api.BROADCAST_ADDRESS, 'SDN', tuple([power_api.DAY] * 8)),
+                          communicator.commands[1])
+
+        tkeep.run_once(datetime(2013, 3, 4, 9, 0, 0))
+        self.assertEquals(2, len(communicator.commands))
+
+        # A module that does not agree is set separately.
+        controller.times[2] = None
+        tkeep.run_once(datetime(2013, 3, 4, 9, 0, 0))
+        self.assertEquals([(2, 'SDN', tuple([power_api.NIGHT] * 8))], communicator.commands[2:])
+
+    def test_broadcast_failure(self):
+        """ Test that a failed broadcast is retried after RETRY_DELAY seconds. """
+        day = ",".join(["08:00,20:00"] * 7)
+        communicator = PowerCommunicatorDummy()
+        communicator.fail = True
+        tkeep = TimeKeeper(communicator, PowerControllerDummy({1 : day, 2 : day}), 3600)
+
+        self.assertEquals(TimeKeeper.RETRY_DELAY, tkeep.run_once(datetime(2013, 3, 4, 9, 0, 0)))
+
+        communicator.fail = False
+        self.assertEquals(11 * 3600, tkeep.run_once(datetime(2013, 3, 4, 9, 0, 0)))
+        self.assertEquals(2, len(communicator.commands))
+
+    def test_wakeup_on_change(self):
+        """ Test that the thread sleeps until the next transition and that a change of the
+        modules wakes it. """
+        controller = PowerControllerDummy({1 : None})
+        communicator = PowerCommunicatorDummy()
+        tkeep = TimeKeeper(communicator, controller, 3600)
+        tkeep.start()
+        try:
+            time.sleep(0.05)
+            self.assertEquals([(1, 'SDN', tuple([power_api.NIGHT] * 8))], communicator.commands)
+
+            controller.change(1, ",".join(["00:00,24:00"] * 7))
+            for _ in range(100):
+                if len(communicator.commands) == 2:
+                    break
+                time.sleep(0.01)
+            self.assertEquals((1, 'SDN', tuple([power_api.DAY] * 8)), communicator.commands[-1])
+        finally:
+            tkeep.stop()
+            time.sleep(0.1) # Let the thread stop before the interpreter exits.
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
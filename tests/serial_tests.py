@@ -18,17 +18,22 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 '''
 
 """
-Contains the SerialMock.
+Contains the SerialMock and the tests for the transports.
 
 Created on Dec 29, 2012
 
 @author: fryckbos
 """
+import os
+import pty
+import tty
 import time
+import socket
 import threading
 import unittest
 
-from serial_utils import printable
+from serial_utils import printable, PollTransport, BlockingTransport, get_transport, \
+                         LatencyHistogram, CommunicationStats
 
 def sin(data):
     """ Input for the SerialMock """
@@ -154,6 +159,117 @@ class SerialMockTest(unittest.TestCase):
         serial_mock.read(1)
         self.assertEquals(1, phase['phase'])
 
+
+class TransportTest(unittest.TestCase):
+    """ Tests for the transports. """
+
+    def test_poll_transport_pty(self):
+        """ Test that the PollTransport drains all available bytes from a pty. """
+        (master_fd, slave_fd) = pty.openpty()
+        tty.setraw(slave_fd)
+        stream = os.fdopen(master_fd, 'r+b', 0)
+        try:
+            transport = PollTransport(stream, timeout=0.01)
+            buffer = bytearray(16)
+
+            self.assertEquals(0, transport.recv_into(buffer))
+
+            os.write(slave_fd, "abcdef")
+            time.sleep(0.01)
+            self.assertEquals(6, transport.recv_into(buffer))
+            self.assertEquals("abcdef", str(buffer[:6]))
+
+            transport.write("xyz")
+            self.assertEquals("xyz", os.read(slave_fd, 3))
+        finally:
+            stream.close()
+            os.close(slave_fd)
+
+    def test_poll_transport_socket(self):
+        """ Test the PollTransport over a socket. """
+        (left, right) = socket.socketpair()
+        try:
+            transport = PollTransport(left, timeout=0.01)
+            buffer = bytearray(4)
+
+            right.sendall("abcdef")
+            self.assertEquals(4, transport.recv_into(buffer))
+            self.assertEquals("abcd", str(buffer))
+            self.assertEquals(2, transport.recv_into(buffer))
+            self.assertEquals("ef", str(buffer[:2]))
+
+            transport.write("xyz")
+            self.assertEquals("xyz", right.recv(3))
+        finally:
+            left.close()
+            right.close()
+
+    def test_blocking_transport(self):
+        """ Test the BlockingTransport over the SerialMock. """
+        transport = BlockingTransport(SerialMock([sout("abcdef")]))
+        buffer = bytearray(4)
+        self.assertEquals(4, transport.recv_into(buffer))
+        self.assertEquals("abcd", str(buffer))
+        self.assertEquals(2, transport.recv_into(buffer))
+        self.assertEquals("ef", str(buffer[:2]))
+
+    def test_get_transport(self):
+        """ Test the transport selection. """
+        (left, right) = socket.socketpair()
+        try:
+            transport = get_transport(left)
+            self.assertTrue(isinstance(transport, PollTransport))
+            self.assertTrue(transport is get_transport(transport))
+            self.assertTrue(isinstance(get_transport(SerialMock([])), BlockingTransport))
+        finally:
+            left.close()
+            right.close()
+
+
+class CommunicationStatsTest(unittest.TestCase):
+    """ Tests for LatencyHistogram and CommunicationStats. """
+
+    def test_histogram(self):
+        """ Test the buckets and percentiles of the LatencyHistogram. """
+        histogram = LatencyHistogram()
+        self.assertEquals(None, histogram.get_percentile(50))
+
+        for _ in range(90):
+            histogram.add(0.003)
+        for _ in range(9):
+            histogram.add(0.04)
+        histogram.add(7.0)
+
+        ret = histogram.to_dict()
+        self.assertEquals(100, ret['count'])
+        self.assertEquals(7.0, ret['max'])
+        self.assertEquals(0.005, ret['p50'])
+        self.assertEquals(0.005, ret['p90'])
+        self.assertEquals(0.05, ret['p99'])
+        self.assertEquals(7.0, histogram.get_percentile(100))
+        self.assertEquals([[0.005, 90], [0.05, 9], [None, 1]], ret['buckets'])
+
+    def test_stats(self):
+        """ Test the CommunicationStats. """
+        stats = CommunicationStats(1000, window=10)
+        stats.record_command('EL', 0.01)
+        stats.record_command('EL', 0.02)
+        stats.record_command('GVOL', 0.03, 5)
+        stats.record_failure('timeout', 'EL')
+        stats.record_failure('timeout', 'EL')
+        stats.record_failure('crc', 'RE')
+        stats.record_wait(0.5)
+        stats.record_bytes(500)
+
+        ret = stats.to_dict()
+        self.assertEquals(['EL', 'GVOL'], sorted(ret['actions'].keys()))
+        self.assertEquals(2, ret['actions']['EL']['count'])
+        self.assertEquals(['5'], ret['modules'].keys())
+        self.assertEquals({'timeout' : {'EL' : 2}, 'crc' : {'RE' : 1}}, ret['failures'])
+        self.assertEquals(1, ret['wait']['count'])
+        self.assertAlmostEquals(0.5, ret['utilisation']) # 500 bytes of 10 * 100 bytes
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()